@@ -0,0 +1,1270 @@
+import os
+import sys
+import asyncio
+import time
+import uuid
+import discord
+from discord.ext import commands
+from discord.ui import Button, View
+from dotenv import load_dotenv
+
+# srcディレクトリをパスに追加（uv run ./src/main.py から読み込まれる場合に対応）
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BASE_DIR)
+
+from audio_source import GuildAudioStream, StreamHandle
+from audio_cache import RenderedAudioCache
+from db import Database
+from engines import AUTO_LANGUAGE, SUPPORTED_LANGUAGES, create_synthesizer, detect_language, parse_engine_routes
+from governor import LoadGovernor, parse_tiers
+from length_policy import LengthPolicy, parse_guild_limits
+from metrics import PipelineMetrics
+from system_monitor import SystemMonitor
+from text_normalizer import TextNormalizer
+from text_utils import split_sentences
+from playback import AudioItem, PlaybackQueue
+from prewarm import PrewarmBudget
+from speaker_store import SpeakerStore, make_ref
+from scheduler import InProcessBackend, QueueFullError, SynthesisRequest, SynthesisScheduler
+from synthesis_service import RemoteBackend
+from worker_pool import ProcessPoolBackend
+
+# =====================
+# Env
+# =====================
+load_dotenv(os.path.join(BASE_DIR, ".env"))
+TOKEN = os.getenv("TOKEN")
+# 声クローン用の参照音声ファイル（オプション）
+SPEAKER_WAV_NAME = os.getenv("SPEAKER_WAV")
+SPEAKER_WAV = os.path.join(BASE_DIR, "audiofiles", SPEAKER_WAV_NAME) if SPEAKER_WAV_NAME else None
+AUDIOFILES_DIR = os.path.join(BASE_DIR, "audiofiles")
+# 話者コンディショニングのキャッシュ設定
+SPEAKER_CACHE_SIZE = int(os.getenv("SPEAKER_CACHE_SIZE", "16"))
+SPEAKER_CACHE_DIR = os.getenv("SPEAKER_CACHE_DIR") or None
+# 話者ストア（正規化済みの参照音声をまとめた1つのファイル）と容量の上限
+SPEAKER_STORE_PATH = os.getenv("SPEAKER_STORE_PATH") or os.path.join(AUDIOFILES_DIR, "speakers.bin")
+SPEAKER_STORE_MAX_MB = int(os.getenv("SPEAKER_STORE_MAX_MB", "256"))
+# 入力中のユーザーの話者を先読みする（1分あたりの上限・同じ話者を再び先読みするまでの秒数）
+TYPING_PREWARM = os.getenv("TYPING_PREWARM", "1") == "1"
+TYPING_PREWARM_PER_MINUTE = int(os.getenv("TYPING_PREWARM_PER_MINUTE", str(max(1, SPEAKER_CACHE_SIZE // 2))))
+TYPING_PREWARM_COOLDOWN = float(os.getenv("TYPING_PREWARM_COOLDOWN", "30"))
+# 読み上げる言語（"auto" で文字の種類から判定。サーバーごとに !lang で変更可）
+TTS_LANGUAGE = os.getenv("TTS_LANGUAGE", "ja")
+# 言語ごとのエンジン（"言語:エンジン,..."、"*" はその他）と、使われていないエンジンの解放条件
+TTS_ENGINES = parse_engine_routes(os.getenv("TTS_ENGINES", ""))
+TTS_DEFAULT_ENGINE = os.getenv("TTS_DEFAULT_ENGINE", "chatterbox")
+TTS_ENGINE_IDLE_TIMEOUT = float(os.getenv("TTS_ENGINE_IDLE_TIMEOUT", "600"))
+TTS_ENGINE_MEMORY_MB = int(os.getenv("TTS_ENGINE_MEMORY_MB", "0"))
+# 文単位で分割して生成・再生するストリーミングモード
+TTS_STREAMING = os.getenv("TTS_STREAMING", "1") == "1"
+TTS_CHUNK_MIN_CHARS = int(os.getenv("TTS_CHUNK_MIN_CHARS", "10"))
+TTS_CHUNK_MAX_CHARS = int(os.getenv("TTS_CHUNK_MAX_CHARS", "80"))
+# メッセージの長さの上限（音声トークンの見積もり、約25トークン/秒）と長文の扱い
+TTS_MAX_MESSAGE_TOKENS = int(os.getenv("TTS_MAX_MESSAGE_TOKENS", "1500"))
+TTS_LONG_MESSAGE_TOKENS = int(os.getenv("TTS_LONG_MESSAGE_TOKENS", "300"))
+TTS_GUILD_MAX_TOKENS = parse_guild_limits(os.getenv("TTS_GUILD_MAX_TOKENS", ""))
+TTS_TRUNCATION_SUFFIX = os.getenv("TTS_TRUNCATION_SUFFIX", "以下略")
+# 負荷に応じた品質の段階（"名前:cfg_weight:最大トークン数:最大文字数[:エンジン],..."、先頭が最高品質）
+TTS_GOVERNOR = os.getenv("TTS_GOVERNOR", "1") == "1"
+TTS_QUALITY_TIERS = parse_tiers(os.getenv("TTS_QUALITY_TIERS", ""))
+TTS_GOVERNOR_HIGH_PENDING = int(os.getenv("TTS_GOVERNOR_HIGH_PENDING", "8"))
+TTS_GOVERNOR_HIGH_RTF = float(os.getenv("TTS_GOVERNOR_HIGH_RTF", "0.9"))
+# 複数リクエストをまとめてバックエンドに渡すバッチ設定（推論は1件ずつなので、既定では待たない）
+TTS_BATCH_WINDOW_MS = int(os.getenv("TTS_BATCH_WINDOW_MS", "0"))
+TTS_MAX_BATCH_SIZE = int(os.getenv("TTS_MAX_BATCH_SIZE", "4"))
+# ギルド・ユーザーごとの待機上限（処理中を含む）
+TTS_MAX_PENDING_PER_GUILD = int(os.getenv("TTS_MAX_PENDING_PER_GUILD", "40"))
+TTS_MAX_PENDING_PER_USER = int(os.getenv("TTS_MAX_PENDING_PER_USER", "20"))
+# ギルドごとの再生キューの上限と破棄ポリシー
+PLAYBACK_MAX_ITEMS = int(os.getenv("PLAYBACK_MAX_ITEMS", "30"))
+PLAYBACK_MAX_AGE = float(os.getenv("PLAYBACK_MAX_AGE", "60"))
+PLAYBACK_COLLAPSE_SAME_USER = os.getenv("PLAYBACK_COLLAPSE_SAME_USER", "0") == "1"
+# ギルドごとの再生ストリーム（メッセージ間の無音・同じメッセージのチャンク間のクロスフェード・無音が続いたら停止するまでの秒数）
+PLAYBACK_GAP_MS = float(os.getenv("PLAYBACK_GAP_MS", "150"))
+PLAYBACK_CROSSFADE_MS = float(os.getenv("PLAYBACK_CROSSFADE_MS", "0"))
+PLAYBACK_IDLE_TIMEOUT = float(os.getenv("PLAYBACK_IDLE_TIMEOUT", "30"))
+# 短い定型メッセージの生成済み音声キャッシュ（0で無効）
+AUDIO_CACHE_MB = int(os.getenv("AUDIO_CACHE_MB", "64"))
+AUDIO_CACHE_MAX_CHARS = int(os.getenv("AUDIO_CACHE_MAX_CHARS", "20"))
+AUDIO_CACHE_DIR = os.getenv("AUDIO_CACHE_DIR") or None
+# システムステータスのサンプリング間隔（秒）
+STATUS_SAMPLE_INTERVAL = float(os.getenv("STATUS_SAMPLE_INTERVAL", "1"))
+# 合成ワーカープロセス数（0ならBotと同じプロセスで合成）
+TTS_WORKERS = int(os.getenv("TTS_WORKERS", "0"))
+# ワーカーが1つも準備できないまま待つ上限（秒）。超えるか全ワーカーが起動に失敗したらエラーにする
+TTS_WORKER_START_TIMEOUT = float(os.getenv("TTS_WORKER_START_TIMEOUT", "1800"))
+# 外部の合成サービス（カンマ区切り、"http://host:port" または "unix:/path"）。指定するとこのプロセスではモデルを読み込まない
+TTS_SERVICE_URLS = [url.strip() for url in os.getenv("TTS_SERVICE_URLS", "").split(",") if url.strip()]
+# シャーディング（SHARD_COUNT: 0なら無効、"auto"ならDiscordの推奨数。SHARD_IDS: このプロセスが担当するシャード）
+SHARD_COUNT = os.getenv("SHARD_COUNT", "0")
+SHARD_IDS = [int(i) for i in os.getenv("SHARD_IDS", "").split(",") if i.strip()]
+# 推論の最適化（torch.compile・CPUでのint8量子化・スレッド数）
+TTS_COMPILE = os.getenv("TTS_COMPILE", "0") == "1"
+TTS_QUANTIZE = os.getenv("TTS_QUANTIZE", "0") == "1"
+TTS_NUM_THREADS = int(os.getenv("TTS_NUM_THREADS", "0"))
+TTS_INTEROP_THREADS = int(os.getenv("TTS_INTEROP_THREADS", "0"))
+# 合成側でOpusにエンコードするビットレート（kbps、0ならPCMのまま再生時にエンコード）
+TTS_OPUS_BITRATE = int(os.getenv("TTS_OPUS_BITRATE", "0"))
+AUDIO_FORMAT = "opus" if TTS_OPUS_BITRATE > 0 else "pcm"
+# Prometheus形式のメトリクスを公開するポート（0で無効）
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+# =====================
+# Database
+# =====================
+db = Database(os.path.join(BASE_DIR, "kero_voice.db"))
+speaker_store = SpeakerStore(SPEAKER_STORE_PATH, max_bytes=SPEAKER_STORE_MAX_MB * 1024 * 1024)
+
+
+def speaker_reference(speaker: dict) -> str:
+    """合成に渡す話者の参照（話者ストアに移行済みなら "store:..."、未移行ならファイルパス）"""
+    if speaker["clip_offset"] is not None:
+        return make_ref(
+            speaker["clip_generation"], speaker["clip_offset"], speaker["clip_length"], speaker["clip_digest"]
+        )
+    return speaker["filepath"]
+
+
+def prepare_speaker_store():
+    """起動時に話者ストアを整える
+
+    - 詰め直しの途中で止まっていれば DB に記録された世代に揃える
+    - ハッシュを持たない古い登録にハッシュを付ける
+    - 削除された話者の領域が多ければ詰め直す
+    位置が変わるので、合成が始まる前（load_synthesis_backend）にだけ呼ぶ。ワーカープロセスからは呼ばない。
+    他のプロセスと共有している場合（SHARD_IDS 指定時）は詰め直さない。
+    """
+    speaker_store.recover(db.get_speaker_store_generation())
+
+    missing = {
+        speaker_id: speaker_store.digest(offset, length)
+        for speaker_id, (offset, length) in db.get_speaker_clips().items()
+        if not db.get_speaker_by_id(speaker_id)["clip_digest"]
+    }
+    if missing:
+        db.set_speaker_clip_digests(missing)
+
+    clips = db.get_speaker_clips()
+    if SHARD_IDS or not speaker_store.needs_compaction(clips):
+        return
+    freed = speaker_store.wasted_bytes(clips)
+    speaker_store.compact(clips, commit=db.move_speaker_clips)
+    print(f"Speaker store compacted ({freed / 1024 / 1024:.1f} MB freed)")
+
+# 読み上げ前のテキスト正規化（ギルドごとの辞書を含む）
+normalizer = TextNormalizer()
+for dict_guild_id, entries in db.get_dictionaries().items():
+    normalizer.set_dictionary(dict_guild_id, entries)
+
+# =====================
+# TTS (Discord接続後にバックグラウンドで読み込み)
+# =====================
+# 読み込みが終わるまでは None（メッセージはスケジューラーで待たせる）
+synthesis_backend = None
+# TTSの準備状況: loading / warming up / ready / error
+tts_state = "loading"
+tts_state_detail = ""
+
+
+def set_tts_state(state: str, detail: str = ""):
+    global tts_state, tts_state_detail
+    tts_state, tts_state_detail = state, detail
+    print(f"TTS {state}" + (f": {detail}" if detail else ""))
+
+
+def create_synthesis_backend():
+    """合成バックエンドを作成（TTS_WORKERS > 0 ならワーカープロセス、0なら同一プロセス）
+
+    ブロッキングなので、イベントループからはスレッドで呼ぶ。
+    """
+    synth_kwargs = dict(
+        speaker_cache_size=SPEAKER_CACHE_SIZE,
+        speaker_cache_dir=SPEAKER_CACHE_DIR,
+        compile_model=TTS_COMPILE,
+        quantize=TTS_QUANTIZE,
+        num_threads=TTS_NUM_THREADS,
+        interop_threads=TTS_INTEROP_THREADS,
+        speaker_store_path=SPEAKER_STORE_PATH,
+        opus_bitrate=TTS_OPUS_BITRATE,
+    )
+    engine_config = dict(
+        routes=TTS_ENGINES,
+        default_engine=TTS_DEFAULT_ENGINE,
+        # 品質の段階で退避先に指定されたエンジン
+        engines=[tier.engine for tier in TTS_QUALITY_TIERS if tier.engine],
+        idle_timeout=TTS_ENGINE_IDLE_TIMEOUT,
+        memory_budget_mb=TTS_ENGINE_MEMORY_MB,
+    )
+    if TTS_WORKERS > 0:
+        print(f"Starting {TTS_WORKERS} TTS worker processes...")
+        backend = ProcessPoolBackend(TTS_WORKERS, synth_kwargs, engine_config)
+        # 各ワーカーは読み込みとウォームアップを済ませてから ready を返す
+        set_tts_state("warming up")
+        deadline = time.monotonic() + TTS_WORKER_START_TIMEOUT
+        while backend.ready_workers == 0:
+            if backend.startup_failures >= backend.num_workers or time.monotonic() > deadline:
+                failures = backend.startup_failures
+                backend.close()
+                raise RuntimeError(f"TTS workers failed to start ({failures} failed)")
+            time.sleep(0.5)
+        return backend
+
+    print("Loading TTS model... (this may take a while)")
+    synth = create_synthesizer(synth_kwargs, **engine_config)
+    # 他のエンジンは使われたときに読み込む
+    synth.preload()
+    set_tts_state("warming up")
+    print(f"TTS warm-up finished in {synth.warmup():.1f}s")
+    return InProcessBackend(synth)
+
+
+async def load_synthesis_backend():
+    """モデルの読み込みとウォームアップをバックグラウンドで行い、スケジューラーに設定する
+
+    誰も待たないタスクとして動くので、例外はここでログに出す。
+    """
+    global synthesis_backend
+    start = time.monotonic()
+    try:
+        # 話者ストアの整理は合成が始まる前に済ませる（詰め直しは時間がかかることがある）
+        await asyncio.to_thread(prepare_speaker_store)
+        if TTS_SERVICE_URLS:
+            # 合成サービスのいずれかが準備できるまで待つ
+            backend = RemoteBackend(TTS_SERVICE_URLS, audio_format=AUDIO_FORMAT)
+            await backend.wait_ready()
+            start_background_task(backend.monitor())
+        else:
+            backend = await asyncio.to_thread(create_synthesis_backend)
+    except Exception as e:
+        set_tts_state("error", f"{type(e).__name__}: {e}")
+        # 読み込み中に受け付けたリクエストは破棄
+        await scheduler.stop()
+        return
+    synthesis_backend = backend
+    scheduler.set_backend(backend)
+    set_tts_state("ready", f"loaded in {time.monotonic() - start:.0f}s")
+    try:
+        await migrate_speakers_to_store()
+    except Exception as e:
+        print(f"Speaker migration failed: {type(e).__name__}: {e}")
+
+
+async def migrate_speakers_to_store():
+    """話者ストアに入っていない話者（以前のバージョンで登録したファイル）を1度だけ移行する"""
+    pending = [s for s in db.get_speakers() if s["clip_offset"] is None]
+    if not pending:
+        return
+    print(f"Migrating {len(pending)} speakers to the speaker store...")
+    for speaker in pending:
+        # 別のプロセスが先に移行していないか確認
+        db.refresh_if_changed()
+        current = db.get_speaker_by_id(speaker["id"])
+        if not current or current["clip_offset"] is not None:
+            continue
+        src_path = current["filepath"]
+        if not os.path.exists(src_path):
+            print(f"Speaker file not found, skipping: {current['name']} ({src_path})")
+            continue
+
+        wav_path = os.path.join(AUDIOFILES_DIR, f"{uuid.uuid4().hex}.wav")
+        conds_path = current["conds_path"] or os.path.splitext(src_path)[0] + ".conds.pt"
+        try:
+            await synthesis_backend.prepare_speaker(src_path, wav_path, conds_path)
+            offset, length, digest, generation = await asyncio.to_thread(speaker_store.append_wav, wav_path)
+        except Exception as e:
+            print(f"Speaker migration error ({current['name']}): {e}")
+            continue
+        finally:
+            if os.path.exists(wav_path):
+                os.remove(wav_path)
+
+        db.set_speaker_clip(
+            current["id"], (offset, length, speaker_store.sample_rate, digest, generation), "", conds_path
+        )
+        synthesis_backend.invalidate_speaker(src_path)
+        try:
+            os.remove(src_path)
+        except OSError as e:
+            print(f"Could not remove migrated speaker file ({src_path}): {e}")
+
+
+def describe_tts_state() -> str:
+    """!status 用の準備状況"""
+    if isinstance(synthesis_backend, ProcessPoolBackend):
+        return f"{tts_state} ({synthesis_backend.ready_workers}/{TTS_WORKERS} workers)"
+    if isinstance(synthesis_backend, RemoteBackend):
+        return f"{tts_state} ({synthesis_backend.ready_count}/{len(TTS_SERVICE_URLS)} services)"
+    text = tts_state
+    if tts_state_detail:
+        text += f" ({tts_state_detail})"
+    if tts_state in ("loading", "warming up") and scheduler.pending:
+        text += f", {scheduler.pending} queued"
+    return text
+
+
+def describe_quality() -> str | None:
+    """!status 用の品質の段階（表示するだけで段階は変えない。段階の更新は合成の経路で行う）"""
+    if governor is None or not scheduler.ready:
+        return None
+    return governor.describe()
+
+# =====================
+# Discord
+# =====================
+intents = discord.Intents.default()
+intents.message_content = True
+intents.voice_states = True
+
+if SHARD_COUNT != "0":
+    # シャードごとにゲートウェイ接続を分ける（複数プロセスで分担する場合は SHARD_IDS を指定）
+    bot = commands.AutoShardedBot(
+        command_prefix="!",
+        intents=intents,
+        help_command=None,
+        shard_count=None if SHARD_COUNT == "auto" else int(SHARD_COUNT),
+        shard_ids=SHARD_IDS or None,
+    )
+else:
+    bot = commands.Bot(
+        command_prefix="!",
+        intents=intents,
+        help_command=None
+    )
+
+shutdown_event = asyncio.Event()
+
+# 投げっぱなしのタスク（イベントループは弱参照しか持たないので、完了まで参照を保持する）
+background_tasks: set[asyncio.Task] = set()
+
+
+def start_background_task(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+# 生成済み音声キャッシュ
+audio_cache = RenderedAudioCache(
+    max_bytes=AUDIO_CACHE_MB * 1024 * 1024,
+    max_text_length=AUDIO_CACHE_MAX_CHARS,
+    disk_dir=AUDIO_CACHE_DIR,
+    audio_format=AUDIO_FORMAT,
+) if AUDIO_CACHE_MB > 0 else None
+
+# メッセージの長さの扱い（文単位での切り詰め・長文の低優先度化）
+length_policy = LengthPolicy(
+    max_tokens=TTS_MAX_MESSAGE_TOKENS,
+    long_tokens=TTS_LONG_MESSAGE_TOKENS,
+    guild_limits=TTS_GUILD_MAX_TOKENS,
+    truncation_suffix=TTS_TRUNCATION_SUFFIX,
+)
+
+# 区間ごとのレイテンシ計測
+metrics = PipelineMetrics()
+
+# 待ち行列が伸びたら品質を下げて（CFGを弱める・生成長と文の長さを抑える）遅れを取り戻す
+governor = LoadGovernor(
+    TTS_QUALITY_TIERS,
+    high_pending=TTS_GOVERNOR_HIGH_PENDING,
+    low_pending=max(0, TTS_GOVERNOR_HIGH_PENDING // 4),
+    high_rtf=TTS_GOVERNOR_HIGH_RTF,
+    low_rtf=TTS_GOVERNOR_HIGH_RTF * 2 / 3,
+) if TTS_GOVERNOR else None
+
+# 合成リクエストのスケジューラー（ギルドごとのラウンドロビン + バッチ）
+# バックエンドは読み込み完了後に set_backend() で設定する
+scheduler = SynthesisScheduler(
+    None,
+    batch_window=TTS_BATCH_WINDOW_MS / 1000,
+    max_batch_size=TTS_MAX_BATCH_SIZE,
+    # 合成サービスを使う場合はサービスの台数分のバッチを同時に送る
+    num_workers=max(1, TTS_WORKERS, len(TTS_SERVICE_URLS)),
+    max_pending_per_guild=TTS_MAX_PENDING_PER_GUILD,
+    max_pending_per_user=TTS_MAX_PENDING_PER_USER,
+    cache=audio_cache,
+    metrics=metrics,
+    governor=governor,
+)
+
+metrics.register_gauge("scheduler_pending", lambda: scheduler.pending)
+metrics.register_gauge("playback_dropped_total", lambda: sum(q.dropped for q in audio_queues.values()))
+if governor is not None:
+    metrics.register_gauge("quality_tier", lambda: governor.level)
+    metrics.register_gauge("quality_tier_changes_total", lambda: governor.changes)
+
+# 入力中の話者の先読み（話者キャッシュを追い出し合わないよう回数を制限）
+prewarm_budget = PrewarmBudget(
+    max_per_window=TYPING_PREWARM_PER_MINUTE,
+    window=60.0,
+    cooldown=TYPING_PREWARM_COOLDOWN,
+)
+metrics.register_gauge("typing_prefetch_total", lambda: prewarm_budget.allowed)
+metrics.register_gauge("typing_prefetch_skipped_total", lambda: prewarm_budget.skipped)
+if audio_cache is not None:
+    metrics.register_gauge("audio_cache_hits_total", lambda: audio_cache.hits + audio_cache.disk_hits)
+    metrics.register_gauge("audio_cache_misses_total", lambda: audio_cache.misses)
+    metrics.register_gauge("audio_cache_hit_rate", lambda: audio_cache.hit_rate)
+    metrics.register_gauge("audio_cache_bytes", lambda: audio_cache.size_bytes)
+
+
+async def refresh_shared_state():
+    """他のシャードのプロセスが登録した話者・辞書を取り込む"""
+    known_guilds = set(db.get_dictionaries())
+    while True:
+        await asyncio.sleep(5)
+        if await asyncio.to_thread(db.refresh_if_changed):
+            dictionaries = db.get_dictionaries()
+            # 全件削除されたギルドの辞書も空にする
+            for dict_guild_id in known_guilds | set(dictionaries):
+                normalizer.set_dictionary(dict_guild_id, dictionaries.get(dict_guild_id, {}))
+            known_guilds = set(dictionaries)
+
+
+async def setup_hook():
+    scheduler.start()
+    if SHARD_COUNT != "0":
+        start_background_task(refresh_shared_state())
+    # Discordへの接続を待たせないよう、話者ストアの整理とモデルの読み込みはバックグラウンドで行う
+    start_background_task(load_synthesis_backend())
+    SystemMonitor.start_sampler(interval=STATUS_SAMPLE_INTERVAL)
+    if METRICS_PORT > 0:
+        await metrics.serve(METRICS_HOST, METRICS_PORT)
+        print(f"Metrics endpoint: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+bot.setup_hook = setup_hook
+
+_close_bot = bot.close
+
+
+async def close_bot():
+    """Discordから切断し、ワーカープロセスと合成サービスへの接続を閉じる"""
+    await _close_bot()
+    if isinstance(synthesis_backend, ProcessPoolBackend):
+        await asyncio.to_thread(synthesis_backend.close)
+    elif isinstance(synthesis_backend, RemoteBackend):
+        await synthesis_backend.close()
+
+bot.close = close_bot
+
+# =====================
+# Audio Queue System
+# =====================
+# ギルドごとの再生キュー
+audio_queues: dict[int, PlaybackQueue] = {}
+playback_tasks: dict[int, asyncio.Task] = {}
+audio_streams: dict[int, GuildAudioStream] = {}
+
+
+def get_audio_stream(guild_id: int, vc: discord.VoiceClient) -> GuildAudioStream:
+    """ギルドの再生ストリームを取得（無い・終了済みなら作り直して再生を始める）"""
+    stream = audio_streams.get(guild_id)
+    if stream is not None and not stream.closed and vc.is_playing():
+        return stream
+
+    if vc.is_playing():
+        vc.stop()
+    stream = GuildAudioStream(
+        asyncio.get_running_loop(),
+        gap_ms=PLAYBACK_GAP_MS,
+        crossfade_ms=PLAYBACK_CROSSFADE_MS,
+        idle_timeout=PLAYBACK_IDLE_TIMEOUT,
+        opus=TTS_OPUS_BITRATE > 0,
+    )
+    audio_streams[guild_id] = stream
+
+    def after_play(error):
+        if error:
+            print(f"Playback error: {error}")
+
+    vc.play(stream, after=after_play)
+    return stream
+
+
+async def track_playback(guild_id: int, queue: PlaybackQueue, item: AudioItem, handle: StreamHandle):
+    """ストリームでの再生の開始・終了に合わせて再生中の項目とメトリクスを更新"""
+    try:
+        await handle.started.wait()
+        if handle.finished.is_set() and not handle.played:
+            return  # 再生前に破棄された
+
+        # 合成完了から再生開始まで、メッセージ受信から最初の音声まで
+        started_at = time.monotonic()
+        queue.current = item
+        if item.ready_at is not None:
+            metrics.record("playback_delay", started_at - item.ready_at, guild_id)
+        if item.first_chunk:
+            metrics.record("time_to_first_audio", started_at - item.created_at, guild_id)
+
+        await handle.finished.wait()
+        if handle.played:
+            metrics.record("playback", time.monotonic() - started_at, guild_id)
+    finally:
+        if queue.current is item:
+            queue.current = None
+
+
+async def playback_worker(guild_id: int):
+    """キューの音声をギルドの再生ストリームへ順に送るワーカー（VCセッションの終了時にキャンセルされる）
+
+    ストリームには再生中の1件と次の1件だけを入れ、それより後はキューに残す
+    （!skip・!clear や古くなった項目の破棄が効くように）。
+    """
+    queue = audio_queues[guild_id]
+
+    while not shutdown_event.is_set():
+        item = await queue.get()
+        try:
+            queue.preparing = item
+
+            # TTS処理完了を待つ
+            await item.ready.wait()
+
+            if item.pcm is None:
+                continue
+
+            guild = bot.get_guild(guild_id)
+            if not guild or not guild.voice_client:
+                # VCから切断済みならセッションごと破棄
+                end_voice_session(guild_id)
+                return
+
+            vc = guild.voice_client
+            handle = get_audio_stream(guild_id, vc).append(item.pcm, item.message_id)
+            if handle is None:
+                # 無音が続いてストリームが終了した直後なら作り直す
+                handle = get_audio_stream(guild_id, vc).append(item.pcm, item.message_id)
+            start_background_task(track_playback(guild_id, queue, item, handle))
+
+            # 次の項目はこの項目の再生が始まってから取り出す
+            await handle.started.wait()
+
+        except Exception as e:
+            print(f"Playback worker error: {e}")
+        finally:
+            queue.preparing = None
+            item.pcm = None
+
+
+def get_or_create_queue(guild_id: int) -> PlaybackQueue:
+    """ギルドの再生キューを取得または作成"""
+    if guild_id not in audio_queues:
+        audio_queues[guild_id] = PlaybackQueue(
+            max_items=PLAYBACK_MAX_ITEMS,
+            max_age=PLAYBACK_MAX_AGE,
+            collapse_same_user=PLAYBACK_COLLAPSE_SAME_USER,
+        )
+        playback_tasks[guild_id] = asyncio.create_task(playback_worker(guild_id))
+    return audio_queues[guild_id]
+
+
+def end_voice_session(guild_id: int):
+    """ギルドの読み上げを終了する
+
+    合成待ち・合成中のリクエストを取り消し、再生キューを空にして再生ワーカーを止める。
+    ギルド別のメトリクスも破棄する。
+    """
+    cancelled = scheduler.cancel_guild(guild_id)
+    queue = audio_queues.pop(guild_id, None)
+    if queue:
+        cancelled += queue.clear()
+        for item in (queue.current, queue.preparing):
+            if item:
+                item.cancel()
+    stream = audio_streams.pop(guild_id, None)
+    if stream:
+        stream.clear()
+    # ギルド別の区間時間は次のセッションで取り直す（退出したギルドの分を溜め続けない）
+    metrics.forget_guild(guild_id)
+
+    task = playback_tasks.pop(guild_id, None)
+    if task and task is not asyncio.current_task():
+        task.cancel()
+
+    if cancelled:
+        print(f"Voice session ended in guild {guild_id}: {cancelled} pending items cancelled")
+
+# =====================
+# Events
+# =====================
+@bot.event
+async def on_ready():
+    print(f"Logged in as {bot.user} (ID: {bot.user.id})")
+    print("Bot is ready!")
+
+
+@bot.event
+async def on_typing(channel, user, when):
+    """VCで読み上げ中のギルドでユーザーが入力を始めたら、その話者のコンディショニングを先読みする
+
+    メッセージが届く前に読み込んでおき、初回の読み込み時間を最初の音声までの時間に含めない。
+    """
+    guild = getattr(channel, "guild", None)
+    if (
+        not TYPING_PREWARM
+        or user.bot
+        or guild is None
+        or not guild.voice_client
+        or not guild.voice_client.is_connected()
+        or synthesis_backend is None
+    ):
+        return
+
+    # 組み込みの話者は常にメモリにある
+    speaker = db.get_user_speaker(user.id)
+    if not speaker:
+        return
+    speaker_wav = speaker_reference(speaker)
+    if not prewarm_budget.allow(speaker_wav):
+        return
+
+    start = time.perf_counter()
+    try:
+        await synthesis_backend.prefetch_speaker(speaker_wav, speaker["conds_path"])
+    except Exception as e:
+        print(f"Speaker prefetch error: {e}")
+        return
+    metrics.record("speaker_prefetch", time.perf_counter() - start, guild.id)
+
+
+@bot.event
+async def on_voice_state_update(member, before, after):
+    """ボイスチャンネルに誰もいなくなったら自動で退出"""
+    # Bot自身が切断された（!leave・自動退出・キックなど）ら読み上げを終了
+    if member.id == bot.user.id and after.channel is None:
+        end_voice_session(member.guild.id)
+        return
+
+    # ボイスチャンネルから離脱したイベントだけを見る
+    if before.channel is None or after.channel == before.channel:
+        return
+
+    channel = before.channel
+
+    # このギルドにBotが接続しているか？
+    if channel.guild.voice_client is None:
+        return
+
+    bot_voice = channel.guild.voice_client
+
+    # Botが現在いるチャンネルと一致しているか？
+    if bot_voice.channel != channel:
+        return
+
+    # 残っているメンバーに人間がいるかチェック
+    humans = [m for m in channel.members if not m.bot]
+
+    if len(humans) == 0:
+        end_voice_session(channel.guild.id)
+        await bot_voice.disconnect()
+        print("誰もいなくなったのでBOTは退出しました。")
+
+# =====================
+# Commands
+# =====================
+@bot.command()
+async def help(ctx):
+    """ヘルプを表示"""
+    embed = discord.Embed(
+        title="kero-voice Bot",
+        description="テキストを音声に変換してVCで再生するBotです",
+        color=discord.Color.green()
+    )
+    embed.add_field(
+        name="!join",
+        value="Botをあなたのボイスチャンネルに参加させます",
+        inline=False
+    )
+    embed.add_field(
+        name="!leave",
+        value="Botをボイスチャンネルから切断します",
+        inline=False
+    )
+    embed.add_field(
+        name="!skip",
+        value="再生中のメッセージをスキップします",
+        inline=False
+    )
+    embed.add_field(
+        name="!clear",
+        value="読み上げ待ちのメッセージをすべて破棄します",
+        inline=False
+    )
+    embed.add_field(
+        name="!speakers",
+        value="利用可能な話者一覧を表示します",
+        inline=False
+    )
+    embed.add_field(
+        name="!myvoice",
+        value="現在設定されている話者を確認します",
+        inline=False
+    )
+    embed.add_field(
+        name="!sr <name>",
+        value="話者ファイルを登録（名前を指定して音声ファイルを添付）",
+        inline=False
+    )
+    embed.add_field(
+        name="!sd <name>",
+        value="話者ファイルを削除",
+        inline=False
+    )
+    embed.add_field(
+        name="!dict add <単語> <読み>",
+        value="読み方を辞書に登録します（`!dict remove <単語>` で削除、`!dict list` で一覧）",
+        inline=False
+    )
+    embed.add_field(
+        name="!lang <言語コード>",
+        value="このサーバーの読み上げ言語を設定します（`auto` で文字の種類から判定、`reset` でデフォルト）",
+        inline=False
+    )
+    embed.add_field(
+        name="!status",
+        value="システムステータスを表示（1分間自動更新）",
+        inline=False
+    )
+    embed.add_field(
+        name="!perf",
+        value="読み上げの処理時間（p50/p95/p99）を表示します",
+        inline=False
+    )
+    embed.add_field(
+        name="!help",
+        value="このヘルプを表示します",
+        inline=False
+    )
+    embed.add_field(
+        name="使い方",
+        value="Botがボイスチャンネルに参加中、テキストチャンネルにメッセージを送ると音声で読み上げます",
+        inline=False
+    )
+    await ctx.send(embed=embed)
+
+
+@bot.command()
+async def join(ctx):
+    """ボイスチャンネルに参加"""
+    if ctx.author.voice is None:
+        return await ctx.send("VCに入ってください")
+
+    target_channel = ctx.author.voice.channel
+
+    if ctx.voice_client is None:
+        # 未接続の場合は接続
+        await target_channel.connect()
+        await ctx.send(f"{target_channel.name} に参加しました")
+    elif ctx.voice_client.channel != target_channel:
+        # 別チャンネルにいる場合は移動
+        await ctx.voice_client.move_to(target_channel)
+        await ctx.send(f"{target_channel.name} に移動しました")
+    else:
+        await ctx.send("既に同じVCにいます")
+
+
+@bot.command()
+async def leave(ctx):
+    """ボイスチャンネルから退出"""
+    vc = ctx.guild.voice_client
+    if vc:
+        end_voice_session(ctx.guild.id)
+        await vc.disconnect()
+        await ctx.send("VCから切断しました")
+    else:
+        await ctx.send("VCにいません")
+
+
+@bot.command()
+async def skip(ctx):
+    """再生中のメッセージをスキップ"""
+    queue = audio_queues.get(ctx.guild.id)
+    stream = audio_streams.get(ctx.guild.id)
+    current = queue and (queue.current or queue.preparing)
+    if current:
+        queue.skip_current()
+        current.cancel()
+        if stream:
+            stream.skip(current.message_id)
+
+
+@bot.command()
+async def clear(ctx):
+    """再生待ちのメッセージをすべて破棄"""
+    count = 0
+    queue = audio_queues.get(ctx.guild.id)
+    if queue:
+        count = queue.clear()
+        for item in (queue.current, queue.preparing):
+            if item:
+                item.cancel()
+    stream = audio_streams.get(ctx.guild.id)
+    if stream:
+        stream.clear()
+    await ctx.send(f"読み上げ待ちを {count} 件破棄しました", delete_after=10)
+
+
+# =====================
+# Speaker File Management
+# =====================
+ALLOWED_EXTENSIONS = {".mp3", ".wav"}
+
+
+@bot.command()
+async def sr(ctx, name: str = None):
+    """話者ファイルを登録 (!sr <名前> + ファイル添付)"""
+    # 名前のチェック
+    if not name:
+        return await ctx.send("使い方: `!sr <名前>` + 音声ファイル添付", delete_after=10)
+
+    # 名前の長さチェック
+    if len(name) > 8:
+        return await ctx.send("名前は8文字以下にしてください", delete_after=10)
+
+    # 添付ファイルのチェック
+    if not ctx.message.attachments:
+        return await ctx.send("音声ファイルを添付してください（.mp3 または .wav）", delete_after=10)
+
+    attachment = ctx.message.attachments[0]
+    original_ext = os.path.splitext(attachment.filename)[1].lower()
+
+    # 拡張子チェック
+    if original_ext not in ALLOWED_EXTENSIONS:
+        return await ctx.send(f"対応していない形式です。対応形式: {', '.join(ALLOWED_EXTENSIONS)}", delete_after=10)
+
+    # 重複チェック（名前で）
+    if db.get_speaker_by_name(name):
+        return await ctx.send(f"**{name}** は既に登録されています", delete_after=10)
+
+    if synthesis_backend is None:
+        return await ctx.send("TTSモデルを読み込み中です。しばらくしてからもう一度お試しください", delete_after=10)
+
+    # ファイル名をランダムなIDに変換（特殊文字対策）
+    file_id = uuid.uuid4().hex
+    upload_path = os.path.join(AUDIOFILES_DIR, f"{file_id}.upload{original_ext}")
+    # 正規化済みの参照音声（話者ストアに追記したら消す）と事前計算したコンディショニング
+    wav_path = os.path.join(AUDIOFILES_DIR, f"{file_id}.wav")
+    conds_path = os.path.join(AUDIOFILES_DIR, f"{file_id}.conds.pt")
+
+    # ファイル保存
+    try:
+        await attachment.save(upload_path)
+    except Exception as e:
+        return await ctx.send(f"ファイルの保存に失敗しました: {e}", delete_after=10)
+
+    # 正規化とコンディショニングの事前計算（イベントループ外で実行）し、話者ストアに追記
+    try:
+        await synthesis_backend.prepare_speaker(upload_path, wav_path, conds_path)
+        offset, length, digest, generation = await asyncio.to_thread(speaker_store.append_wav, wav_path)
+    except Exception as e:
+        if os.path.exists(conds_path):
+            os.remove(conds_path)
+        return await ctx.send(f"音声ファイルの処理に失敗しました: {e}", delete_after=10)
+    finally:
+        for path in (upload_path, wav_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    # DB登録（name=表示名、参照音声は話者ストア内の位置）
+    speaker_id = db.add_speaker(
+        name, "", conds_path, (offset, length, speaker_store.sample_rate, digest, generation)
+    )
+    if speaker_id:
+        await ctx.send(f"**{name}** を登録しました", delete_after=10)
+    else:
+        # 保存したファイルを削除（話者ストアの領域は次回起動時に詰める）
+        if os.path.exists(conds_path):
+            os.remove(conds_path)
+        await ctx.send("データベースへの登録に失敗しました", delete_after=10)
+
+
+@bot.command()
+async def sd(ctx, name: str = None):
+    """話者ファイルを削除 (!sd <名前>)"""
+    if not name:
+        return await ctx.send("使い方: `!sd <名前>`", delete_after=10)
+
+    # DB検索（名前で）
+    speaker = db.get_speaker_by_name(name)
+    if not speaker:
+        return await ctx.send(f"**{name}** は登録されていません", delete_after=10)
+
+    # ファイル削除（話者ストアに移行済みなら領域は次回起動時に詰める）
+    filepath = speaker["filepath"]
+    if filepath and os.path.exists(filepath):
+        try:
+            os.remove(filepath)
+        except Exception as e:
+            return await ctx.send(f"ファイルの削除に失敗しました: {e}", delete_after=10)
+
+    # 事前計算したコンディショニングを削除
+    conds_path = speaker["conds_path"]
+    if conds_path and os.path.exists(conds_path):
+        try:
+            os.remove(conds_path)
+        except OSError:
+            pass
+
+    # キャッシュ済みのコンディショニングを破棄
+    if synthesis_backend is not None:
+        synthesis_backend.invalidate_speaker(speaker_reference(speaker))
+
+    # DB削除
+    if db.delete_speaker(speaker["id"]):
+        await ctx.send(f"**{name}** を削除しました", delete_after=10)
+    else:
+        await ctx.send("データベースからの削除に失敗しました", delete_after=10)
+
+
+# =====================
+# Speaker Selection UI
+# =====================
+class SpeakerSelectView(View):
+    """話者選択用のボタンビュー"""
+
+    def __init__(self, speakers: list[dict]):
+        super().__init__(timeout=None)  # 同一インスタンス中は有効
+        for speaker in speakers[:25]:  # Discordの制限: 最大25ボタン
+            label = speaker["name"][:20]
+            button = Button(
+                label=label,
+                style=discord.ButtonStyle.primary,
+                custom_id=f"speaker_{speaker['id']}"
+            )
+            button.callback = self.create_callback(speaker["id"])
+            self.add_item(button)
+
+    def create_callback(self, speaker_id: int):
+        async def callback(interaction: discord.Interaction):
+            user_id = interaction.user.id
+            speaker = db.get_speaker_by_id(speaker_id)
+            if speaker and db.set_user_speaker(user_id, speaker_id):
+                await interaction.response.send_message(
+                    f"話者を **{speaker['name']}** に設定しました",
+                    ephemeral=True
+                )
+            else:
+                await interaction.response.send_message(
+                    "設定に失敗しました",
+                    ephemeral=True
+                )
+        return callback
+
+
+def chunk_list(lst: list, n: int) -> list[list]:
+    """リストをn個ずつに分割"""
+    return [lst[i:i + n] for i in range(0, len(lst), n)]
+
+
+@bot.command()
+async def speakers(ctx):
+    """利用可能な話者一覧を表示（ボタンで選択）"""
+    speaker_list = db.get_speakers()
+
+    if not speaker_list:
+        return await ctx.send("話者が登録されていません")
+
+    # 25個ずつに分割してViewを作成
+    blocks = chunk_list(speaker_list, 25)
+    for block in blocks:
+        view = SpeakerSelectView(block)
+        await ctx.send("話者を選択してください:", view=view)
+
+
+@bot.command()
+async def myvoice(ctx):
+    """現在の話者設定を確認"""
+    user_id = ctx.author.id
+    speaker = db.get_user_speaker(user_id)
+
+    if speaker:
+        await ctx.send(f"現在の話者: **{speaker['name']}**", delete_after=10)
+    else:
+        await ctx.send("話者が設定されていません。デフォルトの話者を使用します。", delete_after=10)
+
+
+# =====================
+# Dictionary
+# =====================
+MAX_DICTIONARY_WORDS = 500
+MAX_DICTIONARY_WORD_LENGTH = 50
+
+
+@bot.group(name="dict", invoke_without_command=True)
+async def dictionary(ctx):
+    """読み方辞書の操作 (!dict add / remove / list)"""
+    await ctx.send(
+        "使い方: `!dict add <単語> <読み>` / `!dict remove <単語>` / `!dict list`",
+        delete_after=10
+    )
+
+
+@dictionary.command(name="add")
+async def dictionary_add(ctx, word: str = None, *, reading: str = None):
+    """辞書に読み方を登録 (!dict add <単語> <読み>)"""
+    if not word or not reading:
+        return await ctx.send("使い方: `!dict add <単語> <読み>`", delete_after=10)
+
+    reading = reading.strip()
+    if len(word) > MAX_DICTIONARY_WORD_LENGTH or len(reading) > MAX_DICTIONARY_WORD_LENGTH:
+        return await ctx.send(f"単語と読みは{MAX_DICTIONARY_WORD_LENGTH}文字以下にしてください", delete_after=10)
+
+    entries = db.get_dictionary(ctx.guild.id)
+    if word not in entries and len(entries) >= MAX_DICTIONARY_WORDS:
+        return await ctx.send(f"辞書に登録できるのは{MAX_DICTIONARY_WORDS}件までです", delete_after=10)
+
+    db.set_dictionary_word(ctx.guild.id, word, reading)
+    normalizer.set_dictionary(ctx.guild.id, db.get_dictionary(ctx.guild.id))
+    await ctx.send(f"**{word}** の読みを **{reading}** に設定しました", delete_after=10)
+
+
+@dictionary.command(name="remove")
+async def dictionary_remove(ctx, word: str = None):
+    """辞書から単語を削除 (!dict remove <単語>)"""
+    if not word:
+        return await ctx.send("使い方: `!dict remove <単語>`", delete_after=10)
+
+    if db.remove_dictionary_word(ctx.guild.id, word):
+        normalizer.set_dictionary(ctx.guild.id, db.get_dictionary(ctx.guild.id))
+        await ctx.send(f"**{word}** を辞書から削除しました", delete_after=10)
+    else:
+        await ctx.send(f"**{word}** は辞書に登録されていません", delete_after=10)
+
+
+@dictionary.command(name="list")
+async def dictionary_list(ctx):
+    """辞書の一覧を表示"""
+    entries = db.get_dictionary(ctx.guild.id)
+    if not entries:
+        return await ctx.send("辞書に単語が登録されていません", delete_after=10)
+
+    lines = [f"{word} → {reading}" for word, reading in sorted(entries.items())]
+    # Discordのメッセージ上限（2000文字）に収める
+    body = ""
+    for line in lines:
+        if len(body) + len(line) + 1 > 1900:
+            body += "…"
+            break
+        body += line + "\n"
+    await ctx.send(f"```\n{body}```")
+
+
+# =====================
+# Language
+# =====================
+@bot.command(name="lang")
+async def guild_language(ctx, code: str = None):
+    """サーバーの読み上げ言語を設定 (!lang <言語コード|auto|reset>)"""
+    if not code:
+        current = db.get_guild_language(ctx.guild.id)
+        label = current or f"{TTS_LANGUAGE}（デフォルト）"
+        return await ctx.send(
+            f"このサーバーの読み上げ言語: **{label}**\n"
+            "使い方: `!lang <言語コード>` / `!lang auto`（文字の種類で判定） / `!lang reset`",
+            delete_after=15
+        )
+
+    code = code.lower()
+    if code == "reset":
+        db.set_guild_language(ctx.guild.id, None)
+        return await ctx.send(f"読み上げ言語をデフォルト（**{TTS_LANGUAGE}**）に戻しました", delete_after=10)
+    if code != AUTO_LANGUAGE and code not in SUPPORTED_LANGUAGES:
+        return await ctx.send(
+            f"対応していない言語です。使える言語: auto, {', '.join(sorted(SUPPORTED_LANGUAGES))}",
+            delete_after=15
+        )
+
+    db.set_guild_language(ctx.guild.id, code)
+    await ctx.send(f"読み上げ言語を **{code}** に設定しました", delete_after=10)
+
+
+# アクティブなステータス更新タスクを管理（ギルドIDをキーに）
+active_status_tasks: dict[int, asyncio.Task] = {}
+
+
+@bot.command()
+async def status(ctx):
+    """システムステータスを表示（1分間自動更新、再実行で停止）"""
+    guild_id = ctx.guild.id
+
+    # 既存のタスクがあれば停止
+    if guild_id in active_status_tasks:
+        active_status_tasks[guild_id].cancel()
+        del active_status_tasks[guild_id]
+        return
+
+    # 初回メッセージ送信
+    status_msg = SystemMonitor.generate_status_message(describe_tts_state(), describe_quality())
+    message = await ctx.send(status_msg)
+
+    async def update_status():
+        """1分間、1秒ごとにステータスを更新"""
+        try:
+            for _ in range(60):  # 60秒間
+                await asyncio.sleep(1)
+                status_msg = SystemMonitor.generate_status_message(describe_tts_state(), describe_quality())
+                await message.edit(content=status_msg)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"Status update error: {e}")
+        finally:
+            # 完了したらタスクを削除
+            if guild_id in active_status_tasks:
+                del active_status_tasks[guild_id]
+
+    # タスクを開始して保存
+    active_status_tasks[guild_id] = asyncio.create_task(update_status())
+
+
+@bot.command()
+async def perf(ctx):
+    """区間ごとの処理時間を表示（全体とこのサーバー）"""
+    await ctx.send(
+        "**全体** (秒)\n"
+        f"```\n{metrics.report()}\n```\n"
+        "**このサーバー** (秒)\n"
+        f"```\n{metrics.report(ctx.guild.id)}\n```"
+    )
+
+
+# =====================
+# TTS scheduler
+# =====================
+def synthesize(
+    text: str,
+    guild_id: int,
+    user_id: int,
+    speaker_wav: str | None = None,
+    conds_path: str | None = None,
+    low_priority: bool = False,
+    params: tuple = (),
+    language: str = "ja",
+) -> asyncio.Future:
+    """合成リクエストをスケジューラーに登録し、PCMを返すfutureを返す"""
+    return scheduler.submit(SynthesisRequest(
+        text=text,
+        speaker_wav=speaker_wav or SPEAKER_WAV,
+        conds_path=conds_path if speaker_wav else None,
+        language=language,
+        guild_id=guild_id,
+        user_id=user_id,
+        low_priority=low_priority,
+        params=params,
+    ))
+
+# =====================
+# Message handler
+# =====================
+@bot.event
+async def on_message(message: discord.Message):
+    if message.author.bot:
+        return
+
+    await bot.process_commands(message)
+
+    if (
+        not message.guild
+        or not message.guild.voice_client
+        or not message.guild.voice_client.is_connected()
+        or message.content.startswith("!")
+        or not message.content.strip()
+        or tts_state == "error"
+        or shutdown_event.is_set()
+    ):
+        return
+
+    # モデルの読み込み中はスケジューラーで待たせ、リアクションで知らせる
+    if not scheduler.ready:
+        try:
+            await message.add_reaction("⏳")
+        except discord.HTTPException:
+            pass
+
+    text = message.content.strip()
+    guild_id = message.guild.id
+    user_id = message.author.id
+
+    # ユーザーの話者設定を取得
+    lookup_start = time.perf_counter()
+    user_speaker = db.get_user_speaker(user_id)
+    speaker_wav = speaker_reference(user_speaker) if user_speaker else None
+    conds_path = user_speaker["conds_path"] if user_speaker else None
+    metrics.record("speaker_lookup", time.perf_counter() - lookup_start, guild_id)
+
+    # 読み上げ用に正規化（メンション・URL・絵文字・Markdown・辞書）
+    names = {m.id: m.display_name for m in message.mentions}
+    names.update({r.id: r.name for r in message.role_mentions})
+    names.update({c.id: c.name for c in message.channel_mentions})
+    text = normalizer.normalize(text, guild_id, names)
+    if not text:
+        return
+
+    # サーバーの設定（"auto" なら文字の種類）で読み上げる言語を決める
+    language = db.get_guild_language(guild_id) or TTS_LANGUAGE
+    if language == AUTO_LANGUAGE:
+        language = detect_language(text)
+
+    # 負荷が高いときは品質の段階を下げる（文を短く切り、生成パラメータを軽くする）
+    tier = governor.update(scheduler.pending) if governor else None
+    chunk_max_chars = (tier and tier.chunk_max_chars) or TTS_CHUNK_MAX_CHARS
+
+    # 文単位に分割し、上限を超える分は文の区切りで切って「以下略」を付ける
+    chunks = split_sentences(text, min(TTS_CHUNK_MIN_CHARS, chunk_max_chars), chunk_max_chars)
+    chunks, _ = length_policy.truncate(chunks, guild_id)
+    if not chunks:
+        return
+
+    # 長文は常に文単位で生成し、他のメッセージより後回しにする（先頭の文は通常の優先度）
+    is_long = length_policy.is_long(chunks)
+    if not TTS_STREAMING and not is_long:
+        chunks = ["".join(chunks)]
+
+    # 再生時には古くなりすぎているメッセージは合成しない
+    queue = get_or_create_queue(guild_id)
+    if queue.would_be_stale():
+        return
+
+    # キューにアイテムを追加（TTS完了前に予約）
+    items = [
+        AudioItem(
+            ready=asyncio.Event(),
+            text=chunk,
+            message_id=message.id,
+            user_id=user_id,
+            first_chunk=index == 0,
+        )
+        for index, chunk in enumerate(chunks)
+    ]
+    queue.put_message(items)
+
+    # TTS処理をバックグラウンドで実行（全チャンクを登録し、完了した順に再生可能にする）
+    async def process_tts(item: AudioItem):
+        try:
+            item.pcm = await item.future
+            item.ready_at = time.monotonic()
+        except asyncio.CancelledError:
+            pass  # !skip / !clear やキューからの破棄
+        except Exception as e:
+            print(f"TTS Error: {e}")
+        finally:
+            item.ready.set()  # エラーでも再生ワーカーを進める
+
+    for index, item in enumerate(items):
+        try:
+            item.future = synthesize(
+                item.text, guild_id, user_id, speaker_wav, conds_path,
+                low_priority=is_long and index > 0,
+                params=tier.params if tier else (),
+                language=language,
+            )
+        except QueueFullError as e:
+            # 上限を超えた分は読み上げない
+            print(f"TTS queue full: {e}")
+            item.ready.set()
+            continue
+        start_background_task(process_tts(item))
+
+
+def run():
+    bot.run(TOKEN)
@@ -0,0 +1,158 @@
+import hashlib
+import os
+import threading
+import unicodedata
+from collections import OrderedDict
+
+
+def normalize_cache_text(text: str) -> str:
+    """キャッシュキー用にテキストを正規化（全角/半角・大文字小文字・空白の揺れを吸収）"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    return " ".join(text.split())
+
+
+class RenderedAudioCache:
+    """生成済み音声のLRUキャッシュ（バイト数で上限管理）
+
+    キーは (正規化テキスト, 話者, 言語, 生成パラメータ, 音声の形式) のハッシュ。
+    max_text_length 以下の短いメッセージだけを対象にする。
+    disk_dir を指定すると、メモリから追い出された音声もディスクから読み込める。
+    ディスク操作はブロッキングなので、イベントループからはスレッド経由で呼ぶこと。
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = 64 * 1024 * 1024,
+        max_text_length: int = 20,
+        disk_dir: str | None = None,
+        max_disk_bytes: int = 512 * 1024 * 1024,
+        audio_format: str = "pcm",
+    ):
+        self.max_bytes = max_bytes
+        self.max_text_length = max_text_length
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        # 保存する音声の形式（"pcm" / "opus"）。キーとファイルの拡張子に含め、形式を変えても混ざらないようにする
+        self.audio_format = audio_format
+        self._entries: OrderedDict[str, bytes] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._disk_size = 0
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._disk_size = sum(size for _, size, _ in self._scan_disk())
+
+    def make_key(
+        self,
+        text: str,
+        speaker: str | None,
+        language: str,
+        params: tuple = (),
+    ) -> str | None:
+        """キャッシュキーを作成（対象外のテキストなら None）"""
+        normalized = normalize_cache_text(text)
+        if not normalized or len(normalized) > self.max_text_length:
+            return None
+        parts = [normalized, speaker or "", language, repr(params)]
+        if self.audio_format != "pcm":
+            parts.append(self.audio_format)
+        raw = "\0".join(parts)
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.{self.audio_format}")
+
+    def _remember(self, key: str, data: bytes):
+        with self._lock:
+            if key in self._entries:
+                self._size -= len(self._entries.pop(key))
+            self._entries[key] = data
+            self._size += len(data)
+            while self._size > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.disk_hits + self.misses
+        return (self.hits + self.disk_hits) / total if total else 0.0
+
+    def get(self, key: str) -> bytes | None:
+        """メモリから取得（ディスク層が無い場合はここでミスを数える）"""
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return data
+            if not self.disk_dir:
+                self.misses += 1
+        return None
+
+    def put(self, key: str, data: bytes):
+        """メモリに登録"""
+        if len(data) > self.max_bytes:
+            return
+        self._remember(key, data)
+
+    def load_from_disk(self, key: str) -> bytes | None:
+        """ディスクから取得してメモリに載せる（ブロッキングI/O）"""
+        try:
+            with open(self._disk_path(key), "rb") as f:
+                data = f.read()
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        self.put(key, data)
+        with self._lock:
+            self.disk_hits += 1
+        return data
+
+    def save_to_disk(self, key: str, data: bytes):
+        """ディスクに保存し、上限を超えたら古いものから削除（ブロッキングI/O）"""
+        try:
+            with open(self._disk_path(key), "wb") as f:
+                f.write(data)
+        except OSError as e:
+            print(f"Audio cache write error: {e}")
+            return
+
+        self._disk_size += len(data)
+        if self._disk_size > self.max_disk_bytes:
+            self._trim_disk()
+
+    def _scan_disk(self) -> list[tuple[float, int, str]]:
+        files = []
+        for entry in os.scandir(self.disk_dir):
+            if entry.is_file() and entry.name.endswith(f".{self.audio_format}"):
+                st = entry.stat()
+                files.append((st.st_atime, st.st_size, entry.path))
+        return files
+
+    def _trim_disk(self):
+        """ディスク上のキャッシュを古い順に削除して上限の8割まで減らす"""
+        files = self._scan_disk()
+        total = sum(size for _, size, _ in files)
+
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes * 0.8:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self._disk_size = total
+
+    @property
+    def size_bytes(self) -> int:
+        return self._size
+
+    def __len__(self) -> int:
+        return len(self._entries)
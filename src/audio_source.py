@@ -0,0 +1,245 @@
+import asyncio
+import struct
+import threading
+from collections import deque
+
+import discord
+import numpy as np
+
+# Discordの音声フォーマット（48kHz / ステレオ / s16le / 20msフレーム）
+DISCORD_SAMPLE_RATE = 48000
+DISCORD_CHANNELS = 2
+FRAME_SAMPLES = DISCORD_SAMPLE_RATE * 20 // 1000
+FRAME_SIZE = FRAME_SAMPLES * DISCORD_CHANNELS * 2
+SILENCE_FRAME = bytes(FRAME_SIZE)
+
+# Opusパケット列のまとめ方: マジック + パケット数(uint32) + [長さ(uint16) + パケット] の繰り返し
+OPUS_MAGIC = b"KVO1"
+OPUS_SILENCE = discord.opus.OPUS_SILENCE
+
+
+def to_discord_pcm(wav: np.ndarray, sr: int) -> bytes:
+    """モノラルのfloat波形をDiscord用のPCM（48kHzステレオs16le）に変換
+
+    48kHz以外の入力は線形補間でリサンプルする。長さは20msフレーム単位に無音で揃える。
+    """
+    wav = np.asarray(wav, dtype=np.float32).reshape(-1)
+
+    if sr != DISCORD_SAMPLE_RATE and len(wav) > 0:
+        n_out = int(round(len(wav) * DISCORD_SAMPLE_RATE / sr))
+        positions = np.arange(n_out, dtype=np.float64) * (sr / DISCORD_SAMPLE_RATE)
+        wav = np.interp(positions, np.arange(len(wav)), wav).astype(np.float32)
+
+    n_frames = -(-len(wav) // FRAME_SAMPLES)
+    pcm = np.zeros((n_frames * FRAME_SAMPLES, DISCORD_CHANNELS), dtype=np.int16)
+    samples = (wav * 32767).clip(-32768, 32767).astype(np.int16)
+    pcm[:len(samples)] = samples[:, None]
+    return pcm.tobytes()
+
+
+def encode_opus(pcm: bytes, bitrate: int = 64) -> bytes:
+    """Discord用のPCMを20msごとのOpusパケットにエンコードし、1つのバイト列にまとめる
+
+    libopus を使うブロッキング処理なので、合成側（ワーカー・スレッド）で呼ぶ。
+    """
+    encoder = discord.opus.Encoder(bitrate=bitrate)
+    view = memoryview(pcm)
+    parts = []
+    count = 0
+    for start in range(0, len(view) - FRAME_SIZE + 1, FRAME_SIZE):
+        packet = encoder.encode(view[start:start + FRAME_SIZE].tobytes(), FRAME_SAMPLES)
+        parts.append(struct.pack("<H", len(packet)))
+        parts.append(packet)
+        count += 1
+    return OPUS_MAGIC + struct.pack("<I", count) + b"".join(parts)
+
+
+def is_opus_data(data: bytes) -> bool:
+    return data[:len(OPUS_MAGIC)] == OPUS_MAGIC
+
+
+def opus_packets(data: bytes) -> list[memoryview]:
+    """encode_opus でまとめたバイト列をパケットごとのスライスに分ける（コピーしない）"""
+    if not is_opus_data(data):
+        raise ValueError("Opusパケット列ではありません")
+    view = memoryview(data)
+    (count,) = struct.unpack_from("<I", data, len(OPUS_MAGIC))
+    pos = len(OPUS_MAGIC) + 4
+    packets = []
+    for _ in range(count):
+        (size,) = struct.unpack_from("<H", data, pos)
+        packets.append(view[pos + 2:pos + 2 + size])
+        pos += 2 + size
+    return packets
+
+
+def audio_seconds(data: bytes) -> float:
+    """PCMまたはOpusパケット列の再生時間（秒）"""
+    if is_opus_data(data):
+        (count,) = struct.unpack_from("<I", data, len(OPUS_MAGIC))
+        return count / 50
+    return len(data) / (FRAME_SIZE * 50)
+
+
+class StreamHandle:
+    """ストリームに追加した1件の再生状況（イベントループ側で待つ）"""
+
+    def __init__(self):
+        self.started = asyncio.Event()
+        self.finished = asyncio.Event()
+        self.played = False  # 最後まで再生されたか（スキップ・破棄なら False）
+
+
+class _Segment:
+    __slots__ = ("frames", "pos", "message_id", "handle")
+
+    def __init__(self, frames: list, message_id: int | None = None, handle: StreamHandle | None = None):
+        self.frames = frames
+        self.pos = 0
+        self.message_id = message_id
+        self.handle = handle
+
+
+class GuildAudioStream(discord.AudioSource):
+    """ギルドごとに1つ、再生し続けるAudioSource
+
+    合成済みの音声は append() でセグメントの列に追加し、プレイヤーのスレッドが20msずつ読み出す。
+    メッセージごとに vc.play() し直さないので、項目の間にプレイヤーの起動待ちが入らない。
+
+    - 別のメッセージとの間には gap_ms の無音を入れる（待機中に流れた無音の分は差し引く）
+    - 同じメッセージのチャンク同士は crossfade_ms だけ重ねてつなぐ（0なら無効。Opusでは使えない）
+    - 再生するものが無い間は無音フレームを返し、idle_timeout 秒続いたら終了する（0なら終了しない。終了後は次の追加で作り直す）
+    - opus=True なら encode_opus 済みのパケットをそのまま返し、プレイヤーでのエンコードを省く
+    """
+
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        gap_ms: float = 150,
+        crossfade_ms: float = 0,
+        idle_timeout: float = 30.0,
+        opus: bool = False,
+    ):
+        self.loop = loop
+        self.opus = opus
+        self.gap_frames = int(gap_ms // 20)
+        self.crossfade_frames = 0 if opus else int(crossfade_ms // 20)
+        self.idle_timeout_frames = int(idle_timeout * 50)
+        self.silence = memoryview(OPUS_SILENCE if opus else SILENCE_FRAME)
+        self.closed = False
+        self._segments: deque[_Segment] = deque()
+        self._lock = threading.Lock()
+        # 直前の音声から流れた無音のフレーム数（最初は無音を挟まない）
+        self._idle_frames = self.gap_frames
+        self._last_message_id: int | None = None
+
+    def _notify(self, event: asyncio.Event):
+        try:
+            self.loop.call_soon_threadsafe(event.set)
+        except RuntimeError:
+            pass  # イベントループの終了後
+
+    def _finish(self, segment: _Segment, played: bool):
+        if segment.handle:
+            segment.handle.played = played
+            self._notify(segment.handle.started)
+            self._notify(segment.handle.finished)
+
+    def _split_frames(self, data: bytes) -> list[memoryview]:
+        if self.opus:
+            return opus_packets(data)
+        view = memoryview(data)
+        return [view[i:i + FRAME_SIZE] for i in range(0, len(view) - FRAME_SIZE + 1, FRAME_SIZE)]
+
+    @property
+    def buffered_seconds(self) -> float:
+        """まだ読み出されていない音声の長さ（秒）"""
+        with self._lock:
+            remaining = sum(len(seg.frames) - seg.pos for seg in self._segments)
+        return remaining / 50
+
+    def append(self, data: bytes, message_id: int = 0) -> StreamHandle | None:
+        """音声（PCMまたはOpusパケット列）を末尾に追加する（終了済みのストリームなら None）"""
+        frames = self._split_frames(data)
+        handle = StreamHandle()
+        with self._lock:
+            if self.closed:
+                return None
+
+            prev = next((seg for seg in reversed(self._segments) if seg.handle), None)
+            if prev is not None and prev.message_id == message_id and self.crossfade_frames:
+                self._crossfade(prev, frames)
+            elif message_id != self._last_message_id and self.gap_frames:
+                if prev is not None:
+                    gap = self.gap_frames
+                else:
+                    gap = max(0, self.gap_frames - self._idle_frames)
+                if gap:
+                    self._segments.append(_Segment([self.silence] * gap))
+
+            self._segments.append(_Segment(frames, message_id, handle))
+            self._last_message_id = message_id
+        return handle
+
+    def _crossfade(self, prev: _Segment, frames: list[memoryview]):
+        """prev の未再生の末尾と frames の先頭を重ね、prev を重ねた分だけ短くする（PCMのみ）"""
+        overlap = min(self.crossfade_frames, len(prev.frames) - prev.pos, len(frames))
+        if overlap <= 0:
+            return
+
+        tail = np.frombuffer(b"".join(prev.frames[-overlap:]), dtype=np.int16).reshape(-1, DISCORD_CHANNELS)
+        head = np.frombuffer(b"".join(frames[:overlap]), dtype=np.int16).reshape(-1, DISCORD_CHANNELS)
+        fade_in = np.linspace(0.0, 1.0, len(head), dtype=np.float32)[:, None]
+        mixed = memoryview((tail * (1.0 - fade_in) + head * fade_in).clip(-32768, 32767).astype(np.int16).tobytes())
+
+        del prev.frames[-overlap:]
+        frames[:overlap] = [mixed[i:i + FRAME_SIZE] for i in range(0, len(mixed), FRAME_SIZE)]
+
+    def skip(self, message_id: int) -> int:
+        """メッセージの再生中・未再生のセグメントを破棄"""
+        return self._drop(lambda seg: seg.message_id == message_id)
+
+    def clear(self) -> int:
+        """すべてのセグメントを破棄"""
+        return self._drop(lambda seg: True)
+
+    def _drop(self, predicate) -> int:
+        with self._lock:
+            dropped = [seg for seg in self._segments if predicate(seg)]
+            self._segments = deque(seg for seg in self._segments if not predicate(seg))
+        for seg in dropped:
+            self._finish(seg, played=False)
+        return sum(1 for seg in dropped if seg.handle)
+
+    def read(self) -> bytes:
+        with self._lock:
+            while self._segments:
+                seg = self._segments[0]
+                if seg.pos >= len(seg.frames):
+                    self._segments.popleft()
+                    self._finish(seg, played=True)
+                    continue
+                if seg.pos == 0 and seg.handle:
+                    self._notify(seg.handle.started)
+                frame = seg.frames[seg.pos].tobytes()
+                seg.pos += 1
+                self._idle_frames = 0
+                return frame
+
+            # 再生するものが無い間は無音を流してプレイヤーを止めない
+            self._idle_frames += 1
+            if self.idle_timeout_frames and self._idle_frames > self.idle_timeout_frames:
+                self.closed = True
+                return b""
+            return self.silence.tobytes()
+
+    def is_opus(self) -> bool:
+        return self.opus
+
+    def cleanup(self):
+        """プレイヤーの停止（切断など）時に、残りのセグメントを待っている側を解放する"""
+        with self._lock:
+            self.closed = True
+            dropped, self._segments = self._segments, deque()
+        for seg in dropped:
+            self._finish(seg, played=False)
@@ -0,0 +1,458 @@
+"""読み上げパイプラインのオフラインベンチマーク
+
+チャットを模したメッセージを複数ギルドからバースト的に投稿し、
+シンセサイザー単体と スケジューラー → 再生キュー → スタブのボイスクライアント
+までを通して計測する。結果はJSONで出力するので、実行ごとに差分を取れる。
+
+    python src/benchmark.py --model fake --output bench.json
+    python src/benchmark.py --model chatterbox --guilds 2 --bursts 1
+
+--model には fake / chatterbox / "モジュール:クラス" を指定できる。
+fake はGPUもモデルも不要なので、CPUのみのCI環境でも実行できる。
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import time
+from typing import Callable
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BASE_DIR)
+
+from audio_source import GuildAudioStream, audio_seconds
+from fake_synth import FakeSynthesizer
+from governor import LoadGovernor
+from length_policy import LengthPolicy
+from metrics import LatencyHistogram, PipelineMetrics
+from playback import AudioItem, PlaybackQueue
+from scheduler import InProcessBackend, QueueFullError, SynthesisRequest, SynthesisScheduler
+from text_utils import split_sentences
+
+# 実際のチャットに近い長さ・表記揺れのメッセージ
+DEFAULT_CORPUS = [
+    "おはよう",
+    "草",
+    "www",
+    "それな",
+    "了解です！",
+    "おつかれさまでした",
+    "今日の夜ってみんな空いてる？",
+    "ちょっと待って、今トイレ行ってくる",
+    "このボス強すぎない？さっきから全然勝てないんだけど",
+    "明日の集合は駅前に10時でお願いします。遅れる人は連絡してね！",
+    "さっきのURL開けなかったんだけど、もう一回貼ってもらえる？",
+    "昨日買ったゲーム、思ってたより面白くて気づいたら朝の4時になってた。"
+    "今日の仕事は眠すぎてほとんど記憶がない。",
+    "まず最初に装備を整えて、次にレベルを上げてから二つ目のダンジョンに行くのがおすすめです。"
+    "回復アイテムは多めに持っていった方がいいですよ。ボスの第二形態は全体攻撃が痛いので、"
+    "防御バフを切らさないようにしてください。",
+    "ラーメン食べたい",
+    "それ前にも言ってたよね？",
+    "ＯＫ！",
+    "ちなみに来週の火曜日はメンテナンスがあるらしいので、イベントの周回は月曜までに終わらせておきましょう。",
+]
+
+
+def percentiles(values: list[float]) -> dict:
+    """p50/p95/p99・平均・最大をまとめる"""
+    if not values:
+        return {"count": 0}
+    hist = LatencyHistogram(max_samples=len(values))
+    for value in values:
+        hist.add(value)
+    return {
+        "count": hist.count,
+        "mean": round(hist.total / hist.count, 6),
+        "p50": round(hist.percentile(50), 6),
+        "p95": round(hist.percentile(95), 6),
+        "p99": round(hist.percentile(99), 6),
+        "max": round(max(values), 6),
+    }
+
+
+def load_synthesizer(spec: str, args: argparse.Namespace):
+    """--model の指定からシンセサイザーを作成"""
+    if spec == "fake":
+        return FakeSynthesizer(rtf=args.fake_rtf, seed=args.seed, opus_bitrate=args.opus_bitrate)
+    if spec == "chatterbox":
+        from tts import ChatterboxVoiceSynthesizer
+        return ChatterboxVoiceSynthesizer(
+            device=args.device,
+            compile_model=args.compile,
+            quantize=args.quantize,
+            num_threads=args.num_threads,
+            interop_threads=args.interop_threads,
+            opus_bitrate=args.opus_bitrate,
+        )
+
+    module_name, _, class_name = spec.partition(":")
+    if not class_name:
+        raise SystemExit(f"--model は fake / chatterbox / モジュール:クラス のいずれか: {spec}")
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+# =====================
+# Stub voice client
+# =====================
+class StubVoiceClient:
+    """discord.VoiceClient の代わりにPCMを読み捨てるクライアント
+
+    speed 倍速で20msフレームを読み出す（0なら待たずに読み切る）。
+    ソースが空（b""）を返すまで読み続けるので、GuildAudioStream は無音が続いて終了するまで再生中になる。
+    """
+
+    def __init__(self, speed: float = 1.0):
+        self.speed = speed
+        self.frames = 0
+        self._task: asyncio.Task | None = None
+
+    def is_playing(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def play(self, source, after: Callable | None = None):
+        async def run():
+            error = None
+            try:
+                # 1秒分ずつ読み出し、その再生時間だけ待つ
+                while True:
+                    count = 0
+                    while count < 50 and source.read():
+                        count += 1
+                    self.frames += count
+                    if self.speed > 0 and count:
+                        await asyncio.sleep(count * 0.02 / self.speed)
+                    else:
+                        await asyncio.sleep(0)
+                    if count < 50:
+                        break
+            except Exception as e:
+                error = e
+            finally:
+                source.cleanup()
+                if after:
+                    after(error)
+
+        self._task = asyncio.create_task(run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+
+
+# =====================
+# Benchmarks
+# =====================
+def bench_synthesis(synth, corpus: list[str], repeats: int) -> dict:
+    """シンセサイザー単体のRTF（生成時間 / 音声の長さ）"""
+    rtfs, latencies, audio_total, wall_start = [], [], 0.0, time.perf_counter()
+    for _ in range(repeats):
+        for text in corpus:
+            start = time.perf_counter()
+            pcm = synth.synthesize_pcm(text, None, "ja", None)
+            elapsed = time.perf_counter() - start
+            seconds = audio_seconds(pcm)
+            audio_total += seconds
+            latencies.append(elapsed)
+            if seconds > 0:
+                rtfs.append(elapsed / seconds)
+    wall = time.perf_counter() - wall_start
+    return {
+        "utterances": len(latencies),
+        "audio_seconds": round(audio_total, 3),
+        "wall_seconds": round(wall, 3),
+        "rtf": percentiles(rtfs),
+        "latency": percentiles(latencies),
+    }
+
+
+async def bench_pipeline(synth, corpus: list[str], args: argparse.Namespace) -> dict:
+    """複数ギルドのバースト投稿をスケジューラーと再生キューに流す"""
+    rng = random.Random(args.seed)
+    metrics = PipelineMetrics(max_samples=100_000)
+    governor = LoadGovernor(high_pending=args.governor_high_pending) if args.governor else None
+    scheduler = SynthesisScheduler(
+        InProcessBackend(synth),
+        batch_window=args.batch_window_ms / 1000,
+        max_batch_size=args.max_batch_size,
+        metrics=metrics,
+        governor=governor,
+    )
+    scheduler.start()
+
+    queues: dict[int, PlaybackQueue] = {}
+    clients: dict[int, StubVoiceClient] = {}
+    streams: dict[int, GuildAudioStream] = {}
+    tracking: set[asyncio.Task] = set()
+    rtfs: list[float] = []
+    ttfa: list[float] = []
+    counts = {"messages": 0, "chunks": 0, "played": 0, "failed": 0, "rejected": 0, "truncated": 0}
+    length_policy = LengthPolicy(max_tokens=args.max_message_tokens, long_tokens=args.long_message_tokens)
+    audio_total = 0.0
+
+    def get_stream(guild_id: int) -> GuildAudioStream:
+        """app.py の get_audio_stream と同じく、終了済みならストリームを作り直す"""
+        stream, vc = streams.get(guild_id), clients[guild_id]
+        if stream is None or stream.closed or not vc.is_playing():
+            vc.stop()
+            stream = GuildAudioStream(
+                asyncio.get_running_loop(),
+                gap_ms=args.gap_ms,
+                crossfade_ms=args.crossfade_ms,
+                opus=args.opus_bitrate > 0,
+            )
+            streams[guild_id] = stream
+            vc.play(stream)
+        return stream
+
+    async def track_playback(guild_id: int, queue: PlaybackQueue, item: AudioItem, handle):
+        try:
+            await handle.started.wait()
+            if handle.finished.is_set() and not handle.played:
+                return
+            started_at = time.monotonic()
+            queue.current = item
+            if item.ready_at is not None:
+                metrics.record("playback_delay", started_at - item.ready_at, guild_id)
+            if item.first_chunk:
+                ttfa.append(started_at - item.created_at)
+                metrics.record("time_to_first_audio", started_at - item.created_at, guild_id)
+            await handle.finished.wait()
+            if handle.played:
+                metrics.record("playback", time.monotonic() - started_at, guild_id)
+                counts["played"] += 1
+        finally:
+            if queue.current is item:
+                queue.current = None
+
+    async def playback_worker(guild_id: int):
+        """app.py の playback_worker と同じ流れでスタブに再生させる"""
+        queue = queues[guild_id]
+        while True:
+            item = await queue.get()
+            try:
+                queue.preparing = item
+                await item.ready.wait()
+                if item.pcm is None:
+                    continue
+                handle = get_stream(guild_id).append(item.pcm, item.message_id)
+                if handle is None:
+                    handle = get_stream(guild_id).append(item.pcm, item.message_id)
+                task = asyncio.create_task(track_playback(guild_id, queue, item, handle))
+                tracking.add(task)
+                task.add_done_callback(tracking.discard)
+                await handle.started.wait()
+            finally:
+                queue.preparing = None
+                item.pcm = None
+
+    async def process_tts(item: AudioItem, request: SynthesisRequest):
+        nonlocal audio_total
+        try:
+            item.pcm = await item.future
+            item.ready_at = time.monotonic()
+            seconds = audio_seconds(item.pcm)
+            audio_total += seconds
+            if seconds > 0 and "synthesis" in request.timings:
+                rtfs.append(request.timings["synthesis"] / seconds)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            counts["failed"] += 1
+            print(f"TTS Error: {e}", file=sys.stderr)
+        finally:
+            item.ready.set()
+
+    def post(guild_id: int, user_id: int, message_id: int, text: str):
+        """app.py の on_message と同じ流れでキューに積む"""
+        queue = queues[guild_id]
+        counts["messages"] += 1
+        if queue.would_be_stale():
+            return
+        # app.py と同じく、負荷が高いときは品質の段階を下げる
+        tier = governor.update(scheduler.pending) if governor else None
+        chunk_max_chars = (tier and tier.chunk_max_chars) or args.chunk_max_chars
+        chunks = split_sentences(text, min(args.chunk_min_chars, chunk_max_chars), chunk_max_chars)
+        chunks, truncated = length_policy.truncate(chunks, guild_id)
+        counts["truncated"] += truncated
+        is_long = length_policy.is_long(chunks)
+        items = [
+            AudioItem(
+                ready=asyncio.Event(),
+                text=chunk,
+                message_id=message_id,
+                user_id=user_id,
+                first_chunk=index == 0,
+            )
+            for index, chunk in enumerate(chunks)
+        ]
+        queue.put_message(items)
+        for index, item in enumerate(items):
+            request = SynthesisRequest(
+                text=item.text,
+                guild_id=guild_id,
+                user_id=user_id,
+                low_priority=is_long and index > 0,
+                params=tier.params if tier else (),
+            )
+            try:
+                item.future = scheduler.submit(request)
+            except QueueFullError:
+                counts["rejected"] += 1
+                item.ready.set()
+                continue
+            counts["chunks"] += 1
+            asyncio.create_task(process_tts(item, request))
+
+    async def guild_traffic(guild_id: int):
+        """バースト（短い間隔の連投）と待機を繰り返す"""
+        message_ids = iter(range(guild_id * 1_000_000, (guild_id + 1) * 1_000_000))
+        for _ in range(args.bursts):
+            for _ in range(rng.randint(1, args.burst_size)):
+                user_id = guild_id * 100 + rng.randrange(args.users_per_guild)
+                post(guild_id, user_id, next(message_ids), rng.choice(corpus))
+                await asyncio.sleep(rng.expovariate(1 / args.message_gap))
+            await asyncio.sleep(rng.uniform(0, args.burst_idle))
+
+    for guild_id in range(1, args.guilds + 1):
+        queues[guild_id] = PlaybackQueue(max_items=args.playback_max_items, max_age=args.playback_max_age)
+        clients[guild_id] = StubVoiceClient(args.playback_speed)
+
+    wall_start = time.perf_counter()
+    workers = [asyncio.create_task(playback_worker(g)) for g in queues]
+    await asyncio.gather(*(guild_traffic(g) for g in queues))
+
+    # 全ギルドの再生が終わるまで待つ
+    while any(len(q) or q.current or q.preparing for q in queues.values()) or scheduler.pending or tracking:
+        await asyncio.sleep(0.05)
+    wall = time.perf_counter() - wall_start
+
+    for vc in clients.values():
+        vc.stop()
+
+    for task in workers:
+        task.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    await scheduler.stop()
+
+    stages = {
+        stage: {key: round(value, 6) for key, value in values.items()}
+        for stage, values in metrics.summary().items()
+    }
+
+    return {
+        **counts,
+        "dropped": sum(q.dropped for q in queues.values()),
+        "quality_tier_changes": governor.changes if governor else 0,
+        "audio_seconds": round(audio_total, 3),
+        "wall_seconds": round(wall, 3),
+        "throughput": {
+            "chunks_per_second": round(counts["chunks"] / wall, 3) if wall else 0.0,
+            "audio_seconds_per_second": round(audio_total / wall, 3) if wall else 0.0,
+        },
+        "rtf": percentiles(rtfs),
+        "time_to_first_audio": percentiles(ttfa),
+        "stages": stages,
+    }
+
+
+def peak_memory() -> dict:
+    """プロセスの最大常駐メモリ（とGPUの最大確保量）"""
+    result = {"max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
+        result["cuda_max_allocated_mb"] = round(torch.cuda.max_memory_allocated() / 1024**2, 1)
+    return result
+
+
+def load_corpus(path: str | None) -> list[str]:
+    """1行1メッセージのコーパスを読み込む（未指定なら組み込みのもの）"""
+    if not path:
+        return DEFAULT_CORPUS
+    with open(path, encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="kero-voice の合成・再生パイプラインのベンチマーク")
+    parser.add_argument("--model", default="fake", help="fake / chatterbox / モジュール:クラス")
+    parser.add_argument("--device", default=None, help="chatterbox のデバイス（cuda / cpu）")
+    parser.add_argument("--compile", action="store_true", help="chatterbox のサブモジュールを torch.compile")
+    parser.add_argument("--quantize", action="store_true", help="chatterbox のT3をint8に量子化（CPUのみ）")
+    parser.add_argument("--num-threads", type=int, default=0, help="PyTorchの演算スレッド数（0でデフォルト）")
+    parser.add_argument("--interop-threads", type=int, default=0, help="PyTorchのinter-opスレッド数")
+    parser.add_argument("--no-warmup", action="store_true", help="計測前のウォームアップを行わない")
+    parser.add_argument("--fake-rtf", type=float, default=0.3, help="fake モデルのRTF")
+    parser.add_argument("--opus-bitrate", type=int, default=0, help="合成側でOpusにエンコードするビットレート（kbps、0ならPCM）")
+    parser.add_argument("--corpus", default=None, help="1行1メッセージのテキストファイル")
+    parser.add_argument("--skip-synthesis", action="store_true", help="シンセサイザー単体の計測を省略")
+    parser.add_argument("--skip-pipeline", action="store_true", help="パイプラインの計測を省略")
+    parser.add_argument("--repeats", type=int, default=1, help="単体計測でコーパスを繰り返す回数")
+    parser.add_argument("--guilds", type=int, default=3)
+    parser.add_argument("--users-per-guild", type=int, default=4)
+    parser.add_argument("--bursts", type=int, default=3, help="ギルドごとのバースト回数")
+    parser.add_argument("--burst-size", type=int, default=6, help="1バーストの最大メッセージ数")
+    parser.add_argument("--message-gap", type=float, default=0.3, help="バースト内の平均投稿間隔（秒）")
+    parser.add_argument("--burst-idle", type=float, default=2.0, help="バースト間の最大待機（秒）")
+    parser.add_argument("--playback-speed", type=float, default=20.0, help="再生速度の倍率（0で待たない）")
+    parser.add_argument("--batch-window-ms", type=int, default=0)
+    parser.add_argument("--max-batch-size", type=int, default=4)
+    parser.add_argument("--chunk-min-chars", type=int, default=10)
+    parser.add_argument("--chunk-max-chars", type=int, default=80)
+    parser.add_argument("--max-message-tokens", type=int, default=1500)
+    parser.add_argument("--long-message-tokens", type=int, default=300)
+    parser.add_argument("--playback-max-items", type=int, default=30)
+    parser.add_argument("--playback-max-age", type=float, default=60.0)
+    parser.add_argument("--gap-ms", type=float, default=150.0, help="メッセージ間の無音（ミリ秒）")
+    parser.add_argument("--crossfade-ms", type=float, default=0.0, help="同じメッセージのチャンク間のクロスフェード（ミリ秒）")
+    parser.add_argument("--governor", action="store_true", help="負荷に応じて品質の段階を下げる（app.py の TTS_GOVERNOR）")
+    parser.add_argument("--governor-high-pending", type=int, default=8, help="品質を1段下げる待機リクエスト数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="結果のJSONを書き出すファイル（未指定なら標準出力）")
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None):
+    args = parse_args(argv)
+    corpus = load_corpus(args.corpus)
+
+    load_start = time.perf_counter()
+    synth = load_synthesizer(args.model, args)
+    load_seconds = time.perf_counter() - load_start
+
+    results = {
+        "config": vars(args),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "model_load_seconds": round(load_seconds, 3),
+    }
+    if not args.no_warmup and hasattr(synth, "warmup"):
+        print("Warming up...", file=sys.stderr)
+        results["warmup_seconds"] = round(synth.warmup(), 3)
+    if not args.skip_synthesis:
+        print("Running synthesis benchmark...", file=sys.stderr)
+        results["synthesis"] = bench_synthesis(synth, corpus, args.repeats)
+    if not args.skip_pipeline:
+        print("Running pipeline benchmark...", file=sys.stderr)
+        results["pipeline"] = asyncio.run(bench_pipeline(synth, corpus, args))
+    results["memory"] = peak_memory()
+
+    output = json.dumps(results, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+        print(f"Results written to {args.output}", file=sys.stderr)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,54 @@
 import sqlite3
+import threading
 from contextlib import contextmanager
 
 
 class Database:
+    """話者設定のデータベース
+
+    コネクションは1本を使い回し、speakers と user_speakers はメモリにも保持する。
+    読み取り系のメソッドはディスクI/Oを行わない。
+    書き込み系のメソッドは、コミットが成功してからメモリキャッシュを更新する。
+    """
+
     def __init__(self, db_path: str = "kero_voice.db"):
         self.db_path = db_path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(
+            self.db_path,
+            check_same_thread=False,
+            cached_statements=256,
+        )
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+
+        # メモリキャッシュ
+        self._speakers: dict[int, dict] = {}
+        self._speaker_ids_by_name: dict[str, int] = {}
+        self._user_speakers: dict[int, int] = {}
+        self._dictionaries: dict[int, dict[str, str]] = {}
+        self._guild_languages: dict[int, str] = {}
+
         self._init_db()
+        self._load_cache()
+        self._data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
 
     @contextmanager
     def _get_connection(self):
         """コネクションのコンテキストマネージャー"""
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        try:
-            yield conn
-            conn.commit()
-        except Exception:
-            conn.rollback()
-            raise
-        finally:
-            conn.close()
+        with self._lock:
+            try:
+                yield self._conn
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+
+    def close(self):
+        """コネクションを閉じる"""
+        with self._lock:
+            self._conn.close()
 
     def _init_db(self):
         """データベースの初期化"""
@@ -32,10 +61,39 @@ class Database:
                 CREATE TABLE IF NOT EXISTS speakers (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     name TEXT NOT NULL UNIQUE,
-                    filepath TEXT NOT NULL
+                    filepath TEXT NOT NULL,
+                    conds_path TEXT
+                )
+            """)
+
+            # 既存DBのマイグレーション（事前計算したコンディショニングのパス）
+            cursor.execute("PRAGMA table_info(speakers)")
+            columns = {row["name"] for row in cursor.fetchall()}
+            if "conds_path" not in columns:
+                cursor.execute("ALTER TABLE speakers ADD COLUMN conds_path TEXT")
+
+            # speaker_clipsテーブル（話者ストア内の参照音声の位置。単位はサンプル）
+            # digest: 音声のハッシュ、generation: 位置が有効な話者ストアの世代
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS speaker_clips (
+                    speaker_id INTEGER PRIMARY KEY,
+                    offset INTEGER NOT NULL,
+                    length INTEGER NOT NULL,
+                    sample_rate INTEGER NOT NULL,
+                    digest TEXT,
+                    generation INTEGER NOT NULL DEFAULT 0,
+                    FOREIGN KEY (speaker_id) REFERENCES speakers(id)
                 )
             """)
 
+            # 既存DBのマイグレーション（ハッシュと世代）
+            cursor.execute("PRAGMA table_info(speaker_clips)")
+            columns = {row["name"] for row in cursor.fetchall()}
+            if "digest" not in columns:
+                cursor.execute("ALTER TABLE speaker_clips ADD COLUMN digest TEXT")
+            if "generation" not in columns:
+                cursor.execute("ALTER TABLE speaker_clips ADD COLUMN generation INTEGER NOT NULL DEFAULT 0")
+
             # user_speakersテーブル（ユーザーと話者の紐付け）
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS user_speakers (
@@ -45,23 +103,74 @@ class Database:
                 )
             """)
 
-    def get_speakers(self) -> list[dict]:
-        """スピーカー一覧を取得"""
+            # dictionaryテーブル（ギルドごとの読み方辞書）
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS dictionary (
+                    guild_id INTEGER NOT NULL,
+                    word TEXT NOT NULL,
+                    reading TEXT NOT NULL,
+                    PRIMARY KEY (guild_id, word)
+                )
+            """)
+
+            # guild_languagesテーブル（ギルドごとの読み上げ言語。"auto" は文字の種類で判定）
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS guild_languages (
+                    guild_id INTEGER PRIMARY KEY,
+                    language TEXT NOT NULL
+                )
+            """)
+
+    def _load_cache(self):
+        """テーブルの内容をメモリに読み込む"""
         with self._get_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT id, name, filepath FROM speakers ORDER BY name")
-            return [dict(row) for row in cursor.fetchall()]
+            cursor.execute("""
+                SELECT s.id, s.name, s.filepath, s.conds_path,
+                       c.offset AS clip_offset, c.length AS clip_length,
+                       c.digest AS clip_digest, c.generation AS clip_generation
+                FROM speakers s LEFT JOIN speaker_clips c ON c.speaker_id = s.id
+            """)
+            for row in cursor.fetchall():
+                self._cache_speaker(dict(row))
+
+            cursor.execute("SELECT user_id, speaker_id FROM user_speakers")
+            self._user_speakers = {row["user_id"]: row["speaker_id"] for row in cursor.fetchall()}
+
+            cursor.execute("SELECT guild_id, word, reading FROM dictionary")
+            for row in cursor.fetchall():
+                self._dictionaries.setdefault(row["guild_id"], {})[row["word"]] = row["reading"]
+
+            cursor.execute("SELECT guild_id, language FROM guild_languages")
+            self._guild_languages = {row["guild_id"]: row["language"] for row in cursor.fetchall()}
+
+    def refresh_if_changed(self) -> bool:
+        """他のプロセス（別シャード）が書き込んでいればメモリキャッシュを読み直す"""
+        with self._lock:
+            version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+            if version == self._data_version:
+                return False
+            self._data_version = version
+            self._speakers = {}
+            self._speaker_ids_by_name = {}
+            self._dictionaries = {}
+            self._load_cache()
+            return True
+
+    def _cache_speaker(self, speaker: dict):
+        self._speakers[speaker["id"]] = speaker
+        self._speaker_ids_by_name[speaker["name"]] = speaker["id"]
+
+    def get_speakers(self) -> list[dict]:
+        """スピーカー一覧を取得"""
+        with self._lock:
+            return [dict(s) for s in sorted(self._speakers.values(), key=lambda s: s["name"])]
 
     def get_speaker_by_id(self, speaker_id: int) -> dict | None:
         """IDでスピーカーを取得"""
-        with self._get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT id, name, filepath FROM speakers WHERE id = ?",
-                (speaker_id,)
-            )
-            row = cursor.fetchone()
-            return dict(row) if row else None
+        with self._lock:
+            speaker = self._speakers.get(speaker_id)
+            return dict(speaker) if speaker else None
 
     def set_user_speaker(self, user_id: int, speaker_id: int) -> bool:
         """ユーザーの話者を設定"""
@@ -69,65 +178,234 @@ class Database:
         if not self.get_speaker_by_id(speaker_id):
             return False
 
-        with self._get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                INSERT INTO user_speakers (user_id, speaker_id)
-                VALUES (?, ?)
-                ON CONFLICT(user_id) DO UPDATE SET speaker_id = ?
-            """, (user_id, speaker_id, speaker_id))
+        with self._lock:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    INSERT INTO user_speakers (user_id, speaker_id)
+                    VALUES (?, ?)
+                    ON CONFLICT(user_id) DO UPDATE SET speaker_id = ?
+                """, (user_id, speaker_id, speaker_id))
+            self._user_speakers[user_id] = speaker_id
 
         return True
 
     def get_user_speaker(self, user_id: int) -> dict | None:
         """ユーザーの話者を取得"""
-        with self._get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT s.id, s.name, s.filepath
-                FROM user_speakers us
-                JOIN speakers s ON us.speaker_id = s.id
-                WHERE us.user_id = ?
-            """, (user_id,))
-            row = cursor.fetchone()
-            return dict(row) if row else None
+        with self._lock:
+            speaker_id = self._user_speakers.get(user_id)
+            if speaker_id is None:
+                return None
+            speaker = self._speakers.get(speaker_id)
+            return dict(speaker) if speaker else None
 
     def remove_user_speaker(self, user_id: int) -> bool:
         """ユーザーの話者設定を削除"""
-        with self._get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM user_speakers WHERE user_id = ?", (user_id,))
+        with self._lock:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("DELETE FROM user_speakers WHERE user_id = ?", (user_id,))
+            self._user_speakers.pop(user_id, None)
             return cursor.rowcount > 0
 
-    def add_speaker(self, name: str, filepath: str) -> int | None:
-        """スピーカーを追加し、IDを返す"""
-        with self._get_connection() as conn:
-            cursor = conn.cursor()
-            try:
+    def add_speaker(
+        self,
+        name: str,
+        filepath: str,
+        conds_path: str | None = None,
+        clip: tuple[int, int, int, str, int] | None = None,
+    ) -> int | None:
+        """スピーカーを追加し、IDを返す
+
+        clip は話者ストア内の (先頭, 長さ, サンプルレート, ハッシュ, 世代)。
+        """
+        with self._lock:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                try:
+                    cursor.execute(
+                        "INSERT INTO speakers (name, filepath, conds_path) VALUES (?, ?, ?)",
+                        (name, filepath, conds_path)
+                    )
+                except sqlite3.IntegrityError:
+                    return None  # 重複
+
+                speaker_id = cursor.lastrowid
+                if clip:
+                    cursor.execute(
+                        """
+                        INSERT INTO speaker_clips (speaker_id, offset, length, sample_rate, digest, generation)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                        """,
+                        (speaker_id, *clip)
+                    )
+            self._cache_speaker({
+                "id": speaker_id,
+                "name": name,
+                "filepath": filepath,
+                "conds_path": conds_path,
+                "clip_offset": clip[0] if clip else None,
+                "clip_length": clip[1] if clip else None,
+                "clip_digest": clip[3] if clip else None,
+                "clip_generation": clip[4] if clip else None,
+            })
+            return speaker_id
+
+    def set_speaker_clip(
+        self,
+        speaker_id: int,
+        clip: tuple[int, int, int, str, int],
+        filepath: str,
+        conds_path: str | None,
+    ):
+        """話者ストアへ移行した話者の位置とファイルパスを保存"""
+        with self._lock:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    INSERT INTO speaker_clips (speaker_id, offset, length, sample_rate, digest, generation)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(speaker_id) DO UPDATE SET
+                        offset = excluded.offset, length = excluded.length, sample_rate = excluded.sample_rate,
+                        digest = excluded.digest, generation = excluded.generation
+                """, (speaker_id, *clip))
                 cursor.execute(
-                    "INSERT INTO speakers (name, filepath) VALUES (?, ?)",
-                    (name, filepath)
+                    "UPDATE speakers SET filepath = ?, conds_path = ? WHERE id = ?",
+                    (filepath, conds_path, speaker_id)
+                )
+            speaker = self._speakers.get(speaker_id)
+            if speaker:
+                speaker.update(
+                    filepath=filepath,
+                    conds_path=conds_path,
+                    clip_offset=clip[0],
+                    clip_length=clip[1],
+                    clip_digest=clip[3],
+                    clip_generation=clip[4],
+                )
+
+    def move_speaker_clips(self, clips: dict[int, tuple[int, int]], generation: int):
+        """話者ストアの詰め直し後の位置と世代を1つのトランザクションで保存"""
+        with self._lock:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.executemany(
+                    "UPDATE speaker_clips SET offset = ?, length = ?, generation = ? WHERE speaker_id = ?",
+                    [(offset, length, generation, speaker_id) for speaker_id, (offset, length) in clips.items()]
                 )
-                return cursor.lastrowid
-            except sqlite3.IntegrityError:
-                return None  # 重複
+            for speaker_id, (offset, length) in clips.items():
+                speaker = self._speakers.get(speaker_id)
+                if speaker:
+                    speaker.update(clip_offset=offset, clip_length=length, clip_generation=generation)
+
+    def set_speaker_clip_digests(self, digests: dict[int, str]):
+        """ハッシュを持たない（以前のバージョンで移行した）話者のハッシュを保存"""
+        with self._lock:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.executemany(
+                    "UPDATE speaker_clips SET digest = ? WHERE speaker_id = ?",
+                    [(digest, speaker_id) for speaker_id, digest in digests.items()]
+                )
+            for speaker_id, digest in digests.items():
+                speaker = self._speakers.get(speaker_id)
+                if speaker:
+                    speaker.update(clip_digest=digest)
+
+    def get_speaker_store_generation(self) -> int | None:
+        """DBに記録された話者ストアの世代（話者ストアに入っている話者がいなければ None）"""
+        with self._lock:
+            generations = [s["clip_generation"] for s in self._speakers.values() if s["clip_offset"] is not None]
+            return max(generations) if generations else None
+
+    def get_speaker_clips(self) -> dict[int, tuple[int, int]]:
+        """話者ストアに入っている話者の {ID: (先頭, 長さ)}"""
+        with self._lock:
+            return {
+                speaker_id: (s["clip_offset"], s["clip_length"])
+                for speaker_id, s in self._speakers.items()
+                if s["clip_offset"] is not None
+            }
 
     def get_speaker_by_name(self, name: str) -> dict | None:
         """名前でスピーカーを取得"""
-        with self._get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT id, name, filepath FROM speakers WHERE name = ?",
-                (name,)
-            )
-            row = cursor.fetchone()
-            return dict(row) if row else None
+        with self._lock:
+            speaker_id = self._speaker_ids_by_name.get(name)
+            return self.get_speaker_by_id(speaker_id) if speaker_id is not None else None
 
     def delete_speaker(self, speaker_id: int) -> bool:
         """スピーカーを削除"""
-        with self._get_connection() as conn:
-            cursor = conn.cursor()
-            # 関連するuser_speakersも削除
-            cursor.execute("DELETE FROM user_speakers WHERE speaker_id = ?", (speaker_id,))
-            cursor.execute("DELETE FROM speakers WHERE id = ?", (speaker_id,))
+        with self._lock:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                # 関連するuser_speakersも削除
+                cursor.execute("DELETE FROM user_speakers WHERE speaker_id = ?", (speaker_id,))
+                cursor.execute("DELETE FROM speaker_clips WHERE speaker_id = ?", (speaker_id,))
+                cursor.execute("DELETE FROM speakers WHERE id = ?", (speaker_id,))
+                deleted = cursor.rowcount > 0
+
+            self._user_speakers = {
+                user_id: sid for user_id, sid in self._user_speakers.items()
+                if sid != speaker_id
+            }
+            speaker = self._speakers.pop(speaker_id, None)
+            if speaker:
+                self._speaker_ids_by_name.pop(speaker["name"], None)
+            return deleted
+
+    def get_dictionaries(self) -> dict[int, dict[str, str]]:
+        """全ギルドの辞書を取得"""
+        with self._lock:
+            return {guild_id: dict(entries) for guild_id, entries in self._dictionaries.items()}
+
+    def get_dictionary(self, guild_id: int) -> dict[str, str]:
+        """ギルドの辞書を取得"""
+        with self._lock:
+            return dict(self._dictionaries.get(guild_id, {}))
+
+    def set_dictionary_word(self, guild_id: int, word: str, reading: str):
+        """辞書に単語を登録（既にあれば読み方を更新）"""
+        with self._lock:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    INSERT INTO dictionary (guild_id, word, reading)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT(guild_id, word) DO UPDATE SET reading = ?
+                """, (guild_id, word, reading, reading))
+            self._dictionaries.setdefault(guild_id, {})[word] = reading
+
+    def remove_dictionary_word(self, guild_id: int, word: str) -> bool:
+        """辞書から単語を削除"""
+        with self._lock:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    "DELETE FROM dictionary WHERE guild_id = ? AND word = ?",
+                    (guild_id, word)
+                )
+            self._dictionaries.get(guild_id, {}).pop(word, None)
             return cursor.rowcount > 0
+
+    def get_guild_language(self, guild_id: int) -> str | None:
+        """ギルドの読み上げ言語を取得（未設定なら None）"""
+        with self._lock:
+            return self._guild_languages.get(guild_id)
+
+    def set_guild_language(self, guild_id: int, language: str | None):
+        """ギルドの読み上げ言語を設定（None で設定を削除）"""
+        with self._lock:
+            with self._get_connection() as conn:
+                cursor = conn.cursor()
+                if language is None:
+                    cursor.execute("DELETE FROM guild_languages WHERE guild_id = ?", (guild_id,))
+                else:
+                    cursor.execute("""
+                        INSERT INTO guild_languages (guild_id, language)
+                        VALUES (?, ?)
+                        ON CONFLICT(guild_id) DO UPDATE SET language = ?
+                    """, (guild_id, language, language))
+            if language is None:
+                self._guild_languages.pop(guild_id, None)
+            else:
+                self._guild_languages[guild_id] = language
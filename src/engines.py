@@ -0,0 +1,408 @@
+import gc
+import importlib
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable
+
+import psutil
+
+# Chatterbox Multilingual が読める言語
+SUPPORTED_LANGUAGES = {
+    "ar", "da", "de", "el", "en", "es", "fi", "fr", "he", "hi", "it", "ja",
+    "ko", "ms", "nl", "no", "pl", "pt", "ru", "sv", "sw", "tr", "zh",
+}
+
+# 文字の種類（用字）と言語の対応。かなは日本語に確定できるので別に数える
+KANA_PATTERN = re.compile(r"[ぁ-ゟ゠-ヿｦ-ﾟ]")
+HAN_PATTERN = re.compile(r"[㐀-䶿一-鿿豈-﫿]")
+SCRIPT_PATTERNS = [
+    ("ko", re.compile(r"[가-힯ᄀ-ᇿ㄰-㆏]")),
+    ("ru", re.compile(r"[Ѐ-ӿ]")),
+    ("el", re.compile(r"[Ͱ-Ͽ]")),
+    ("he", re.compile(r"[֐-׿]")),
+    ("ar", re.compile(r"[؀-ۿ]")),
+    ("hi", re.compile(r"[ऀ-ॿ]")),
+    ("en", re.compile(r"[A-Za-zÀ-ɏ]")),
+]
+# ラテン文字がこれより少ない（"OK" "w" など）ときはデフォルトの言語のままにする
+MIN_LATIN_LETTERS = 4
+
+# 言語ごとの設定で使う「自動判定」
+AUTO_LANGUAGE = "auto"
+
+
+def detect_language(text: str, default: str = "ja") -> str:
+    """文字の種類だけで読み上げる言語を推定する（辞書もモデルも使わない）
+
+    かなが含まれていれば日本語。それ以外は最も多い用字の言語（ラテン文字は英語）。
+    漢字だけの文や判定できない文は default を返す。
+    """
+    if KANA_PATTERN.search(text):
+        return "ja"
+
+    counts = {language: len(pattern.findall(text)) for language, pattern in SCRIPT_PATTERNS}
+    language, count = max(counts.items(), key=lambda item: item[1])
+    if count == 0 or count < len(HAN_PATTERN.findall(text)):
+        return default
+    if language == "en" and count < MIN_LATIN_LETTERS:
+        return default
+    return language
+
+
+def parse_engine_routes(value: str) -> dict[str, str]:
+    """"言語:エンジン,..." 形式の設定を読む（"*" はその他の言語）"""
+    routes: dict[str, str] = {}
+    for entry in value.split(","):
+        language, sep, engine = entry.strip().partition(":")
+        if not sep or not engine:
+            if entry.strip():
+                print(f"Invalid engine route: {entry}")
+            continue
+        routes[language.strip()] = engine.strip()
+    return routes
+
+
+def engine_factory(name: str, synth_kwargs: dict) -> Callable[[], Any]:
+    """エンジン名からシンセサイザーを作る関数を返す
+
+    - chatterbox: 通常のモデル（synth_kwargs の設定）
+    - chatterbox-cpu: CPU・int8量子化のモデル（GPUが混んでいるときの退避先）
+    - fake: モデルを使わない偽のシンセサイザー（動作確認用）
+    - "モジュール:クラス": 引数なしで作成できる任意のシンセサイザー
+    """
+    if name == "chatterbox":
+        def create():
+            from tts import ChatterboxVoiceSynthesizer
+            return ChatterboxVoiceSynthesizer(**synth_kwargs)
+        return create
+    if name == "chatterbox-cpu":
+        def create():
+            from tts import ChatterboxVoiceSynthesizer
+            return ChatterboxVoiceSynthesizer(
+                **dict(synth_kwargs, device="cpu", quantize=True, compile_model=False)
+            )
+        return create
+    if name == "fake":
+        def create():
+            from fake_synth import FakeSynthesizer
+            return FakeSynthesizer(opus_bitrate=synth_kwargs.get("opus_bitrate", 0))
+        return create
+
+    module_name, _, class_name = name.partition(":")
+    if not class_name:
+        raise ValueError(f"unknown engine: {name}")
+    return lambda: getattr(importlib.import_module(module_name), class_name)()
+
+
+@dataclass
+class LoadedEngine:
+    synth: Any
+    memory_bytes: int
+    last_used: float
+    in_use: int = 0
+
+
+class SynthesizerRegistry:
+    """言語ごとにエンジンを振り分ける、シンセサイザーと同じインターフェースのラッパー
+
+    エンジンは最初に使われたときに読み込み、idle_timeout 秒使われなかったもの、
+    または読み込み済みの合計が memory_budget_mb を超えたときの古いものから解放する。
+    default_engine（話者の登録にも使う）は解放しない。
+    使用中（in_use > 0）のエンジンは解放せず、使い終わってから上限を確かめ直す。
+    リクエストの params に ("engine", 名前) があれば、言語に関係なくそのエンジンを使う。
+    """
+
+    def __init__(
+        self,
+        factories: dict[str, Callable[[], Any]],
+        routes: dict[str, str] | None = None,
+        default_engine: str = "chatterbox",
+        idle_timeout: float = 600.0,
+        memory_budget_mb: int = 0,
+    ):
+        self.factories = factories
+        self.routes = routes or {}
+        self.default_engine = default_engine
+        self.idle_timeout = idle_timeout
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self.last_timings: dict[str, float] = {}
+        self.loads = 0
+        self.evictions = 0
+
+        self._engines: OrderedDict[str, LoadedEngine] = OrderedDict()
+        self._load_locks: dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        if idle_timeout > 0:
+            threading.Thread(target=self._evict_idle_loop, name="engine-evictor", daemon=True).start()
+
+    @property
+    def loaded(self) -> list[str]:
+        with self._lock:
+            return list(self._engines)
+
+    def engine_for(self, language: str, params: tuple = ()) -> str:
+        """言語（と生成パラメータ）から使うエンジン名を決める"""
+        engine = dict(params).get("engine")
+        if engine in self.factories:
+            return engine
+        return self.routes.get(language) or self.routes.get("*") or self.default_engine
+
+    # =====================
+    # Loading / eviction
+    # =====================
+    def _acquire(self, name: str) -> Any:
+        """エンジンを使用中にして返す（読み込まれていなければ読み込む）"""
+        with self._lock:
+            engine = self._engines.get(name)
+            if engine is None:
+                load_lock = self._load_locks.setdefault(name, threading.Lock())
+            else:
+                return self._use(name, engine)
+
+        # 読み込みはエンジンごとに1回だけ。他のエンジンの利用は止めない
+        with load_lock:
+            with self._lock:
+                engine = self._engines.get(name)
+                if engine is not None:
+                    return self._use(name, engine)
+            synth, memory_bytes = self._load(name)
+            with self._lock:
+                engine = LoadedEngine(synth, memory_bytes, time.monotonic())
+                self._engines[name] = engine
+                synth = self._use(name, engine)
+                evicted = self._enforce_budget()
+        if evicted:
+            _collect_garbage()
+        return synth
+
+    def _use(self, name: str, engine: LoadedEngine) -> Any:
+        engine.in_use += 1
+        engine.last_used = time.monotonic()
+        self._engines.move_to_end(name)
+        return engine.synth
+
+    def _release(self, name: str, touch: bool = True):
+        with self._lock:
+            engine = self._engines.get(name)
+            if engine is None:
+                return
+            engine.in_use -= 1
+            if touch:
+                engine.last_used = time.monotonic()
+            # 使用中で解放できなかったエンジンがあれば、ここで上限を確かめ直す
+            evicted = engine.in_use == 0 and self._enforce_budget()
+        if evicted:
+            _collect_garbage()
+
+    def _hold_loaded(self) -> list[tuple[str, Any]]:
+        """読み込み済みのエンジンを全て使用中にして返す（最終使用時刻と順序は変えない）"""
+        with self._lock:
+            for engine in self._engines.values():
+                engine.in_use += 1
+            return [(name, engine.synth) for name, engine in self._engines.items()]
+
+    def _load(self, name: str) -> tuple[Any, int]:
+        """エンジンを読み込み、増えたメモリ（RSS + CUDA）のバイト数と一緒に返す"""
+        factory = self.factories.get(name)
+        if factory is None:
+            raise ValueError(f"unknown engine: {name}")
+        print(f"Loading TTS engine: {name}")
+        before = _memory_in_use()
+        start = time.perf_counter()
+        synth = factory()
+        memory_bytes = max(0, _memory_in_use() - before)
+        self.loads += 1
+        print(f"TTS engine {name} loaded in {time.perf_counter() - start:.1f}s ({memory_bytes / 1024**2:.0f}MB)")
+        return synth, memory_bytes
+
+    def _evictable(self, name: str, engine: LoadedEngine) -> bool:
+        return name != self.default_engine and engine.in_use == 0
+
+    def _evict(self, name: str, reason: str):
+        """エンジンを登録から外す（_lock を持った状態で呼ぶ）
+
+        メモリの回収は時間がかかるので、呼び出し側がロックを放してから _collect_garbage を呼ぶ。
+        """
+        engine = self._engines.pop(name)
+        self.evictions += 1
+        print(f"TTS engine {name} evicted ({reason}, {engine.memory_bytes / 1024**2:.0f}MB)")
+
+    def _enforce_budget(self) -> bool:
+        """メモリの上限を超えていれば、使われていない古いエンジンから外す（外したら True）"""
+        if not self.memory_budget:
+            return False
+        evicted = False
+        for name, engine in list(self._engines.items()):
+            if sum(e.memory_bytes for e in self._engines.values()) <= self.memory_budget:
+                break
+            if self._evictable(name, engine):
+                self._evict(name, "memory budget")
+                evicted = True
+        return evicted
+
+    def evict_idle(self, now: float | None = None):
+        """idle_timeout 秒使われていないエンジンを解放する"""
+        now = time.monotonic() if now is None else now
+        evicted = False
+        with self._lock:
+            for name, engine in list(self._engines.items()):
+                if self._evictable(name, engine) and now - engine.last_used > self.idle_timeout:
+                    self._evict(name, "idle")
+                    evicted = True
+        if evicted:
+            _collect_garbage()
+
+    def _evict_idle_loop(self):
+        while not self._stop.wait(min(60.0, self.idle_timeout)):
+            try:
+                self.evict_idle()
+            except Exception as e:
+                print(f"Engine eviction error: {e}")
+
+    def close(self):
+        self._stop.set()
+
+    # =====================
+    # Synthesizer interface
+    # =====================
+    def synthesize_pcm(
+        self,
+        text: str,
+        speaker_wav: str | None = None,
+        language: str = "ja",
+        conds_path: str | None = None,
+        params: tuple = (),
+    ) -> bytes:
+        name = self.engine_for(language, params)
+        synth = self._acquire(name)
+        try:
+            return synth.synthesize_pcm(text, speaker_wav, language, conds_path, _engine_params(params))
+        finally:
+            self.last_timings = dict(synth.last_timings)
+            self._release(name)
+
+    def synthesize_many(
+        self,
+        jobs: list[tuple],
+        on_result: Callable[[int, bytes | Exception, dict], None] | None = None,
+        should_skip: Callable[[int], bool] | None = None,
+    ) -> list[bytes | Exception | None]:
+        """エンジンごとにまとめて各エンジンの synthesize_many に渡す（結果は元の順で返す）"""
+        groups: OrderedDict[str, list[int]] = OrderedDict()
+        for index, (_, _, language, _, params) in enumerate(jobs):
+            groups.setdefault(self.engine_for(language, params), []).append(index)
+
+        results: list[bytes | Exception | None] = [None] * len(jobs)
+        for name, indices in groups.items():
+            try:
+                synth = self._acquire(name)
+            except Exception as e:
+                # 読み込めないエンジンのリクエストだけ失敗させる
+                print(f"TTS engine {name} failed to load: {e}")
+                for index in indices:
+                    results[index] = e
+                    if on_result:
+                        on_result(index, e, {})
+                continue
+            try:
+                group_results = synth.synthesize_many(
+                    [
+                        (text, speaker_wav, language, conds_path, _engine_params(params))
+                        for text, speaker_wav, language, conds_path, params in (jobs[i] for i in indices)
+                    ],
+                    (lambda i, result, timings: on_result(indices[i], result, timings)) if on_result else None,
+                    (lambda i: should_skip(indices[i])) if should_skip else None,
+                )
+            finally:
+                self._release(name)
+            for index, result in zip(indices, group_results):
+                results[index] = result
+        return results
+
+    def preload(self):
+        """default_engine を読み込んでおく（起動時用）"""
+        self._acquire(self.default_engine)
+        self._release(self.default_engine)
+
+    def warmup(self, *args, **kwargs) -> float:
+        """default_engine だけ読み込んでウォームアップする（他のエンジンは使われたときに読み込む）"""
+        synth = self._acquire(self.default_engine)
+        try:
+            return synth.warmup(*args, **kwargs)
+        finally:
+            self._release(self.default_engine)
+
+    def prepare_speaker(self, src_path: str, wav_path: str, conds_path: str):
+        """話者の登録は default_engine で行う（コンディショニングのファイルを共有するため）"""
+        synth = self._acquire(self.default_engine)
+        try:
+            synth.prepare_speaker(src_path, wav_path, conds_path)
+        finally:
+            self._release(self.default_engine)
+
+    def prefetch_speaker(self, speaker_wav: str, conds_path: str | None) -> bool:
+        """読み込み済みのエンジンにだけ先読みさせる（先読みのためにエンジンを読み込まない）"""
+        engines = self._hold_loaded()
+        try:
+            return any([synth.prefetch_speaker(speaker_wav, conds_path) for _, synth in engines])
+        finally:
+            for name, _ in engines:
+                self._release(name, touch=False)
+
+    def invalidate_speaker(self, speaker_wav: str):
+        engines = self._hold_loaded()
+        try:
+            for _, synth in engines:
+                synth.invalidate_speaker(speaker_wav)
+        finally:
+            for name, _ in engines:
+                self._release(name, touch=False)
+
+
+def _engine_params(params: tuple) -> tuple:
+    """エンジンの選択はレジストリで済ませるので、エンジンには渡さない"""
+    return tuple(p for p in params if p[0] != "engine")
+
+
+def _collect_garbage():
+    """外したエンジンのメモリを回収する（レジストリのロックの外で呼ぶ）"""
+    gc.collect()
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def _memory_in_use() -> int:
+    """このプロセスのRSSとCUDAの確保量の合計（バイト）"""
+    total = psutil.Process().memory_info().rss
+    torch = sys.modules.get("torch")
+    if torch is not None and torch.cuda.is_available():
+        total += torch.cuda.memory_allocated()
+    return total
+
+
+def create_synthesizer(
+    synth_kwargs: dict,
+    routes: dict[str, str] | None = None,
+    default_engine: str = "chatterbox",
+    engines: list[str] | None = None,
+    idle_timeout: float = 600.0,
+    memory_budget_mb: int = 0,
+) -> SynthesizerRegistry:
+    """設定された全エンジンのレジストリを作成（読み込みは使われたときに行う）
+
+    engines は routes に無くても params で指定されうるエンジン（品質の段階の退避先など）。
+    """
+    names = {default_engine, *(routes or {}).values(), *(engines or [])}
+    return SynthesizerRegistry(
+        {name: engine_factory(name, synth_kwargs) for name in names},
+        routes=routes,
+        default_engine=default_engine,
+        idle_timeout=idle_timeout,
+        memory_budget_mb=memory_budget_mb,
+    )
@@ -0,0 +1,107 @@
+import random
+import threading
+import time
+import wave
+from typing import Callable
+
+import numpy as np
+
+from audio_source import encode_opus, to_discord_pcm
+from length_policy import SPEECH_TOKENS_PER_SECOND
+from playback import CHARS_PER_SECOND
+
+
+class FakeSynthesizer:
+    """ChatterboxVoiceSynthesizer と同じインターフェースの偽モデル
+
+    文字数から読み上げ時間を見積もり、その rtf 倍の時間だけ待ってから正弦波を返す。
+    GPUもモデルも不要なので、キューやスケジューラーの計測に使う。
+    """
+
+    def __init__(
+        self,
+        rtf: float = 0.3,
+        jitter: float = 0.1,
+        sr: int = 24000,
+        seed: int = 0,
+        opus_bitrate: int = 0,
+    ):
+        self.rtf = rtf
+        self.opus_bitrate = opus_bitrate
+        self.jitter = jitter
+        self.sr = sr
+        self.last_timings: dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+
+    def _generate(self, text: str, params: tuple = ()) -> np.ndarray:
+        self.last_timings = {}
+        seconds = max(len(text) / CHARS_PER_SECOND, 0.3)
+        # 音声トークン数の上限は生成される音声の長さの上限になる
+        max_new_tokens = dict(params).get("max_new_tokens", 0)
+        if max_new_tokens > 0:
+            seconds = min(seconds, max_new_tokens / SPEECH_TOKENS_PER_SECOND)
+        cost = seconds * self.rtf * (1 + self._random.uniform(-self.jitter, self.jitter))
+
+        self.last_timings["conditioning"] = 0.0
+        start = time.perf_counter()
+        time.sleep(cost * 0.8)
+        self.last_timings["generation"] = time.perf_counter() - start
+        start = time.perf_counter()
+        time.sleep(cost * 0.2)
+        self.last_timings["vocoder"] = time.perf_counter() - start
+
+        t = np.arange(int(seconds * self.sr), dtype=np.float32) / self.sr
+        return 0.3 * np.sin(2 * np.pi * 220 * t)
+
+    def _to_pcm(self, wav: np.ndarray) -> bytes:
+        start = time.perf_counter()
+        pcm = to_discord_pcm(wav, self.sr)
+        if self.opus_bitrate:
+            pcm = encode_opus(pcm, self.opus_bitrate)
+        self.last_timings["encode"] = time.perf_counter() - start
+        return pcm
+
+    def synthesize_pcm(self, text, speaker_wav=None, language="ja", conds_path=None, params=()) -> bytes:
+        with self._lock:
+            return self._to_pcm(self._generate(text, params))
+
+    def synthesize_many(
+        self,
+        jobs: list[tuple],
+        on_result: Callable | None = None,
+        should_skip: Callable | None = None,
+    ) -> list:
+        results = []
+        with self._lock:
+            for index, (text, speaker_wav, language, conds_path, params) in enumerate(jobs):
+                if should_skip and should_skip(index):
+                    results.append(None)
+                    continue
+                start = time.perf_counter()
+                result = self._to_pcm(self._generate(text, params))
+                timings = dict(self.last_timings, synthesis=time.perf_counter() - start)
+                results.append(result)
+                if on_result:
+                    on_result(index, result, timings)
+        return results
+
+    def warmup(self, texts: list[str] = ("はい。",), language: str = "ja") -> float:
+        start = time.perf_counter()
+        for text in texts:
+            self.synthesize_pcm(text, language=language)
+        return time.perf_counter() - start
+
+    def prepare_speaker(self, src_path: str, wav_path: str, conds_path: str):
+        # 話者ストアに追記できるよう、モデルと同じ形式（24kHzモノラル16bit）の無音を書く
+        with wave.open(wav_path, "wb") as w:
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.setframerate(24000)
+            w.writeframes(np.zeros(24000, dtype=np.int16).tobytes())
+
+    def prefetch_speaker(self, speaker_wav: str, conds_path: str | None) -> bool:
+        return False
+
+    def invalidate_speaker(self, speaker_wav: str):
+        pass
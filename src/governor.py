@@ -0,0 +1,127 @@
+import time
+from dataclasses import dataclass
+
+# モデルの既定の生成パラメータ（これと同じ値はキャッシュキーに含めない）
+DEFAULT_CFG_WEIGHT = 0.5
+
+
+@dataclass(frozen=True)
+class QualityTier:
+    """負荷に応じて切り替える品質の段階"""
+    name: str
+    cfg_weight: float = DEFAULT_CFG_WEIGHT
+    max_new_tokens: int = 0  # 1文あたりの音声トークンの上限（0でモデルの既定）
+    chunk_max_chars: int = 0  # 文の分割の最大文字数（0で TTS_CHUNK_MAX_CHARS）
+    engine: str = ""  # 言語に関係なく使うエンジン（空なら言語ごとの振り分けのまま）
+
+    @property
+    def params(self) -> tuple:
+        """SynthesisRequest.params に渡す生成パラメータ（既定と異なるものだけ）"""
+        params = []
+        if self.cfg_weight != DEFAULT_CFG_WEIGHT:
+            params.append(("cfg_weight", self.cfg_weight))
+        if self.max_new_tokens > 0:
+            params.append(("max_new_tokens", self.max_new_tokens))
+        if self.engine:
+            params.append(("engine", self.engine))
+        return tuple(params)
+
+
+DEFAULT_TIERS = [
+    QualityTier("full"),
+    QualityTier("reduced", cfg_weight=0.3, max_new_tokens=600, chunk_max_chars=50),
+    QualityTier("minimal", cfg_weight=0.0, max_new_tokens=400, chunk_max_chars=30),
+]
+
+
+def parse_tiers(value: str) -> list[QualityTier]:
+    """"名前:cfg_weight:最大トークン数:最大文字数[:エンジン],..." 形式の設定を読む（先頭が最高品質）"""
+    tiers: list[QualityTier] = []
+    for entry in value.split(","):
+        fields = entry.strip().split(":", 4)
+        if len(fields) not in (4, 5):
+            if entry.strip():
+                print(f"Invalid quality tier: {entry}")
+            continue
+        try:
+            tiers.append(QualityTier(
+                fields[0], float(fields[1]), int(fields[2]), int(fields[3]),
+                fields[4] if len(fields) == 5 else "",
+            ))
+        except ValueError:
+            print(f"Invalid quality tier: {entry}")
+    return tiers or list(DEFAULT_TIERS)
+
+
+class LoadGovernor:
+    """合成の待ち行列と実時間比（RTF）を見て品質の段階を上げ下げする
+
+    - 待機中のリクエストが high_pending 以上、または RTF が high_rtf 以上なら1段下げる
+    - 待機中が low_pending 以下、かつ RTF が low_rtf 以下なら1段上げる
+    段階の往復を防ぐため、下げた後は step_down_after 秒、上げる前は step_up_after 秒空ける。
+    RTF は合成時間 / 音声の長さの指数移動平均（1未満なら再生より速く作れている）。
+    """
+
+    def __init__(
+        self,
+        tiers: list[QualityTier] | None = None,
+        high_pending: int = 8,
+        low_pending: int = 2,
+        high_rtf: float = 0.9,
+        low_rtf: float = 0.6,
+        step_down_after: float = 5.0,
+        step_up_after: float = 30.0,
+        rtf_alpha: float = 0.2,
+    ):
+        self.tiers = tiers or list(DEFAULT_TIERS)
+        self.high_pending = high_pending
+        self.low_pending = low_pending
+        self.high_rtf = high_rtf
+        self.low_rtf = low_rtf
+        self.step_down_after = step_down_after
+        self.step_up_after = step_up_after
+        self.rtf_alpha = rtf_alpha
+
+        self.level = 0
+        self.rtf = 0.0
+        self.pending = 0
+        self.changes = 0
+        self._changed_at = float("-inf")
+
+    @property
+    def tier(self) -> QualityTier:
+        return self.tiers[self.level]
+
+    def observe(self, synthesis_seconds: float, audio_seconds: float):
+        """合成1件分の処理時間と音声の長さを記録"""
+        if audio_seconds <= 0:
+            return
+        rtf = synthesis_seconds / audio_seconds
+        self.rtf = rtf if self.rtf == 0.0 else self.rtf + self.rtf_alpha * (rtf - self.rtf)
+
+    def update(self, pending: int, now: float | None = None) -> QualityTier:
+        """現在の待機数から段階を決め、使う段階を返す"""
+        now = time.monotonic() if now is None else now
+        self.pending = pending
+        elapsed = now - self._changed_at
+
+        overloaded = pending >= self.high_pending or self.rtf >= self.high_rtf
+        drained = pending <= self.low_pending and self.rtf <= self.low_rtf
+        if overloaded and self.level < len(self.tiers) - 1 and elapsed >= self.step_down_after:
+            self._set_level(self.level + 1, now)
+        elif drained and self.level > 0 and elapsed >= self.step_up_after:
+            self._set_level(self.level - 1, now)
+        return self.tier
+
+    def _set_level(self, level: int, now: float):
+        print(
+            f"Quality tier: {self.tier.name} -> {self.tiers[level].name} "
+            f"(pending {self.pending}, RTF {self.rtf:.2f})"
+        )
+        self.level = level
+        self.changes += 1
+        self._changed_at = now
+
+    def describe(self) -> str:
+        """!status 用の表示"""
+        return f"{self.tier.name} ({self.level + 1}/{len(self.tiers)}) RTF {self.rtf:.2f}"
@@ -0,0 +1,74 @@
+import math
+
+from playback import CHARS_PER_SECOND
+
+# S3トークナイザーの音声トークンレート（1秒あたり）
+SPEECH_TOKENS_PER_SECOND = 25
+
+
+def estimate_speech_tokens(text: str) -> int:
+    """テキストを読み上げるのに必要な音声トークン数の見積もり"""
+    return math.ceil(len(text) / CHARS_PER_SECOND * SPEECH_TOKENS_PER_SECOND)
+
+
+def parse_guild_limits(value: str) -> dict[int, int]:
+    """"ギルドID:トークン数,..." 形式の設定を読む"""
+    limits: dict[int, int] = {}
+    for entry in value.split(","):
+        guild_id, sep, tokens = entry.strip().partition(":")
+        if not sep:
+            continue
+        try:
+            limits[int(guild_id)] = int(tokens)
+        except ValueError:
+            print(f"Invalid guild token limit: {entry}")
+    return limits
+
+
+class LengthPolicy:
+    """メッセージの長さの扱い
+
+    - 音声トークンの見積もりが上限（ギルドごとに変更可）を超えたら、文の区切りで切って「以下略」を付ける
+    - long_tokens を超えるメッセージは長文として低優先度で合成する
+    """
+
+    def __init__(
+        self,
+        max_tokens: int = 1500,
+        long_tokens: int = 300,
+        guild_limits: dict[int, int] | None = None,
+        truncation_suffix: str = "以下略",
+    ):
+        self.max_tokens = max_tokens
+        self.long_tokens = long_tokens
+        self.guild_limits = guild_limits or {}
+        self.truncation_suffix = truncation_suffix
+
+    def limit_for(self, guild_id: int) -> int:
+        return self.guild_limits.get(guild_id, self.max_tokens)
+
+    def truncate(self, chunks: list[str], guild_id: int = 0) -> tuple[list[str], bool]:
+        """上限に収まるところまで文単位で残す（切った場合は末尾に省略の文を足す）"""
+        budget = self.limit_for(guild_id)
+        if budget <= 0:
+            return chunks, False
+
+        kept: list[str] = []
+        used = 0
+        for chunk in chunks:
+            tokens = estimate_speech_tokens(chunk)
+            if used + tokens > budget:
+                if not kept:
+                    # 1文目から上限を超える場合は文字数で切る
+                    max_chars = max(1, int(budget / SPEECH_TOKENS_PER_SECOND * CHARS_PER_SECOND))
+                    kept.append(chunk[:max_chars])
+                if self.truncation_suffix:
+                    kept.append(self.truncation_suffix)
+                return kept, True
+            kept.append(chunk)
+            used += tokens
+        return kept, False
+
+    def is_long(self, chunks: list[str]) -> bool:
+        """低優先度で合成する長文か"""
+        return sum(estimate_speech_tokens(chunk) for chunk in chunks) > self.long_tokens
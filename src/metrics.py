@@ -0,0 +1,161 @@
+import asyncio
+import threading
+from collections import deque
+from typing import Callable
+
+# パイプラインの計測区間（表示順）
+STAGES = [
+    "speaker_lookup",       # 話者の取得
+    "speaker_prefetch",     # 入力中の話者の先読み
+    "queue_wait",           # 合成待ち
+    "conditioning",         # 話者コンディショニング
+    "generation",           # トークン生成
+    "vocoder",              # ボコーダー
+    "encode",               # PCM変換
+    "synthesis",            # 合成合計
+    "playback_delay",       # 合成完了から再生開始まで
+    "time_to_first_audio",  # メッセージ受信から最初の音声まで
+    "playback",             # 再生時間
+]
+
+
+class LatencyHistogram:
+    """直近のサンプルを保持し、パーセンタイルを計算する"""
+
+    def __init__(self, max_samples: int = 1024):
+        self.samples: deque[float] = deque(maxlen=max_samples)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+
+    def percentile(self, q: float) -> float:
+        """q (0-100) パーセンタイル（直近のサンプルから計算）"""
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+
+class PipelineMetrics:
+    """発話ごとの区間時間を全体・ギルド別に集計する"""
+
+    def __init__(self, max_samples: int = 1024, max_guild_samples: int = 256):
+        self.max_samples = max_samples
+        self.max_guild_samples = max_guild_samples
+        self._overall: dict[str, LatencyHistogram] = {}
+        self._guilds: dict[int, dict[str, LatencyHistogram]] = {}
+        self._gauges: dict[str, Callable[[], float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float, guild_id: int | None = None):
+        """区間時間を記録（スレッドセーフ）"""
+        with self._lock:
+            self._overall.setdefault(stage, LatencyHistogram(self.max_samples)).add(seconds)
+            if guild_id is not None:
+                guild = self._guilds.setdefault(guild_id, {})
+                guild.setdefault(stage, LatencyHistogram(self.max_guild_samples)).add(seconds)
+
+    def record_many(self, timings: dict[str, float], guild_id: int | None = None):
+        for stage, seconds in timings.items():
+            self.record(stage, seconds, guild_id)
+
+    def register_gauge(self, name: str, fn: Callable[[], float]):
+        """Prometheus出力に含める値を登録（キャッシュヒット数など）"""
+        self._gauges[name] = fn
+
+    def forget_guild(self, guild_id: int):
+        with self._lock:
+            self._guilds.pop(guild_id, None)
+
+    def summary(self, guild_id: int | None = None) -> dict[str, dict]:
+        """区間ごとの件数とパーセンタイル（秒）を辞書で返す"""
+        with self._lock:
+            histograms = self._guilds.get(guild_id, {}) if guild_id is not None else self._overall
+            return {
+                stage: {
+                    "count": hist.count,
+                    "p50": hist.percentile(50),
+                    "p95": hist.percentile(95),
+                    "p99": hist.percentile(99),
+                }
+                for stage in STAGES
+                if (hist := histograms.get(stage)) and hist.count
+            }
+
+    def report(self, guild_id: int | None = None) -> str:
+        """!perf 用のテキストを作成（単位: 秒）"""
+        with self._lock:
+            histograms = self._guilds.get(guild_id, {}) if guild_id is not None else self._overall
+            lines = [f"{'stage':<20}{'count':>7}{'p50':>8}{'p95':>8}{'p99':>8}"]
+            for stage in STAGES:
+                hist = histograms.get(stage)
+                if not hist or not hist.count:
+                    continue
+                lines.append(
+                    f"{stage:<20}{hist.count:>7}"
+                    f"{hist.percentile(50):>8.2f}{hist.percentile(95):>8.2f}{hist.percentile(99):>8.2f}"
+                )
+        if len(lines) == 1:
+            lines.append("(データなし)")
+        return "\n".join(lines)
+
+    def render_prometheus(self) -> str:
+        """Prometheusのテキスト形式で出力"""
+        out = [
+            "# HELP kero_voice_stage_seconds Pipeline stage latency in seconds",
+            "# TYPE kero_voice_stage_seconds summary",
+        ]
+        with self._lock:
+            for stage, hist in self._overall.items():
+                for q in (0.5, 0.95, 0.99):
+                    out.append(
+                        f'kero_voice_stage_seconds{{stage="{stage}",quantile="{q}"}} '
+                        f"{hist.percentile(q * 100):.6f}"
+                    )
+                out.append(f'kero_voice_stage_seconds_sum{{stage="{stage}"}} {hist.total:.6f}')
+                out.append(f'kero_voice_stage_seconds_count{{stage="{stage}"}} {hist.count}')
+
+        for name, fn in self._gauges.items():
+            try:
+                value = fn()
+            except Exception:
+                continue
+            out.append(f"# TYPE kero_voice_{name} gauge")
+            out.append(f"kero_voice_{name} {value}")
+        return "\n".join(out) + "\n"
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 9100) -> asyncio.AbstractServer:
+        """/metrics を返す簡易HTTPサーバーを起動"""
+
+        async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            try:
+                request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+                # ヘッダーは読み捨てる
+                while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+                    pass
+
+                parts = request_line.decode(errors="replace").split()
+                if len(parts) >= 2 and parts[1].split("?")[0] == "/metrics":
+                    status, body = "200 OK", self.render_prometheus()
+                else:
+                    status, body = "404 Not Found", "not found\n"
+
+                payload = body.encode()
+                writer.write(
+                    f"HTTP/1.1 {status}\r\n"
+                    "Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                    f"Content-Length: {len(payload)}\r\n"
+                    "Connection: close\r\n\r\n".encode() + payload
+                )
+                await writer.drain()
+            except Exception:
+                pass
+            finally:
+                writer.close()
+
+        return await asyncio.start_server(handle, host, port)
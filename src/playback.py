@@ -0,0 +1,137 @@
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass, field
+
+from audio_source import audio_seconds
+
+# 読み上げ時間の見積もり（日本語の1秒あたりの文字数）
+CHARS_PER_SECOND = 7.0
+
+
+@dataclass
+class AudioItem:
+    """再生キューの1件（ストリーミング時は1チャンク）"""
+    ready: asyncio.Event
+    pcm: bytes | None = None  # 48kHzステレオs16le、またはOpusパケット列（生成失敗時はNone）
+    text: str = ""
+    message_id: int = 0
+    user_id: int = 0
+    created_at: float = field(default_factory=time.monotonic)
+    future: asyncio.Future | None = None  # 合成リクエスト
+    first_chunk: bool = False  # メッセージの最初のチャンクか
+    ready_at: float | None = None  # 合成完了時刻
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.created_at
+
+    @property
+    def estimated_seconds(self) -> float:
+        """再生時間の見積もり（生成済みなら実際の長さ）"""
+        if self.pcm is not None:
+            return audio_seconds(self.pcm)
+        return len(self.text) / CHARS_PER_SECOND
+
+    def cancel(self):
+        """未完了の合成を取り消し、再生ワーカーを進める"""
+        if self.future and not self.future.done():
+            self.future.cancel()
+        self.pcm = None
+        self.ready.set()
+
+
+class PlaybackQueue:
+    """ギルドごとの上限付き再生キュー
+
+    - max_items を超えたら古いメッセージから破棄
+    - max_age 秒より古くなった項目は再生せずに破棄
+    - collapse_same_user が有効なら、同じユーザーの連続投稿は最新のものだけ残す
+    """
+
+    def __init__(
+        self,
+        max_items: int = 30,
+        max_age: float = 60.0,
+        collapse_same_user: bool = False,
+    ):
+        self.max_items = max(1, max_items)
+        self.max_age = max_age
+        self.collapse_same_user = collapse_same_user
+        self.current: AudioItem | None = None  # 再生中の項目
+        self.preparing: AudioItem | None = None  # キューから取り出し、合成完了・再生開始を待っている項目
+        self.dropped = 0
+        self._items: deque[AudioItem] = deque()
+        self._available = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def estimated_wait(self) -> float:
+        """今から追加した項目が再生されるまでの見積もり時間（秒）"""
+        return sum(item.estimated_seconds for item in self._items)
+
+    def would_be_stale(self) -> bool:
+        """今追加しても再生時には max_age を超えているか"""
+        return bool(self.max_age) and self.estimated_wait() > self.max_age
+
+    def _drop_message(self, message_id: int) -> int:
+        """メッセージ単位で待機中の項目を破棄"""
+        kept: deque[AudioItem] = deque()
+        removed = 0
+        for item in self._items:
+            if item.message_id == message_id:
+                item.cancel()
+                removed += 1
+            else:
+                kept.append(item)
+        self._items = kept
+        self.dropped += removed
+        return removed
+
+    def put_message(self, items: list[AudioItem]):
+        """1メッセージ分の項目をまとめて追加"""
+        if not items:
+            return
+
+        # 同じユーザーの連続投稿は直前の未再生メッセージを破棄
+        if self.collapse_same_user:
+            user_id = items[0].user_id
+            while self._items and self._items[-1].user_id == user_id:
+                self._drop_message(self._items[-1].message_id)
+
+        # 上限を超える場合は古いメッセージから破棄
+        while self._items and len(self._items) + len(items) > self.max_items:
+            self._drop_message(self._items[0].message_id)
+
+        self._items.extend(items)
+        self._available.set()
+
+    async def get(self) -> AudioItem:
+        """次に再生する項目を取得（古くなりすぎた項目は破棄）"""
+        while True:
+            while self._items:
+                item = self._items.popleft()
+                if self.max_age and item.age > self.max_age:
+                    item.cancel()
+                    self.dropped += 1
+                    continue
+                return item
+            self._available.clear()
+            await self._available.wait()
+
+    def skip_current(self) -> int:
+        """再生中（無ければ次に再生する）メッセージの残りのチャンクを破棄"""
+        current = self.current or self.preparing
+        if current is None:
+            return 0
+        return self._drop_message(current.message_id)
+
+    def clear(self) -> int:
+        """待機中の項目をすべて破棄"""
+        count = len(self._items)
+        for item in self._items:
+            item.cancel()
+        self._items.clear()
+        self.dropped += count
+        return count
@@ -0,0 +1,41 @@
+import time
+from collections import OrderedDict, deque
+
+
+class PrewarmBudget:
+    """入力中（タイピング）の話者の先読みの上限
+
+    - 同じ話者は cooldown 秒に1回だけ（入力中の通知は数秒おきに繰り返し届く）
+    - window 秒あたり max_per_window 回まで。話者キャッシュの容量より小さくしておけば、
+      大勢が同時に入力しても先読みが話中の話者を追い出し合うことはない
+    """
+
+    def __init__(self, max_per_window: int = 8, window: float = 60.0, cooldown: float = 30.0):
+        self.max_per_window = max_per_window
+        self.window = window
+        self.cooldown = cooldown
+        self.allowed = 0
+        self.skipped = 0
+        self._recent: deque[float] = deque()
+        self._last_by_key: OrderedDict[str, float] = OrderedDict()
+
+    def allow(self, key: str, now: float | None = None) -> bool:
+        """先読みしてよければ True（許可した分は予算から差し引く）"""
+        now = time.monotonic() if now is None else now
+
+        while self._recent and now - self._recent[0] > self.window:
+            self._recent.popleft()
+        while self._last_by_key:
+            oldest_key, oldest = next(iter(self._last_by_key.items()))
+            if now - oldest <= self.cooldown:
+                break
+            del self._last_by_key[oldest_key]
+
+        if key in self._last_by_key or len(self._recent) >= self.max_per_window:
+            self.skipped += 1
+            return False
+
+        self._recent.append(now)
+        self._last_by_key[key] = now
+        self.allowed += 1
+        return True
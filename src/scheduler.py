@@ -0,0 +1,402 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Any, Callable, Protocol
+
+from audio_cache import RenderedAudioCache
+from audio_source import audio_seconds
+from governor import LoadGovernor
+from metrics import PipelineMetrics
+
+
+class QueueFullError(Exception):
+    """ギルドまたはユーザーの待機上限を超えた"""
+
+
+@dataclass
+class SynthesisRequest:
+    """音声合成リクエスト"""
+    text: str
+    speaker_wav: str | None = None
+    conds_path: str | None = None
+    language: str = "ja"
+    guild_id: int = 0
+    user_id: int = 0
+    params: tuple = ()  # 生成パラメータ（(名前, 値) の組。キャッシュキーに含める）
+    low_priority: bool = False  # 長文など、他のリクエストの後に回すもの
+    future: asyncio.Future | None = None
+    enqueued_at: float = field(default_factory=time.monotonic)
+    cache_key: str | None = None
+    timings: dict[str, float] = field(default_factory=dict)  # 区間時間（秒）
+
+    @property
+    def job(self) -> tuple:
+        """バックエンドに渡す (text, speaker_wav, language, conds_path, params)"""
+        return (self.text, self.speaker_wav, self.language, self.conds_path, self.params)
+
+
+class SynthesisBackend(Protocol):
+    """バッチを実際に合成するバックエンド"""
+
+    async def run_batch(
+        self,
+        requests: list[SynthesisRequest],
+        on_result: Callable[[int, Any], None],
+    ) -> None:
+        ...
+
+    async def prepare_speaker(self, src_path: str, wav_path: str, conds_path: str):
+        ...
+
+    async def prefetch_speaker(self, speaker_wav: str, conds_path: str | None):
+        ...
+
+    def invalidate_speaker(self, speaker_wav: str):
+        ...
+
+
+class InProcessBackend:
+    """同一プロセス内のシンセサイザーをスレッドプールで実行するバックエンド"""
+
+    def __init__(self, synth):
+        self.synth = synth
+
+    async def run_batch(
+        self,
+        requests: list[SynthesisRequest],
+        on_result: Callable[[int, Any], None],
+    ) -> None:
+        loop = asyncio.get_running_loop()
+
+        def deliver(index: int, result: Any, timings: dict):
+            requests[index].timings.update(timings)
+            loop.call_soon_threadsafe(on_result, index, result)
+
+        await loop.run_in_executor(
+            None,
+            self.synth.synthesize_many,
+            [r.job for r in requests],
+            deliver,
+            # 取り消されたリクエスト（VC退出など）は生成しない
+            lambda index: requests[index].future.done(),
+        )
+
+    async def prepare_speaker(self, src_path: str, wav_path: str, conds_path: str):
+        """話者登録の前処理（正規化・コンディショニング計算）をスレッドプールで実行"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            None,
+            self.synth.prepare_speaker,
+            src_path,
+            wav_path,
+            conds_path
+        )
+
+    async def prefetch_speaker(self, speaker_wav: str, conds_path: str | None):
+        """話者のコンディショニングをメモリに載せておく（合成とは別スレッドで読み込む）"""
+        await asyncio.to_thread(self.synth.prefetch_speaker, speaker_wav, conds_path)
+
+    def invalidate_speaker(self, speaker_wav: str):
+        self.synth.invalidate_speaker(speaker_wav)
+
+
+class SynthesisScheduler:
+    """合成リクエストをギルドごとのキューに積み、ラウンドロビンでバッチを組むスケジューラー
+
+    1つのギルドが大量に投稿しても、他のギルドのリクエストが順番に割り込めるようにする。
+    バッチは複数のリクエストをまとめてバックエンドに渡すだけで、モデルの推論は1件ずつ行う
+    （ワーカープロセスや合成サービスには並列に振り分けられる）。
+    batch_window 秒だけ後続のリクエストを待ち（0なら待たずに、その時点で積まれている分だけ）、
+    max_batch_size 件に達したら即座に実行する。
+    結果は各リクエストの future に個別に返す。
+    backend が None の間（モデル読み込み中）はリクエストを受け付けるだけで、
+    set_backend() されてから処理を始める。
+    low_priority のリクエストは通常のリクエストが無いときだけ処理するが、
+    low_priority_max_wait 秒以上待ったものは通常のリクエストより先に処理する。
+    """
+
+    def __init__(
+        self,
+        backend: SynthesisBackend | None,
+        batch_window: float = 0.0,
+        max_batch_size: int = 4,
+        num_workers: int = 1,
+        max_pending_per_guild: int = 40,
+        max_pending_per_user: int = 20,
+        cache: RenderedAudioCache | None = None,
+        metrics: PipelineMetrics | None = None,
+        low_priority_max_wait: float = 10.0,
+        governor: LoadGovernor | None = None,
+    ):
+        self.backend = backend
+        self.batch_window = batch_window
+        self.max_batch_size = max(1, max_batch_size)
+        self.num_workers = max(1, num_workers)
+        self.max_pending_per_guild = max_pending_per_guild
+        self.max_pending_per_user = max_pending_per_user
+        # 短い定型メッセージ用の生成済み音声キャッシュ
+        self.cache = cache
+        self.metrics = metrics
+        self.low_priority_max_wait = low_priority_max_wait
+        # 合成の実時間比を品質の段階の判断に使う
+        self.governor = governor
+
+        # ギルドごとのキュー（先頭のギルドから順に1件ずつ取り出す）
+        self._guild_queues: OrderedDict[int, deque[SynthesisRequest]] = OrderedDict()
+        # 低優先度のリクエストのギルドごとのキュー
+        self._low_priority_queues: OrderedDict[int, deque[SynthesisRequest]] = OrderedDict()
+        # 待機中 + 処理中の件数
+        self._guild_counts: dict[int, int] = {}
+        self._user_counts: dict[int, int] = {}
+        self._wakeup = asyncio.Event()
+        self._backend_ready = asyncio.Event()
+        if backend is not None:
+            self._backend_ready.set()
+        self._workers: list[asyncio.Task] = []
+        # ディスク層の確認中のタスク（完了まで参照を保持する）
+        self._lookups: set[asyncio.Task] = set()
+        # バックエンドで処理中のリクエスト（id -> リクエスト）
+        self._in_flight: dict[int, SynthesisRequest] = {}
+
+    @property
+    def ready(self) -> bool:
+        """バックエンドが設定済みか"""
+        return self._backend_ready.is_set()
+
+    def set_backend(self, backend: SynthesisBackend):
+        """読み込みが終わったバックエンドを設定し、待機中のリクエストの処理を始める"""
+        self.backend = backend
+        self._backend_ready.set()
+
+    def start(self):
+        """ワーカーを起動（起動済みなら何もしない）"""
+        if self._workers:
+            return
+        self._workers = [
+            asyncio.create_task(self._worker()) for _ in range(self.num_workers)
+        ]
+
+    async def stop(self):
+        """ワーカーを停止し、未処理のリクエストをキャンセル"""
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+        for queues in (self._guild_queues, self._low_priority_queues):
+            for queue in queues.values():
+                for request in queue:
+                    if not request.future.done():
+                        request.future.cancel()
+            queues.clear()
+
+    def submit(self, request: SynthesisRequest) -> asyncio.Future:
+        """リクエストを登録し、PCMを返すfutureを返す
+
+        キャッシュにある音声は合成せずに即座に返す。
+        ギルドまたはユーザーの上限を超える場合は QueueFullError を送出する。
+        """
+        loop = asyncio.get_running_loop()
+        request.future = loop.create_future()
+
+        if self.cache is not None:
+            request.cache_key = self.cache.make_key(
+                request.text, request.speaker_wav, request.language, request.params
+            )
+            if request.cache_key:
+                data = self.cache.get(request.cache_key)
+                if data is not None:
+                    request.future.set_result(data)
+                    return request.future
+
+        guild_count = self._guild_counts.get(request.guild_id, 0)
+        user_count = self._user_counts.get(request.user_id, 0)
+        if guild_count >= self.max_pending_per_guild:
+            raise QueueFullError(f"guild {request.guild_id} has {guild_count} pending requests")
+        if user_count >= self.max_pending_per_user:
+            raise QueueFullError(f"user {request.user_id} has {user_count} pending requests")
+
+        self._guild_counts[request.guild_id] = guild_count + 1
+        self._user_counts[request.user_id] = user_count + 1
+        request.future.add_done_callback(lambda _: self._release(request))
+
+        if request.cache_key and self.cache.disk_dir:
+            # ディスク層の確認はスレッドで行い、無ければキューに積む
+            task = asyncio.create_task(self._enqueue_after_disk_lookup(request))
+            self._lookups.add(task)
+            task.add_done_callback(self._lookups.discard)
+        else:
+            self._enqueue(request)
+        return request.future
+
+    def cancel_guild(self, guild_id: int) -> int:
+        """ギルドの待機中・処理中のリクエストをすべて取り消し、取り消した件数を返す
+
+        処理中のものは future をキャンセルし、バックエンドが未着手なら生成を飛ばす。
+        """
+        requests = [
+            request
+            for queues in (self._guild_queues, self._low_priority_queues)
+            for request in queues.pop(guild_id, ())
+        ]
+        requests += [r for r in self._in_flight.values() if r.guild_id == guild_id]
+
+        cancelled = 0
+        for request in requests:
+            if not request.future.done():
+                request.future.cancel()
+                cancelled += 1
+        return cancelled
+
+    def _enqueue(self, request: SynthesisRequest):
+        queues = self._low_priority_queues if request.low_priority else self._guild_queues
+        queues.setdefault(request.guild_id, deque()).append(request)
+        self._wakeup.set()
+
+    async def _enqueue_after_disk_lookup(self, request: SynthesisRequest):
+        data = await asyncio.to_thread(self.cache.load_from_disk, request.cache_key)
+        if request.future.done():
+            return
+        if data is not None:
+            request.future.set_result(data)
+        else:
+            self._enqueue(request)
+
+    def _store_cached(self, request: SynthesisRequest, data: bytes):
+        """生成した音声をキャッシュに登録"""
+        self.cache.put(request.cache_key, data)
+        if self.cache.disk_dir:
+            asyncio.get_running_loop().run_in_executor(
+                None, self.cache.save_to_disk, request.cache_key, data
+            )
+
+    def _release(self, request: SynthesisRequest):
+        """完了・キャンセルしたリクエストを上限のカウントから外す"""
+        for counts, key in (
+            (self._guild_counts, request.guild_id),
+            (self._user_counts, request.user_id),
+        ):
+            remaining = counts.get(key, 0) - 1
+            if remaining > 0:
+                counts[key] = remaining
+            else:
+                counts.pop(key, None)
+
+    @property
+    def pending(self) -> int:
+        """待機中のリクエスト数"""
+        return sum(
+            len(queue)
+            for queues in (self._guild_queues, self._low_priority_queues)
+            for queue in queues.values()
+        )
+
+    def pending_for_guild(self, guild_id: int) -> int:
+        """ギルドの待機中 + 処理中のリクエスト数"""
+        return self._guild_counts.get(guild_id, 0)
+
+    def _has_work(self) -> bool:
+        return bool(self._guild_queues or self._low_priority_queues)
+
+    def _low_priority_overdue(self) -> bool:
+        """待ちすぎた低優先度のリクエストがあるか（次に取り出すギルドの先頭で判定）"""
+        if not self._low_priority_queues:
+            return False
+        queue = next(iter(self._low_priority_queues.values()))
+        return time.monotonic() - queue[0].enqueued_at > self.low_priority_max_wait
+
+    def _pop_next(self) -> SynthesisRequest | None:
+        """ラウンドロビンで次のリクエストを取り出す（通常 → 低優先度の順）"""
+        while self._has_work():
+            if self._guild_queues and not self._low_priority_overdue():
+                queues = self._guild_queues
+            else:
+                queues = self._low_priority_queues
+
+            guild_id, queue = next(iter(queues.items()))
+            request = queue.popleft()
+            if queue:
+                queues.move_to_end(guild_id)
+            else:
+                del queues[guild_id]
+
+            # 呼び出し側でキャンセル済みのものは飛ばす
+            if not request.future.done():
+                return request
+        return None
+
+    async def _wait_for_work(self, timeout: float | None = None) -> bool:
+        """キューにリクエストが入るまで待つ（タイムアウトしたら False）"""
+        while not self._has_work():
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    async def _next_batch(self) -> list[SynthesisRequest]:
+        """次のバッチを収集（最初の1件を待ち、その後 batch_window だけ追加を待つ）"""
+        batch: list[SynthesisRequest] = []
+        deadline = None
+
+        while len(batch) < self.max_batch_size:
+            timeout = None
+            if deadline is not None:
+                timeout = deadline - time.monotonic()
+                # 待ち時間が過ぎても、既に積まれている分はまとめる
+                if timeout <= 0 and not self._has_work():
+                    break
+            if not await self._wait_for_work(timeout):
+                break
+
+            request = self._pop_next()
+            if request is None:
+                continue
+            batch.append(request)
+            if deadline is None:
+                deadline = time.monotonic() + self.batch_window
+
+        return batch
+
+    async def _worker(self):
+        await self._backend_ready.wait()
+        while True:
+            batch = await self._next_batch()
+            if not batch:
+                continue
+
+            started_at = time.monotonic()
+            for request in batch:
+                request.timings["queue_wait"] = started_at - request.enqueued_at
+
+            def on_result(index: int, result: Any, batch=batch):
+                request = batch[index]
+                if isinstance(result, bytes) and request.cache_key:
+                    self._store_cached(request, result)
+                if self.metrics:
+                    self.metrics.record_many(request.timings, request.guild_id)
+                if self.governor and isinstance(result, bytes) and "synthesis" in request.timings:
+                    self.governor.observe(request.timings["synthesis"], audio_seconds(result))
+                if request.future.done():
+                    return
+                if isinstance(result, BaseException):
+                    request.future.set_exception(result)
+                else:
+                    request.future.set_result(result)
+
+            for request in batch:
+                self._in_flight[id(request)] = request
+            try:
+                await self.backend.run_batch(batch, on_result)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Synthesis batch error: {e}")
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+            finally:
+                for request in batch:
+                    self._in_flight.pop(id(request), None)
@@ -0,0 +1,129 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable
+
+from speaker_store import STORE_REF_PREFIX, ref_identity
+
+
+class SpeakerConditioningCache:
+    """話者ファイルごとのコンディショニングを保持するLRUキャッシュ
+
+    キーは (絶対パス, mtime, サイズ) で、ファイルが差し替えられると別エントリになる。
+    話者ストアの参照は詰め直しで位置が変わるので、位置ではなく中身のハッシュをキーにする。
+    cache_dir を指定するとディスクにも保存し、再起動後はそこから読み込む。
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 16,
+        cache_dir: str | None = None,
+        load_fn: Callable[[str], Any] | None = None,
+        save_fn: Callable[[Any, str], None] | None = None,
+    ):
+        self.max_entries = max(1, max_entries)
+        self.cache_dir = cache_dir
+        self._load_fn = load_fn
+        self._save_fn = save_fn
+        self._entries: OrderedDict[tuple, Any] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def _make_key(path: str) -> tuple:
+        """ファイルパスからキャッシュキーを作成"""
+        if path.startswith(STORE_REF_PREFIX):
+            return (ref_identity(path), 0, 0)
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        return (path, st.st_mtime_ns, st.st_size)
+
+    @staticmethod
+    def _normalize_path(path: str) -> str:
+        return ref_identity(path) if path.startswith(STORE_REF_PREFIX) else os.path.abspath(path)
+
+    @staticmethod
+    def _path_prefix(normalized_path: str) -> str:
+        return hashlib.sha1(normalized_path.encode()).hexdigest()[:16]
+
+    def _disk_path(self, key: tuple) -> str | None:
+        """ディスク上の保存先を取得"""
+        if not self.cache_dir:
+            return None
+        version = hashlib.sha1(f"{key[1]}:{key[2]}".encode()).hexdigest()[:8]
+        return os.path.join(self.cache_dir, f"{self._path_prefix(key[0])}_{version}.pt")
+
+    def _remember(self, key: tuple, value: Any):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, path: str, compute_fn: Callable[[str], Any]) -> Any:
+        """キャッシュから取得し、無ければ compute_fn で計算して保存"""
+        key = self._make_key(path)
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+
+        disk_path = self._disk_path(key)
+        if disk_path and self._load_fn and os.path.exists(disk_path):
+            try:
+                value = self._load_fn(disk_path)
+                self._remember(key, value)
+                return value
+            except Exception as e:
+                print(f"Speaker cache load error ({disk_path}): {e}")
+
+        value = compute_fn(path)
+        self._remember(key, value)
+
+        if disk_path and self._save_fn:
+            try:
+                self._save_fn(value, disk_path)
+            except Exception as e:
+                print(f"Speaker cache save error ({disk_path}): {e}")
+
+        return value
+
+    def touch(self, path: str) -> bool:
+        """メモリにあれば最近使ったことにして True を返す（統計には数えない）"""
+        key = self._make_key(path)
+        with self._lock:
+            if key not in self._entries:
+                return False
+            self._entries.move_to_end(key)
+            return True
+
+    def put(self, path: str, value: Any):
+        """計算済みの値を登録（ディスクへの保存は呼び出し側で行う）"""
+        self._remember(self._make_key(path), value)
+
+    def invalidate(self, path: str):
+        """指定した話者ファイルのエントリをメモリとディスクから削除"""
+        abspath = self._normalize_path(path)
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == abspath]:
+                del self._entries[key]
+
+        if self.cache_dir and os.path.isdir(self.cache_dir):
+            prefix = self._path_prefix(abspath) + "_"
+            for filename in os.listdir(self.cache_dir):
+                if filename.startswith(prefix):
+                    try:
+                        os.remove(os.path.join(self.cache_dir, filename))
+                    except OSError:
+                        pass
+
+    def __len__(self) -> int:
+        return len(self._entries)
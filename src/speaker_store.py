@@ -0,0 +1,221 @@
+import fcntl
+import hashlib
+import os
+import struct
+import threading
+import wave
+from contextlib import contextmanager
+from typing import Callable
+
+import numpy as np
+
+# ファイル先頭のヘッダー（マジック・サンプルレート・世代）。世代は詰め直すたびに1つ増える
+STORE_MAGIC = b"KVSPKR01"
+HEADER_FORMAT = "<8sII"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+SAMPLE_DTYPE = np.dtype("<i2")
+
+# 削除された領域がこの割合を超えたら詰め直す
+COMPACT_WASTE_RATIO = 0.25
+
+# 話者ストア内の参照音声を表す文字列（"store:<世代>:<先頭サンプル>:<サンプル数>:<ハッシュ>"）
+STORE_REF_PREFIX = "store:"
+
+
+def make_ref(generation: int, offset: int, length: int, digest: str) -> str:
+    return f"{STORE_REF_PREFIX}{generation}:{offset}:{length}:{digest}"
+
+
+def parse_ref(ref: str | None) -> tuple[int, int, int, str] | None:
+    """話者ストアの参照なら (世代, 先頭サンプル, サンプル数, ハッシュ) を返す"""
+    if not ref or not ref.startswith(STORE_REF_PREFIX):
+        return None
+    generation, offset, length, digest = ref[len(STORE_REF_PREFIX):].split(":")
+    return int(generation), int(offset), int(length), digest
+
+
+def ref_identity(ref: str) -> str:
+    """参照音声の中身を表す文字列（位置は詰め直しで変わるので、キャッシュのキーにはこちらを使う）"""
+    return f"{STORE_REF_PREFIX}{parse_ref(ref)[3]}"
+
+
+def clip_digest(samples: np.ndarray) -> str:
+    return hashlib.sha1(np.ascontiguousarray(samples, dtype=SAMPLE_DTYPE).tobytes()).hexdigest()[:16]
+
+
+class SpeakerStore:
+    """正規化済みの参照音声（モノラル・int16・モデルのサンプルレート）をまとめた1つのファイル
+
+    登録時に追記するだけで、各話者の位置・長さ・ハッシュ・世代は DB の speaker_clips テーブルが持つ。
+    読み出しは memmap のスライスなので、デコードもコピーも行わない。
+    削除した話者の領域は compact() で詰める（他のプロセスが追記しないよう flock で排他）。
+    参照には世代とハッシュを含め、詰め直し前の参照で別の話者の音声を読むことはない。
+    """
+
+    def __init__(self, path: str, sample_rate: int = 24000, max_bytes: int = 0):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._mmap: np.memmap | None = None
+        self._mapped_stat: tuple[int, int] | None = None
+        self._mapped_generation = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._file_lock():
+            if not os.path.exists(path) or os.path.getsize(path) == 0:
+                self._write_header(path)
+        self._check_header()
+
+    def _write_header(self, path: str, generation: int = 0):
+        with open(path, "wb") as f:
+            f.write(struct.pack(HEADER_FORMAT, STORE_MAGIC, self.sample_rate, generation))
+
+    @staticmethod
+    def _read_header(path: str) -> tuple[bytes, int, int]:
+        """(マジック, サンプルレート, 世代)"""
+        with open(path, "rb") as f:
+            return struct.unpack(HEADER_FORMAT, f.read(HEADER_SIZE))
+
+    def _check_header(self):
+        magic, sample_rate, _ = self._read_header(self.path)
+        if magic != STORE_MAGIC:
+            raise ValueError(f"話者ストアの形式が不正です: {self.path}")
+        if sample_rate != self.sample_rate:
+            raise ValueError(
+                f"話者ストアのサンプルレートが異なります: {sample_rate} (expected {self.sample_rate})"
+            )
+
+    @contextmanager
+    def _file_lock(self):
+        """プロセス間の排他（追記・詰め直し用）"""
+        with open(self.path + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @property
+    def size_bytes(self) -> int:
+        return os.path.getsize(self.path)
+
+    @property
+    def generation(self) -> int:
+        return self._read_header(self.path)[2]
+
+    def _mapped(self) -> np.memmap | None:
+        """ファイルの memmap（追記や詰め直しでファイルが変わっていれば張り直す）"""
+        st = os.stat(self.path)
+        stat_key = (st.st_ino, st.st_size)
+        with self._lock:
+            if stat_key != self._mapped_stat:
+                self._mapped_generation = self._read_header(self.path)[2]
+                samples = (st.st_size - HEADER_SIZE) // SAMPLE_DTYPE.itemsize
+                self._mmap = (
+                    np.memmap(self.path, dtype=SAMPLE_DTYPE, mode="r", offset=HEADER_SIZE, shape=(samples,))
+                    if samples > 0 else None
+                )
+                self._mapped_stat = stat_key
+            return self._mmap
+
+    def read(self, offset: int, length: int) -> np.ndarray:
+        """参照音声をint16のスライスで返す（コピーしない）"""
+        mapped = self._mapped()
+        if mapped is None or offset < 0 or offset + length > len(mapped):
+            raise ValueError(f"話者ストアの範囲外です: {offset}+{length}")
+        return mapped[offset:offset + length]
+
+    def read_ref(self, ref: str) -> np.ndarray:
+        """参照の音声を返す（詰め直し前の参照や中身の違う参照はエラー）"""
+        generation, offset, length, digest = parse_ref(ref)
+        clip = self.read(offset, length)
+        if generation != self._mapped_generation or clip_digest(clip) != digest:
+            raise ValueError(f"話者ストアの参照が古くなっています: {ref}")
+        return clip
+
+    def digest(self, offset: int, length: int) -> str:
+        """格納済みの参照音声のハッシュ（ハッシュを持たない古い登録の補完用）"""
+        return clip_digest(self.read(offset, length))
+
+    def append(self, samples: np.ndarray) -> tuple[int, int, str, int]:
+        """参照音声を追記し、(先頭サンプル, サンプル数, ハッシュ, 世代) を返す"""
+        data = np.ascontiguousarray(samples, dtype=SAMPLE_DTYPE).tobytes()
+        with self._file_lock():
+            size = self.size_bytes
+            if self.max_bytes and size + len(data) > self.max_bytes:
+                raise ValueError("話者ストアの容量上限に達しています")
+            generation = self.generation
+            with open(self.path, "ab") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        offset = (size - HEADER_SIZE) // SAMPLE_DTYPE.itemsize
+        return offset, len(samples), clip_digest(samples), generation
+
+    def append_wav(self, wav_path: str) -> tuple[int, int, str, int]:
+        """正規化済みのWAV（モノラル・16bit・ストアと同じサンプルレート）を追記"""
+        with wave.open(wav_path, "rb") as w:
+            if w.getnchannels() != 1 or w.getsampwidth() != 2 or w.getframerate() != self.sample_rate:
+                raise ValueError(f"話者ストアに追加できない形式です: {wav_path}")
+            samples = np.frombuffer(w.readframes(w.getnframes()), dtype=SAMPLE_DTYPE)
+        if len(samples) == 0:
+            raise ValueError("音声が含まれていません")
+        return self.append(samples)
+
+    def wasted_bytes(self, clips: dict[int, tuple[int, int]]) -> int:
+        """どの話者からも参照されていない領域のバイト数"""
+        used = sum(length for _, length in clips.values()) * SAMPLE_DTYPE.itemsize
+        return max(0, self.size_bytes - HEADER_SIZE - used)
+
+    def needs_compaction(self, clips: dict[int, tuple[int, int]]) -> bool:
+        wasted = self.wasted_bytes(clips)
+        return wasted > 0 and wasted >= self.size_bytes * COMPACT_WASTE_RATIO
+
+    def compact(
+        self,
+        clips: dict[int, tuple[int, int]],
+        commit: Callable[[dict[int, tuple[int, int]], int], None],
+    ) -> dict[int, tuple[int, int]]:
+        """参照されている音声だけを次の世代のファイルに詰め直し、新しい位置を返す
+
+        clips は {話者ID: (先頭サンプル, サンプル数)}。新しいファイルを書き終えたら
+        commit(新しい位置, 世代) で DB を更新し、その後でファイルを置き換える。
+        DB の更新を確定点とし、途中で止まった場合は次回起動時に recover() で揃える。
+        """
+        tmp_path = self.path + ".tmp"
+        moved: dict[int, tuple[int, int]] = {}
+        with self._file_lock():
+            generation = self.generation + 1
+            self._write_header(tmp_path, generation)
+            offset = 0
+            with open(tmp_path, "ab") as f:
+                for speaker_id, (old_offset, length) in sorted(clips.items(), key=lambda c: c[1][0]):
+                    f.write(self.read(old_offset, length).tobytes())
+                    moved[speaker_id] = (offset, length)
+                    offset += length
+                f.flush()
+                os.fsync(f.fileno())
+            commit(moved, generation)
+            os.replace(tmp_path, self.path)
+        return moved
+
+    def recover(self, committed_generation: int | None):
+        """詰め直しの途中で止まったファイルを DB に記録された世代に揃える
+
+        DB が新しい世代を記録済みなら書き終えた一時ファイルで置き換え、そうでなければ一時ファイルを捨てる。
+        """
+        tmp_path = self.path + ".tmp"
+        if not os.path.exists(tmp_path):
+            return
+        with self._file_lock():
+            try:
+                magic, _, tmp_generation = self._read_header(tmp_path)
+            except (OSError, struct.error):
+                magic, tmp_generation = b"", -1
+            if magic == STORE_MAGIC and tmp_generation == committed_generation != self.generation:
+                os.replace(tmp_path, self.path)
+                print(f"Speaker store: finished interrupted compaction (generation {tmp_generation})")
+            else:
+                os.remove(tmp_path)
@@ -0,0 +1,492 @@
+"""合成サービス（シンセサイザーのエンジンをHTTPで提供する別プロセス）
+
+Discord側（シャード）と推論側を分けて、それぞれ独立に台数を増やすために使う。
+
+    python src/synthesis_service.py --port 8765
+    python src/synthesis_service.py --unix-socket /tmp/kero-tts.sock
+    python src/synthesis_service.py --stub --port 8765   # モデル無しで動作確認
+
+エンドポイント:
+    POST /synthesize        {"text", "speaker_wav", "conds_path", "language", "guild_id", "user_id", "low_priority", "params"}
+                            → PCM（48kHzステレオs16le）または Opus パケット列、X-Timings ヘッダーに区間時間
+    POST /prepare_speaker   {"src_path", "wav_path", "conds_path"}
+    POST /prefetch_speaker  {"speaker_wav", "conds_path"}
+    POST /invalidate_speaker {"speaker_wav"}
+    GET  /health            {"ready", "pending", "format"}
+
+話者ファイルのパスや話者ストアの参照はそのまま渡すので、Botとサービスで同じファイルシステム（共有ボリューム）を見ている必要がある。
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from dataclasses import dataclass
+from typing import Any, Callable
+
+import aiohttp
+from aiohttp import web
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BASE_DIR)
+
+from scheduler import InProcessBackend, QueueFullError, SynthesisRequest, SynthesisScheduler
+
+
+# =====================
+# Server
+# =====================
+class SynthesisService:
+    """シンセサイザーをHTTPで提供する
+
+    受け付けたリクエストは SynthesisScheduler でギルドごとにラウンドロビンしてバッチ処理する。
+    クライアントが切断したリクエストはキャンセルされ、未着手なら生成しない。
+    """
+
+    def __init__(self, batch_window: float = 0.0, max_batch_size: int = 4, audio_format: str = "pcm"):
+        # シンセサイザーは読み込み完了後に set_synthesizer() で設定する
+        self.synth = None
+        # 返す音声の形式（"pcm" / "opus"）。Bot側の設定と一致しないサービスには振り分けられない
+        self.audio_format = audio_format
+        self.scheduler = SynthesisScheduler(
+            None,
+            batch_window=batch_window,
+            max_batch_size=max_batch_size,
+            # 上限はBot側で管理する
+            max_pending_per_guild=10_000,
+            max_pending_per_user=10_000,
+        )
+
+    def set_synthesizer(self, synth):
+        self.synth = synth
+        self.scheduler.set_backend(InProcessBackend(synth))
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/synthesize", self.handle_synthesize)
+        app.router.add_post("/prepare_speaker", self.handle_prepare_speaker)
+        app.router.add_post("/prefetch_speaker", self.handle_prefetch_speaker)
+        app.router.add_post("/invalidate_speaker", self.handle_invalidate_speaker)
+        app.router.add_get("/health", self.handle_health)
+        return app
+
+    async def handle_synthesize(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        synthesis_request = SynthesisRequest(
+            text=data["text"],
+            speaker_wav=data.get("speaker_wav"),
+            conds_path=data.get("conds_path"),
+            language=data.get("language", "ja"),
+            guild_id=data.get("guild_id", 0),
+            user_id=data.get("user_id", 0),
+            low_priority=data.get("low_priority", False),
+            params=tuple(tuple(p) for p in data.get("params", ())),
+        )
+        try:
+            # 切断されるとこの await ごとキャンセルされ、スケジューラーも生成を飛ばす
+            pcm = await self.scheduler.submit(synthesis_request)
+        except QueueFullError as e:
+            return web.json_response({"error": str(e)}, status=429)
+        except Exception as e:
+            return web.json_response({"error": f"{type(e).__name__}: {e}"}, status=500)
+
+        return web.Response(
+            body=pcm,
+            content_type="application/octet-stream",
+            headers={"X-Timings": json.dumps(synthesis_request.timings)},
+        )
+
+    async def handle_prepare_speaker(self, request: web.Request) -> web.Response:
+        if self.synth is None:
+            return web.json_response({"error": "not ready"}, status=503)
+        data = await request.json()
+        try:
+            await asyncio.to_thread(
+                self.synth.prepare_speaker, data["src_path"], data["wav_path"], data["conds_path"]
+            )
+        except Exception as e:
+            return web.json_response({"error": f"{type(e).__name__}: {e}"}, status=500)
+        return web.json_response({"ok": True})
+
+    async def handle_prefetch_speaker(self, request: web.Request) -> web.Response:
+        if self.synth is None:
+            return web.json_response({"error": "not ready"}, status=503)
+        data = await request.json()
+        loaded = await asyncio.to_thread(
+            self.synth.prefetch_speaker, data["speaker_wav"], data.get("conds_path")
+        )
+        return web.json_response({"loaded": loaded})
+
+    async def handle_invalidate_speaker(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        if self.synth is not None:
+            self.synth.invalidate_speaker(data["speaker_wav"])
+        return web.json_response({"ok": True})
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "ready": self.scheduler.ready,
+            "pending": self.scheduler.pending,
+            "format": self.audio_format,
+        })
+
+
+# =====================
+# Client
+# =====================
+class ServiceError(Exception):
+    """合成サービスがエラーを返した"""
+
+
+@dataclass
+class ServiceEndpoint:
+    """合成サービス1台分の接続先と状態"""
+    url: str
+    session: aiohttp.ClientSession | None = None
+    in_flight: int = 0
+    served: int = 0
+    ready: bool = False
+    down_until: float = 0.0
+    format_mismatch: bool = False
+
+    @property
+    def available(self) -> bool:
+        return self.ready and time.monotonic() >= self.down_until
+
+
+class RemoteBackend:
+    """複数の合成サービスに振り分けるバックエンド
+
+    接続先は "http://host:port" または "unix:/path/to.sock"。
+    接続先ごとにコネクションプールを持ち、処理中の件数が最も少ないサービスに送る。
+    接続できなかったサービスは retry_after 秒だけ振り分け先から外す。
+    別のサービスで再試行するのはリクエストが届いていないとわかる場合（接続失敗・503）だけで、
+    送信後のタイムアウトや切断は再試行しない（サービス側で合成が進んでいると二重に合成してしまう）。
+    """
+
+    def __init__(
+        self,
+        urls: list[str],
+        max_connections: int = 8,
+        timeout: float = 120.0,
+        connect_timeout: float = 3.0,
+        retry_after: float = 5.0,
+        audio_format: str = "pcm",
+    ):
+        if not urls:
+            raise ValueError("synthesis service URL is required")
+        self.endpoints = [ServiceEndpoint(url.rstrip("/")) for url in urls]
+        self.max_connections = max_connections
+        # 接続は短いタイムアウトで見切り、別のサービスに回す
+        self.timeout = aiohttp.ClientTimeout(total=timeout, sock_connect=connect_timeout)
+        self.retry_after = retry_after
+        self.audio_format = audio_format
+        # 話者キャッシュの破棄の通知（完了まで参照を保持する）
+        self._notify_tasks: set[asyncio.Task] = set()
+
+    def _session(self, endpoint: ServiceEndpoint) -> aiohttp.ClientSession:
+        if endpoint.session is None or endpoint.session.closed:
+            if endpoint.url.startswith("unix:"):
+                connector = aiohttp.UnixConnector(path=endpoint.url[5:], limit=self.max_connections)
+            else:
+                connector = aiohttp.TCPConnector(limit=self.max_connections)
+            endpoint.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return endpoint.session
+
+    @staticmethod
+    def _base_url(endpoint: ServiceEndpoint) -> str:
+        return "http://localhost" if endpoint.url.startswith("unix:") else endpoint.url
+
+    @property
+    def ready_count(self) -> int:
+        return sum(1 for e in self.endpoints if e.available)
+
+    async def check_health(self):
+        """各サービスの準備状況を確認"""
+        async def check(endpoint: ServiceEndpoint):
+            try:
+                async with self._session(endpoint).get(
+                    f"{self._base_url(endpoint)}/health",
+                    timeout=aiohttp.ClientTimeout(total=5),
+                ) as response:
+                    health = await response.json()
+                # 音声の形式が違うサービスは使わない（PCMとOpusが混ざると再生できない）
+                mismatch = health.get("format", "pcm") != self.audio_format
+                if mismatch and not endpoint.format_mismatch:
+                    print(
+                        f"Synthesis service {endpoint.url} returns {health.get('format', 'pcm')} audio, "
+                        f"expected {self.audio_format}"
+                    )
+                endpoint.format_mismatch = mismatch
+                endpoint.ready = health.get("ready", False) and not mismatch
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                endpoint.ready = False
+
+        await asyncio.gather(*(check(e) for e in self.endpoints))
+
+    async def wait_ready(self, interval: float = 2.0):
+        """いずれかのサービスが準備できるまで待つ"""
+        while True:
+            await self.check_health()
+            if self.ready_count:
+                return
+            await asyncio.sleep(interval)
+
+    async def monitor(self, interval: float = 10.0):
+        """定期的に準備状況を確認し、後から起動・復旧したサービスにも振り分ける"""
+        while True:
+            await asyncio.sleep(interval)
+            await self.check_health()
+
+    def _pick(self, exclude: set[int]) -> ServiceEndpoint | None:
+        """処理中の件数が最も少ない（同数なら処理数が少ない）サービスを選ぶ"""
+        candidates = [
+            e for e in self.endpoints if id(e) not in exclude and e.available
+        ]
+        if not candidates:
+            # 全滅している場合は停止中のものも含めて試す
+            candidates = [e for e in self.endpoints if id(e) not in exclude]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda e: (e.in_flight, e.served))
+
+    async def _post(self, path: str, payload: dict, handle: Callable) -> Any:
+        """リクエストを送り、接続できなければ別のサービスで再試行する
+
+        送信後にタイムアウト・切断した場合は、そのサービスで処理中かもしれないので再試行しない。
+        """
+        tried: set[int] = set()
+        last_error: Exception | None = None
+        while (endpoint := self._pick(tried)) is not None:
+            tried.add(id(endpoint))
+            endpoint.in_flight += 1
+            try:
+                async with self._session(endpoint).post(
+                    f"{self._base_url(endpoint)}{path}", json=payload
+                ) as response:
+                    if response.status == 503:
+                        endpoint.ready = False
+                        last_error = ServiceError(f"{endpoint.url} is not ready")
+                        continue
+                    result = await handle(response)
+                    endpoint.served += 1
+                    return result
+            except (aiohttp.ClientConnectorError, aiohttp.ConnectionTimeoutError) as e:
+                # 接続できていないのでリクエストは届いていない
+                print(f"Synthesis service {endpoint.url} unavailable: {e}")
+                endpoint.down_until = time.monotonic() + self.retry_after
+                last_error = e
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                print(f"Synthesis service {endpoint.url} failed after sending {path}: {e!r}")
+                endpoint.down_until = time.monotonic() + self.retry_after
+                raise ServiceError(f"{endpoint.url} did not respond") from e
+            finally:
+                endpoint.in_flight -= 1
+        raise last_error or ServiceError("no synthesis service available")
+
+    async def _synthesize(self, request: SynthesisRequest) -> bytes:
+        async def handle(response: aiohttp.ClientResponse) -> bytes:
+            if response.status != 200:
+                error = (await response.json()).get("error", response.reason)
+                raise QueueFullError(error) if response.status == 429 else ServiceError(error)
+            timings = json.loads(response.headers.get("X-Timings", "{}"))
+            # サービス側の待ち時間はBot側の待ち時間に足す
+            timings["queue_wait"] = request.timings.get("queue_wait", 0.0) + timings.get("queue_wait", 0.0)
+            request.timings.update(timings)
+            return await response.read()
+
+        return await self._post("/synthesize", {
+            "text": request.text,
+            "speaker_wav": request.speaker_wav,
+            "conds_path": request.conds_path,
+            "language": request.language,
+            "guild_id": request.guild_id,
+            "user_id": request.user_id,
+            "low_priority": request.low_priority,
+            "params": request.params,
+        }, handle)
+
+    async def run_batch(
+        self,
+        requests: list[SynthesisRequest],
+        on_result: Callable[[int, Any], None],
+    ) -> None:
+        """バッチの各リクエストを並列にサービスへ送り、完了した順に結果を返す"""
+        async def run(index: int, request: SynthesisRequest):
+            try:
+                result = await self._synthesize(request)
+            except asyncio.CancelledError:
+                return
+            except Exception as e:
+                result = e
+            on_result(index, result)
+
+        tasks = [asyncio.create_task(run(i, r)) for i, r in enumerate(requests)]
+        for request, task in zip(requests, tasks):
+            # リクエストが取り消されたら接続を切り、サービス側でも生成を飛ばさせる
+            request.future.add_done_callback(
+                lambda f, task=task: task.cancel() if f.cancelled() else None
+            )
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def prepare_speaker(self, src_path: str, wav_path: str, conds_path: str):
+        """話者登録の前処理をいずれかのサービスで実行（結果は共有ファイルに保存される）"""
+        async def handle(response: aiohttp.ClientResponse):
+            if response.status != 200:
+                raise ServiceError((await response.json()).get("error", response.reason))
+
+        await self._post("/prepare_speaker", {
+            "src_path": src_path,
+            "wav_path": wav_path,
+            "conds_path": conds_path,
+        }, handle)
+
+    async def prefetch_speaker(self, speaker_wav: str, conds_path: str | None):
+        """準備のできている全サービスにコンディショニングを読み込ませる（どこで合成するかは未定のため）"""
+        async def prefetch(endpoint: ServiceEndpoint):
+            try:
+                async with self._session(endpoint).post(
+                    f"{self._base_url(endpoint)}/prefetch_speaker",
+                    json={"speaker_wav": speaker_wav, "conds_path": conds_path},
+                ):
+                    pass
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"Failed to prefetch speaker on {endpoint.url}: {e}")
+
+        await asyncio.gather(*(prefetch(e) for e in self.endpoints if e.available))
+
+    def invalidate_speaker(self, speaker_wav: str):
+        """全サービスに話者キャッシュの破棄を通知"""
+        async def notify(endpoint: ServiceEndpoint):
+            try:
+                async with self._session(endpoint).post(
+                    f"{self._base_url(endpoint)}/invalidate_speaker",
+                    json={"speaker_wav": speaker_wav},
+                ):
+                    pass
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"Failed to invalidate speaker on {endpoint.url}: {e}")
+
+        for endpoint in self.endpoints:
+            task = asyncio.create_task(notify(endpoint))
+            self._notify_tasks.add(task)
+            task.add_done_callback(self._notify_tasks.discard)
+
+    async def close(self):
+        for endpoint in self.endpoints:
+            if endpoint.session is not None:
+                await endpoint.session.close()
+
+
+# =====================
+# Entry point
+# =====================
+def load_synthesizer(args: argparse.Namespace):
+    """シンセサイザーを読み込んでウォームアップする（ブロッキング）"""
+    if args.stub:
+        from fake_synth import FakeSynthesizer
+        synth = FakeSynthesizer(rtf=args.stub_rtf, opus_bitrate=args.opus_bitrate)
+    else:
+        from engines import create_synthesizer, parse_engine_routes
+        from governor import parse_tiers
+        synth = create_synthesizer(
+            dict(
+                device=args.device,
+                speaker_cache_size=args.speaker_cache_size,
+                speaker_cache_dir=args.speaker_cache_dir,
+                compile_model=args.compile,
+                quantize=args.quantize,
+                num_threads=args.num_threads,
+                interop_threads=args.interop_threads,
+                speaker_store_path=args.speaker_store,
+                opus_bitrate=args.opus_bitrate,
+            ),
+            routes=parse_engine_routes(args.engines),
+            default_engine=args.default_engine,
+            # Bot側の品質の段階で指定されうるエンジン
+            engines=[tier.engine for tier in parse_tiers(args.quality_tiers) if tier.engine],
+            idle_timeout=args.engine_idle_timeout,
+            memory_budget_mb=args.engine_memory_mb,
+        )
+    print(f"TTS warm-up finished in {synth.warmup():.1f}s")
+    return synth
+
+
+async def serve(args: argparse.Namespace):
+    service = SynthesisService(
+        batch_window=args.batch_window_ms / 1000,
+        max_batch_size=args.max_batch_size,
+        audio_format="opus" if args.opus_bitrate > 0 else "pcm",
+    )
+    service.scheduler.start()
+    # aiohttp 3.9 以降は既定で切断時にハンドラーをキャンセルしないので明示する
+    runner = web.AppRunner(service.create_app(), handler_cancellation=True)
+    await runner.setup()
+    if args.unix_socket:
+        site = web.UnixSite(runner, args.unix_socket)
+    else:
+        site = web.TCPSite(runner, args.host, args.port)
+    await site.start()
+    print(f"Synthesis service listening on {site.name}")
+
+    # 先に待ち受けを始め、モデルはバックグラウンドで読み込む（/health で ready になる）
+    service.set_synthesizer(await asyncio.to_thread(load_synthesizer, args))
+    print("Synthesis service ready")
+    await asyncio.Event().wait()
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="kero-voice の合成サービス")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--unix-socket", default=None, help="TCPの代わりにUnixソケットで待ち受ける")
+    parser.add_argument("--stub", action="store_true", help="モデルを読み込まずに正弦波を返す（動作確認用）")
+    parser.add_argument("--stub-rtf", type=float, default=0.3)
+    parser.add_argument("--device", default=None)
+    parser.add_argument("--speaker-cache-size", type=int, default=int(os.getenv("SPEAKER_CACHE_SIZE", "16")))
+    parser.add_argument("--speaker-cache-dir", default=os.getenv("SPEAKER_CACHE_DIR") or None)
+    parser.add_argument(
+        "--speaker-store",
+        default=os.getenv("SPEAKER_STORE_PATH") or os.path.join(BASE_DIR, "audiofiles", "speakers.bin"),
+        help="話者ストアのファイル（Botと同じファイルを指定）",
+    )
+    parser.add_argument(
+        "--opus-bitrate",
+        type=int,
+        default=int(os.getenv("TTS_OPUS_BITRATE", "0")),
+        help="Opusにエンコードして返すビットレート（kbps、0ならPCM。Botと同じ値にする）",
+    )
+    parser.add_argument("--engines", default=os.getenv("TTS_ENGINES", ""), help="言語ごとのエンジン（言語:エンジン,...）")
+    parser.add_argument("--default-engine", default=os.getenv("TTS_DEFAULT_ENGINE", "chatterbox"))
+    parser.add_argument(
+        "--quality-tiers",
+        default=os.getenv("TTS_QUALITY_TIERS", ""),
+        help="Botと同じ品質の段階（エンジンの指定があれば読み込めるようにする）",
+    )
+    parser.add_argument(
+        "--engine-idle-timeout",
+        type=float,
+        default=float(os.getenv("TTS_ENGINE_IDLE_TIMEOUT", "600")),
+        help="使われていないエンジンを解放するまでの秒数（0で解放しない）",
+    )
+    parser.add_argument(
+        "--engine-memory-mb",
+        type=int,
+        default=int(os.getenv("TTS_ENGINE_MEMORY_MB", "0")),
+        help="読み込んだエンジンのメモリの上限（MB、0で無制限）",
+    )
+    parser.add_argument("--compile", action="store_true", default=os.getenv("TTS_COMPILE", "0") == "1")
+    parser.add_argument("--quantize", action="store_true", default=os.getenv("TTS_QUANTIZE", "0") == "1")
+    parser.add_argument("--num-threads", type=int, default=int(os.getenv("TTS_NUM_THREADS", "0")))
+    parser.add_argument("--interop-threads", type=int, default=int(os.getenv("TTS_INTEROP_THREADS", "0")))
+    parser.add_argument("--batch-window-ms", type=int, default=int(os.getenv("TTS_BATCH_WINDOW_MS", "0")))
+    parser.add_argument("--max-batch-size", type=int, default=int(os.getenv("TTS_MAX_BATCH_SIZE", "4")))
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(serve(parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -1,11 +1,116 @@
 import psutil
+import shutil
 import subprocess
+import threading
+import time
+from collections import deque
 from typing import Optional
 
+try:
+    import pynvml
+except ImportError:  # NVMLバインディングが無い環境では nvidia-smi を使う
+    pynvml = None
+
+
+class SystemSampler:
+    """CPU/GPU/メモリをバックグラウンドスレッドで定期的に取得するサンプラー
+
+    取得結果はリングバッファに保持し、latest() はI/Oなしで最新の値を返す。
+    GPUはNVMLが使えればNVML、無ければ nvidia-smi で取得する。
+    """
+
+    def __init__(self, interval: float = 1.0, history: int = 300):
+        self.interval = interval
+        self.samples: deque[dict] = deque(maxlen=history)
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._nvml_handle = None
+        self._has_nvidia_smi = shutil.which("nvidia-smi") is not None
+
+    def start(self):
+        """サンプリングを開始（開始済みなら何もしない）"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._init_nvml()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="system-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _init_nvml(self):
+        if pynvml is None:
+            return
+        try:
+            pynvml.nvmlInit()
+            self._nvml_handle = pynvml.nvmlDeviceGetHandleByIndex(0)
+        except Exception:
+            self._nvml_handle = None
+
+    def _sample_gpu(self) -> Optional[dict]:
+        if self._nvml_handle is not None:
+            try:
+                name = pynvml.nvmlDeviceGetName(self._nvml_handle)
+                if isinstance(name, bytes):
+                    name = name.decode()
+                mem = pynvml.nvmlDeviceGetMemoryInfo(self._nvml_handle)
+                util = pynvml.nvmlDeviceGetUtilizationRates(self._nvml_handle)
+                return {
+                    "name": name,
+                    "total_memory": mem.total,
+                    "used": mem.used,
+                    "percent": (mem.used / mem.total * 100) if mem.total > 0 else 0,
+                    "gpu_util": float(util.gpu)
+                }
+            except Exception:
+                return None
+
+        # nvidia-smi が無い環境では呼び出さない
+        if not self._has_nvidia_smi:
+            return None
+        return SystemMonitor.get_gpu_info()
+
+    def sample(self) -> dict:
+        """現在の値を取得してバッファに追加"""
+        mem = psutil.virtual_memory()
+        snapshot = {
+            "timestamp": time.time(),
+            "cpu_percent": SystemMonitor.get_cpu_usage(),
+            "cpu_count": SystemMonitor.get_cpu_count(),
+            "memory": {"total": mem.total, "used": mem.used, "percent": mem.percent},
+            "gpu": self._sample_gpu(),
+        }
+        self.samples.append(snapshot)
+        return snapshot
+
+    def latest(self) -> Optional[dict]:
+        """最新のサンプルを取得"""
+        return self.samples[-1] if self.samples else None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.sample()
+            except Exception as e:
+                print(f"System sampler error: {e}")
+            self._stop.wait(self.interval)
+
 
 class SystemMonitor:
     """システムリソースの監視クラス"""
 
+    # バックグラウンドのサンプラー（start_sampler で開始）
+    sampler: Optional[SystemSampler] = None
+
+    @classmethod
+    def start_sampler(cls, interval: float = 1.0) -> SystemSampler:
+        """バックグラウンドのサンプラーを開始"""
+        if cls.sampler is None:
+            cls.sampler = SystemSampler(interval=interval)
+        cls.sampler.start()
+        return cls.sampler
+
     @staticmethod
     def get_cpu_usage() -> float:
         """CPU使用率を取得 (%)"""
@@ -72,8 +177,8 @@ class SystemMonitor:
         return f"[{'█' * filled}{'░' * empty}]{percent:6.1f}%"
 
     @classmethod
-    def generate_status_message(cls) -> str:
-        """ステータスメッセージを生成"""
+    def generate_status_message(cls, tts_status: Optional[str] = None, quality: Optional[str] = None) -> str:
+        """ステータスメッセージを生成（tts_status があればTTSの準備状況、quality があれば品質の段階も表示）"""
         W = 44  # 内側の幅
 
         lines = []
@@ -82,15 +187,42 @@ class SystemMonitor:
         lines.append("║" + "SYSTEM STATUS".center(W) + "║")
         lines.append("╠" + "═" * W + "╣")
 
+        # TTSの準備状況
+        if tts_status:
+            lines.append("║" + " TTS".ljust(W) + "║")
+            lines.append("║" + f"   {tts_status}"[:W].ljust(W) + "║")
+            if quality:
+                lines.append("║" + f"   Quality: {quality}"[:W].ljust(W) + "║")
+            lines.append("╠" + "═" * W + "╣")
+
+        # サンプラーが動いていれば最新の値を使う（I/Oなし）
+        snapshot = cls.sampler.latest() if cls.sampler else None
+        if snapshot is None:
+            snapshot = {
+                "cpu_percent": cls.get_cpu_usage(),
+                "cpu_count": cls.get_cpu_count(),
+                "memory": None,
+                "gpu": cls.get_gpu_info(),
+            }
+
         # CPU情報
-        cpu_percent = cls.get_cpu_usage()
-        physical, logical = cls.get_cpu_count()
+        cpu_percent = snapshot["cpu_percent"]
+        physical, logical = snapshot["cpu_count"]
         lines.append("║" + " CPU".ljust(W) + "║")
         lines.append("║" + f"   Cores: {physical}P / {logical}L".ljust(W) + "║")
         lines.append("║" + f"   {cls.create_bar(cpu_percent)}".ljust(W) + "║")
 
+        # メモリ情報
+        mem = snapshot["memory"]
+        if mem:
+            lines.append("╠" + "═" * W + "╣")
+            lines.append("║" + " MEMORY".ljust(W) + "║")
+            ram_info = f"   RAM:  {cls.format_bytes(mem['used'])} / {cls.format_bytes(mem['total'])}"
+            lines.append("║" + ram_info.ljust(W) + "║")
+            lines.append("║" + f"   {cls.create_bar(mem['percent'])}".ljust(W) + "║")
+
         # GPU情報（利用可能な場合）
-        gpu = cls.get_gpu_info()
+        gpu = snapshot["gpu"]
         if gpu:
             lines.append("╠" + "═" * W + "╣")
             lines.append("║" + " GPU".ljust(W) + "║")
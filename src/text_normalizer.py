@@ -0,0 +1,126 @@
+import re
+import threading
+import unicodedata
+from functools import lru_cache
+
+# Discord固有の記法
+USER_MENTION_PATTERN = re.compile(r"<@!?(\d+)>")
+ROLE_MENTION_PATTERN = re.compile(r"<@&(\d+)>")
+CHANNEL_MENTION_PATTERN = re.compile(r"<#(\d+)>")
+CUSTOM_EMOJI_PATTERN = re.compile(r"<a?:(\w+):\d+>")
+TIMESTAMP_PATTERN = re.compile(r"<t:\d+(?::[tTdDfFR])?>")
+
+# Markdown
+CODE_BLOCK_PATTERN = re.compile(r"```.*?(?:```|$)", re.DOTALL)
+INLINE_CODE_PATTERN = re.compile(r"`([^`\n]*)`")
+MARKDOWN_LINK_PATTERN = re.compile(r"\[([^\]\n]+)\]\(\s*<?https?://[^)\s]+>?\s*\)")
+SPOILER_PATTERN = re.compile(r"\|\|.+?\|\|", re.DOTALL)
+EMPHASIS_PATTERN = re.compile(r"(\*{1,3}|_{2}|~~)(.+?)\1", re.DOTALL)
+LINE_PREFIX_PATTERN = re.compile(r"^\s*(?:>{1,3}|#{1,3}|-#|[-*]|\d+\.)\s+", re.MULTILINE)
+
+URL_PATTERN = re.compile(r"https?://\S+|www\.\S+")
+# 「ｗｗｗ」などの笑い（英単語の一部は除く）
+LAUGH_PATTERN = re.compile(r"(?<![A-Za-z])[wW]{2,}(?![A-Za-z])")
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+class TextNormalizer:
+    """読み上げ前のテキスト正規化
+
+    メンション・チャンネル・カスタム絵文字を短い名前に置き換え、URLやコードブロックを省略し、
+    Markdownの記号と繰り返し文字を取り除いてから、ギルドごとの辞書を適用する。
+    辞書の単語にも同じ正規化をかけ、大文字・小文字を区別せずに照合する。
+    メンションの解決以外の処理は (テキスト, ギルド, 辞書の版) をキーにメモ化する。
+    """
+
+    def __init__(
+        self,
+        cache_size: int = 1024,
+        max_repeat: int = 3,
+        url_word: str = "URL省略",
+        code_word: str = "コード省略",
+        spoiler_word: str = "伏せ字",
+        laugh_word: str = "わら",
+    ):
+        self.max_repeat = max(1, max_repeat)
+        self.url_word = url_word
+        self.code_word = code_word
+        self.spoiler_word = spoiler_word
+        self.laugh_word = laugh_word
+        # 数字と英字は繰り返しを縮めない（「1000000円」や英単語を変えない）
+        self.repeat_pattern = re.compile(r"([^\dA-Za-z])\1{%d,}" % self.max_repeat, re.DOTALL)
+
+        # ギルドごとの辞書（置換パターン・版）
+        self._dictionaries: dict[int, tuple[re.Pattern | None, dict[str, str]]] = {}
+        self._versions: dict[int, int] = {}
+        self._lock = threading.Lock()
+        self._normalize_cached = lru_cache(maxsize=cache_size)(self._normalize)
+
+    def set_dictionary(self, guild_id: int, entries: dict[str, str]):
+        """ギルドの辞書を設定（長い単語から優先して置換する）
+
+        本文は NFKC・笑い・繰り返しの正規化後に辞書を引くので、単語も同じように正規化する。
+        """
+        normalized: dict[str, str] = {}
+        for word, reading in entries.items():
+            key = self._normalize_word(word)
+            if key:
+                normalized[key.lower()] = reading
+        pattern = None
+        if normalized:
+            words = sorted(normalized, key=len, reverse=True)
+            pattern = re.compile("|".join(re.escape(word) for word in words), re.IGNORECASE)
+        with self._lock:
+            self._dictionaries[guild_id] = (pattern, normalized)
+            self._versions[guild_id] = self._versions.get(guild_id, 0) + 1
+
+    def _normalize_word(self, text: str) -> str:
+        """NFKC・笑い・繰り返しの正規化（本文と辞書の単語で共通）"""
+        text = unicodedata.normalize("NFKC", text)
+        text = LAUGH_PATTERN.sub(self.laugh_word, text)
+        return self.repeat_pattern.sub(lambda m: m.group(1) * self.max_repeat, text)
+
+    def resolve_mentions(self, text: str, names: dict[int, str] | None = None) -> str:
+        """メンション・チャンネル・カスタム絵文字を名前に置き換える"""
+        names = names or {}
+
+        def lookup(default: str):
+            return lambda m: names.get(int(m.group(1)), default)
+
+        text = USER_MENTION_PATTERN.sub(lookup("メンション"), text)
+        text = ROLE_MENTION_PATTERN.sub(lookup("ロール"), text)
+        text = CHANNEL_MENTION_PATTERN.sub(lookup("チャンネル"), text)
+        text = CUSTOM_EMOJI_PATTERN.sub(lambda m: m.group(1), text)
+        return TIMESTAMP_PATTERN.sub("", text)
+
+    def normalize(self, text: str, guild_id: int = 0, names: dict[int, str] | None = None) -> str:
+        """読み上げ用に正規化したテキストを返す（読むものが無ければ空文字）"""
+        text = self.resolve_mentions(text, names)
+        with self._lock:
+            version = self._versions.get(guild_id, 0)
+        return self._normalize_cached(text, guild_id, version)
+
+    def _normalize(self, text: str, guild_id: int, version: int) -> str:
+        # コードブロックとURLは中身を読まない（NFKCで記号が変わる前に処理）
+        text = CODE_BLOCK_PATTERN.sub(f" {self.code_word} ", text)
+        text = MARKDOWN_LINK_PATTERN.sub(r"\1", text)
+        text = URL_PATTERN.sub(f" {self.url_word} ", text)
+        text = SPOILER_PATTERN.sub(f" {self.spoiler_word} ", text)
+
+        # 全角英数・半角カナの揺れをそろえる
+        text = unicodedata.normalize("NFKC", text)
+
+        text = INLINE_CODE_PATTERN.sub(r"\1", text)
+        text = LINE_PREFIX_PATTERN.sub("", text)
+        text = EMPHASIS_PATTERN.sub(r"\2", text)
+
+        text = self._normalize_word(text)
+
+        pattern, entries = self._dictionaries.get(guild_id, (None, {}))
+        if pattern is not None:
+            text = pattern.sub(lambda m: entries.get(m.group(0).lower(), m.group(0)), text)
+
+        return WHITESPACE_PATTERN.sub(" ", text).strip()
+
+    def cache_info(self):
+        return self._normalize_cached.cache_info()
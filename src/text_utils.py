@@ -0,0 +1,39 @@
+import re
+
+# 日本語の文区切り（句点・感嘆符・疑問符・読点・改行）
+SENTENCE_PATTERN = re.compile(r"[^。！？、!?\n]+[。！？、!?\n]*|[。！？、!?\n]+")
+
+
+def split_sentences(text: str, min_chars: int = 10, max_chars: int = 80) -> list[str]:
+    """テキストを文単位のチャンクに分割
+
+    短すぎる断片は次の文とまとめ、max_chars を超える文は文字数で分割する。
+    """
+    chunks: list[str] = []
+    buffer = ""
+
+    for piece in SENTENCE_PATTERN.findall(text):
+        piece = piece.strip()
+        if not piece:
+            continue
+
+        # 区切り文字の無い長文は文字数で分割
+        while len(buffer) + len(piece) > max_chars:
+            room = max(max_chars - len(buffer), 1)
+            chunks.append(buffer + piece[:room])
+            buffer = ""
+            piece = piece[room:]
+
+        buffer += piece
+        if len(buffer) >= min_chars:
+            chunks.append(buffer)
+            buffer = ""
+
+    if buffer:
+        # 末尾の短い断片は直前のチャンクにまとめる
+        if chunks and len(chunks[-1]) + len(buffer) <= max_chars:
+            chunks[-1] += buffer
+        else:
+            chunks.append(buffer)
+
+    return chunks
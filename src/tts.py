@@ -1,12 +1,62 @@
+import os
+import threading
+import time
+from functools import wraps
+from typing import Callable
+
+import librosa
 import torch
+import torchaudio
 import numpy as np
 from scipy.io import wavfile
-from chatterbox.mtl_tts import ChatterboxMultilingualTTS
+from chatterbox.mtl_tts import ChatterboxMultilingualTTS, Conditionals
+from chatterbox.models.s3gen import S3GEN_SR
+from chatterbox.models.s3tokenizer import S3_SR
+from chatterbox.models.t3.modules.cond_enc import T3Cond
+
+from audio_source import DISCORD_SAMPLE_RATE, encode_opus, to_discord_pcm
+from speaker_cache import SpeakerConditioningCache
+from speaker_store import SpeakerStore, parse_ref
+
+
+# 参照音声の正規化設定
+REFERENCE_TRIM_DB = 40
+REFERENCE_MAX_SECONDS = 10
+
+# ウォームアップに使う文（短文・中文・長文で入力長ごとの初回コストを済ませる）
+WARMUP_TEXTS = [
+    "はい。",
+    "今日はいい天気ですね。",
+    "明日の集合は駅前に十時でお願いします。遅れる人は早めに連絡してください。",
+]
 
 
 class ChatterboxVoiceSynthesizer:
-    def __init__(self, device: str | None = None):
+    def __init__(
+        self,
+        device: str | None = None,
+        speaker_cache_size: int = 16,
+        speaker_cache_dir: str | None = None,
+        compile_model: bool = False,
+        quantize: bool = False,
+        num_threads: int = 0,
+        interop_threads: int = 0,
+        speaker_store_path: str | None = None,
+        opus_bitrate: int = 0,
+    ):
         self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        # 0より大きければ出力をこのビットレート（kbps）のOpusパケット列にする
+        self.opus_bitrate = opus_bitrate
+
+        # CPUスレッド数（0ならPyTorchのデフォルト）。Botやワーカー同士でコアを取り合わないように制限する
+        if num_threads > 0:
+            torch.set_num_threads(num_threads)
+        if interop_threads > 0:
+            try:
+                torch.set_interop_threads(interop_threads)
+            except RuntimeError as e:
+                # 並列処理の開始後は変更できない（同じプロセスで2回目の読み込みなど）
+                print(f"Could not set interop threads: {e}")
 
         if self.device == "cuda":
             print(f"GPU: {torch.cuda.get_device_name(0)}")
@@ -16,28 +66,299 @@ class ChatterboxVoiceSynthesizer:
 
         self.model = ChatterboxMultilingualTTS.from_pretrained(device=self.device)
         self.sr = self.model.sr
+        # モデルは同時に1つの処理しか行えないため、生成・話者登録を直列化する
+        self._lock = threading.Lock()
+        # Discord再生用のリサンプラー（カーネルを一度だけ計算）
+        self.resampler = torchaudio.transforms.Resample(self.sr, DISCORD_SAMPLE_RATE)
+
+        if quantize:
+            self._quantize()
+        if compile_model:
+            self._compile(skip_t3=quantize)
+
+        # 直近の合成の区間時間（秒）
+        self.last_timings: dict[str, float] = {}
+        # 生成する音声トークンの上限（0ならモデルの既定。負荷が高いときに短くする）
+        self._max_new_tokens = 0
+        self.model.t3.inference = self._timed(
+            "generation", self._cap_tokens(self.model.t3.inference)
+        )
+        self.model.s3gen.inference = self._timed("vocoder", self.model.s3gen.inference)
+
+        # 組み込みのデフォルト話者（参照音声なしの場合に使用）
+        self.default_conds = self.model.conds
+
+        # 話者ごとのコンディショニングキャッシュ
+        self.speaker_cache = SpeakerConditioningCache(
+            max_entries=speaker_cache_size,
+            cache_dir=speaker_cache_dir,
+            load_fn=self._load_conditionals,
+            save_fn=lambda conds, path: conds.save(path),
+        )
+        # 正規化済みの参照音声をまとめたファイル（"store:" の参照をデコードせずに読む）
+        self.speaker_store = (
+            SpeakerStore(speaker_store_path, sample_rate=S3GEN_SR) if speaker_store_path else None
+        )
         print(f"TTS loaded (device: {self.device})")
 
+    def _quantize(self):
+        """T3の線形層をint8の動的量子化に置き換える（CPUのみ）"""
+        if self.device != "cpu":
+            print("TTS quantization is only supported on CPU, skipping")
+            return
+        torch.ao.quantization.quantize_dynamic(
+            self.model.t3, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+        print("TTS T3 quantized to int8")
+
+    def _compile(self, skip_t3: bool = False):
+        """生成ループで繰り返し呼ばれるサブモジュールを torch.compile する
+
+        - フローマッチングの推定器（1発話あたり複数ステップ呼ばれる）
+        - T3 の各デコーダー層のMLP（1トークンごとに呼ばれる）
+        アテンションはアライメント解析のフックが付くため対象外。入力長は毎回変わるので dynamic=True。
+        """
+        flow_decoder = self.model.s3gen.flow.decoder
+        flow_decoder.estimator = torch.compile(flow_decoder.estimator, dynamic=True)
+        if not skip_t3:
+            for layer in self.model.t3.tfmr.layers:
+                layer.mlp = torch.compile(layer.mlp, dynamic=True)
+        print("TTS submodules compiled (first generations will be slow)")
+
+    def _timed(self, stage: str, fn: Callable) -> Callable:
+        """モデル内部の処理時間を last_timings に記録するラッパー"""
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.last_timings[stage] = time.perf_counter() - start
+        return wrapper
+
+    def _cap_tokens(self, fn: Callable) -> Callable:
+        """generate() が固定で渡す max_new_tokens を _max_new_tokens で置き換えるラッパー"""
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if self._max_new_tokens > 0:
+                kwargs["max_new_tokens"] = self._max_new_tokens
+            return fn(*args, **kwargs)
+        return wrapper
+
+    def _load_conditionals(self, path: str) -> Conditionals:
+        return Conditionals.load(path, map_location=self.device).to(self.device)
+
+    def _compute_conditionals(self, speaker_wav: str) -> Conditionals:
+        """参照音声からコンディショニングを計算"""
+        if parse_ref(speaker_wav):
+            if self.speaker_store is None:
+                raise ValueError("話者ストアが設定されていません")
+            clip = self.speaker_store.read_ref(speaker_wav)
+            return self._conditionals_from_wav(clip.astype(np.float32) / 32767)
+
+        with torch.inference_mode():
+            self.model.prepare_conditionals(speaker_wav, exaggeration=0.5)
+        return self.model.conds
+
+    def _conditionals_from_wav(self, ref_wav: np.ndarray) -> Conditionals:
+        """S3GEN_SRの波形配列からコンディショニングを計算（デコード済みの音声用）"""
+        model = self.model
+        ref_16k_wav = librosa.resample(ref_wav, orig_sr=S3GEN_SR, target_sr=S3_SR)
+
+        with torch.inference_mode():
+            gen_ref_dict = model.s3gen.embed_ref(
+                ref_wav[:model.DEC_COND_LEN], S3GEN_SR, device=self.device
+            )
+
+            cond_prompt_tokens = None
+            if plen := model.t3.hp.speech_cond_prompt_len:
+                cond_prompt_tokens, _ = model.s3gen.tokenizer.forward(
+                    [ref_16k_wav[:model.ENC_COND_LEN]], max_len=plen
+                )
+                cond_prompt_tokens = torch.atleast_2d(cond_prompt_tokens).to(self.device)
+
+            ve_embed = torch.from_numpy(
+                model.ve.embeds_from_wavs([ref_16k_wav], sample_rate=S3_SR)
+            )
+            ve_embed = ve_embed.mean(axis=0, keepdim=True).to(self.device)
+
+        t3_cond = T3Cond(
+            speaker_emb=ve_embed,
+            cond_prompt_speech_tokens=cond_prompt_tokens,
+            emotion_adv=0.5 * torch.ones(1, 1, 1),
+        ).to(device=self.device)
+        return Conditionals(t3_cond, gen_ref_dict)
+
+    @staticmethod
+    def normalize_reference(src_path: str) -> np.ndarray:
+        """参照音声を一度だけデコードし、モデルのサンプルレート・無音除去・長さ上限に揃える"""
+        wav, _ = librosa.load(src_path, sr=S3GEN_SR, mono=True)
+        wav, _ = librosa.effects.trim(wav, top_db=REFERENCE_TRIM_DB)
+        return wav[:REFERENCE_MAX_SECONDS * S3GEN_SR].astype(np.float32)
+
+    def prepare_speaker(self, src_path: str, wav_path: str, conds_path: str):
+        """アップロードされた参照音声を正規化して保存し、コンディショニングを事前計算する"""
+        wav = self.normalize_reference(src_path)
+        if len(wav) == 0:
+            raise ValueError("音声が含まれていません")
+
+        wav_int16 = (wav * 32767).clip(-32768, 32767).astype(np.int16)
+        wavfile.write(wav_path, S3GEN_SR, wav_int16)
+
+        # wav_path は話者ストアへの追記後に消える一時ファイルなので、キャッシュには載せない
+        # （初回の合成時に conds_path から読み込まれ、話者ストアの参照をキーにキャッシュされる）
+        with self._lock:
+            conds = self._conditionals_from_wav(wav)
+        conds.save(conds_path)
+
+    def get_conditionals(
+        self,
+        speaker_wav: str | None,
+        conds_path: str | None = None,
+    ) -> Conditionals | None:
+        """話者のコンディショニングを取得（キャッシュ → 事前計算ファイル → 計算の順）"""
+        if not speaker_wav:
+            return self.default_conds
+
+        def compute(path: str) -> Conditionals:
+            if conds_path and os.path.exists(conds_path):
+                return self._load_conditionals(conds_path)
+            return self._compute_conditionals(path)
+
+        return self.speaker_cache.get(speaker_wav, compute)
+
+    def prefetch_speaker(self, speaker_wav: str, conds_path: str | None) -> bool:
+        """事前計算済みのコンディショニングをメモリに載せておく（読み込んだら True）
+
+        モデルを使う計算は合成と競合するので行わない（事前計算ファイルが無い話者は対象外）。
+        """
+        if not speaker_wav or not conds_path or not os.path.exists(conds_path):
+            return False
+        if self.speaker_cache.touch(speaker_wav):
+            return False
+        self.speaker_cache.put(speaker_wav, self._load_conditionals(conds_path))
+        return True
+
+    def invalidate_speaker(self, speaker_wav: str):
+        """話者ファイルのキャッシュを破棄"""
+        self.speaker_cache.invalidate(speaker_wav)
+
+    def _generate(
+        self,
+        text: str,
+        speaker_wav: str | None = None,
+        language: str = "ja",
+        conds_path: str | None = None,
+        params: tuple = (),
+    ) -> torch.Tensor:
+        """音声を生成し、1次元のCPUテンソル（self.sr）を返す
+
+        params は (名前, 値) の組（cfg_weight・max_new_tokens）。無いものは既定値を使う。
+        """
+        options = dict(params)
+        self.last_timings = {}
+        start = time.perf_counter()
+        self.model.conds = self.get_conditionals(speaker_wav, conds_path)
+        self.last_timings["conditioning"] = time.perf_counter() - start
+
+        self._max_new_tokens = options.get("max_new_tokens", 0)
+        try:
+            with torch.inference_mode(), torch.autocast(
+                device_type="cuda", enabled=self.device == "cuda"
+            ):
+                wav = self.model.generate(
+                    text,
+                    language_id=language,
+                    exaggeration=0.5,
+                    cfg_weight=options.get("cfg_weight", 0.5),
+                )
+        finally:
+            self._max_new_tokens = 0
+
+        if wav.dim() == 2:
+            wav = wav.squeeze(0)
+        return wav.detach().float().cpu()
+
     def synthesize_to_file(
         self,
         text: str,
         out_path: str,
         speaker_wav: str | None = None,
         language: str = "ja",
+        conds_path: str | None = None,
+        params: tuple = (),
     ):
-        with torch.inference_mode(), torch.autocast(
-            device_type="cuda", enabled=self.device == "cuda"
-        ):
-            wav = self.model.generate(
-                text,
-                audio_prompt_path=speaker_wav,
-                language_id=language,
-                exaggeration=0.5,
-                cfg_weight=0.5,
-            )
+        with self._lock:
+            wav = self._generate(text, speaker_wav, language, conds_path, params)
 
         # Tensor -> int16 WAV
-        if wav.dim() == 2:
-            wav = wav.squeeze(0)
-        wav_int16 = (wav.cpu().numpy() * 32767).clip(-32768, 32767).astype(np.int16)
+        wav_int16 = (wav.numpy() * 32767).clip(-32768, 32767).astype(np.int16)
         wavfile.write(out_path, self.sr, wav_int16)
+
+    def synthesize_pcm(
+        self,
+        text: str,
+        speaker_wav: str | None = None,
+        language: str = "ja",
+        conds_path: str | None = None,
+        params: tuple = (),
+    ) -> bytes:
+        """音声を生成し、Discordでそのまま再生できるPCM（48kHzステレオs16le）を返す
+
+        opus_bitrate が設定されていれば、PCMの代わりに encode_opus したパケット列を返す。
+        """
+        with self._lock:
+            wav = self._generate(text, speaker_wav, language, conds_path, params)
+        return self._to_pcm(wav)
+
+    def warmup(self, texts: list[str] = WARMUP_TEXTS, language: str = "ja") -> float:
+        """長さの異なる文を生成し、カーネル選択・コンパイル・メモリ確保を済ませる（所要秒を返す）"""
+        start = time.perf_counter()
+        for text in texts:
+            self.synthesize_pcm(text, language=language)
+        if self.device == "cuda":
+            torch.cuda.synchronize()
+        return time.perf_counter() - start
+
+    def _to_pcm(self, wav: torch.Tensor) -> bytes:
+        start = time.perf_counter()
+        with torch.inference_mode():
+            wav_48k = self.resampler(wav)
+        pcm = to_discord_pcm(wav_48k.numpy(), DISCORD_SAMPLE_RATE)
+        if self.opus_bitrate:
+            pcm = encode_opus(pcm, self.opus_bitrate)
+        self.last_timings["encode"] = time.perf_counter() - start
+        return pcm
+
+    def synthesize_many(
+        self,
+        jobs: list[tuple],
+        on_result: Callable[[int, bytes | Exception, dict], None] | None = None,
+        should_skip: Callable[[int], bool] | None = None,
+    ) -> list[bytes | Exception | None]:
+        """複数リクエストを順に生成し、PCMを返す
+
+        jobs は (text, speaker_wav, language, conds_path, params) のリスト。
+        モデルは1件ずつ実行する（パディングしてまとめて推論はしない）ので、速くなるのは
+        ロックの取得とスレッドの切り替えが1回で済む分だけ。各結果は完了次第
+        on_result(index, result, timings) で通知する。
+        失敗したリクエストは例外オブジェクトを結果として返す。
+        should_skip(index) が真になったリクエスト（取り消し済み）は生成せず None を返す。
+        """
+        results: list[bytes | Exception | None] = []
+        with self._lock:
+            for index, (text, speaker_wav, language, conds_path, params) in enumerate(jobs):
+                if should_skip and should_skip(index):
+                    results.append(None)
+                    continue
+                start = time.perf_counter()
+                try:
+                    wav = self._generate(text, speaker_wav, language, conds_path, params)
+                    result = self._to_pcm(wav)
+                except Exception as e:
+                    result = e
+                timings = dict(self.last_timings, synthesis=time.perf_counter() - start)
+                results.append(result)
+                if on_result:
+                    on_result(index, result, timings)
+        return results
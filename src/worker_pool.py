@@ -0,0 +1,293 @@
+import asyncio
+import collections
+import itertools
+import multiprocessing as mp
+import queue
+import threading
+import time
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Callable
+
+
+def _worker_main(
+    worker_id: int,
+    job_queue: mp.Queue,
+    result_queue: mp.Queue,
+    synth_kwargs: dict,
+    engine_config: dict,
+):
+    """ワーカープロセス: モデルを1度だけ読み込み、自分宛てのキューのジョブを処理する"""
+    from engines import create_synthesizer
+
+    synth = create_synthesizer(synth_kwargs, **engine_config)
+    synth.warmup()
+    result_queue.put(("ready", worker_id))
+
+    while True:
+        message = job_queue.get()
+        if message is None:
+            break
+
+        # 話者キャッシュの破棄など、全ワーカー宛ての通知
+        if message[0] == "invalidate":
+            synth.invalidate_speaker(message[1])
+            continue
+
+        _, job_id, kind, args = message
+        shm_name, size, error, timings = None, 0, None, {}
+        start = time.perf_counter()
+        try:
+            if kind == "synth":
+                pcm = synth.synthesize_pcm(*args)
+                timings = dict(synth.last_timings, synthesis=time.perf_counter() - start)
+                size = len(pcm)
+                shm = SharedMemory(create=True, size=max(size, 1))
+                shm.buf[:size] = pcm
+                shm_name = shm.name
+                shm.close()
+                # 解放は受け取った側（unlink）で行う
+                resource_tracker.unregister(shm._name, "shared_memory")
+            elif kind == "prepare":
+                synth.prepare_speaker(*args)
+            elif kind == "prefetch":
+                synth.prefetch_speaker(*args)
+            else:
+                raise ValueError(f"unknown job kind: {kind}")
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+
+        result_queue.put(("done", worker_id, job_id, shm_name, size, error, timings))
+
+
+class ProcessPoolBackend:
+    """複数のシンセサイザープロセスで合成するバックエンド
+
+    各ワーカーはエンジンのレジストリ（engines.create_synthesizer）を作成し、自分宛てのキューから
+    ジョブを取り出す。ジョブは空いているワーカーに1件ずつ渡すので、ワーカーが落ちても
+    処理中だったジョブが分かる。PCMは共有メモリ経由で受け取るため、Botプロセスは推論を行わない。
+    """
+
+    # 結果が届き続けていても、この間隔でワーカーの生存を確認する
+    CHECK_INTERVAL = 1.0
+
+    def __init__(
+        self,
+        num_workers: int,
+        synth_kwargs: dict | None = None,
+        engine_config: dict | None = None,
+    ):
+        self.num_workers = max(1, num_workers)
+        self.synth_kwargs = synth_kwargs or {}
+        # create_synthesizer に渡すエンジンの設定（言語ごとの振り分け・解放の条件）
+        self.engine_config = engine_config or {}
+        self._ctx = mp.get_context("spawn")
+        self._result_queue = self._ctx.Queue()
+        self._job_queues: list[mp.Queue] = []
+        self._processes: list[mp.Process] = []
+        self._job_ids = itertools.count()
+        # job_id -> (loop, future)
+        self._pending: dict[int, tuple[asyncio.AbstractEventLoop, asyncio.Future]] = {}
+        # job_id -> 区間時間（run_batch がリクエストに書き戻す）
+        self._timings: dict[int, dict] = {}
+        # ワーカーに渡す前のジョブ (job_id, kind, args)
+        self._waiting: collections.deque[tuple[int, str, tuple]] = collections.deque()
+        # 準備ができていて手が空いているワーカー
+        self._idle: set[int] = set()
+        # worker_id -> 処理中のjob_id
+        self._running: dict[int, int] = {}
+        self._lock = threading.Lock()
+        self._closed = False
+        self.ready_workers = 0
+        # 準備完了（ready）を返す前に終了したワーカーの数
+        self.startup_failures = 0
+
+        for worker_id in range(self.num_workers):
+            self._job_queues.append(self._ctx.Queue())
+            self._processes.append(self._spawn(worker_id))
+
+        self._reader = threading.Thread(target=self._read_results, daemon=True)
+        self._reader.start()
+
+    def _spawn(self, worker_id: int) -> mp.Process:
+        process = self._ctx.Process(
+            target=_worker_main,
+            args=(
+                worker_id,
+                self._job_queues[worker_id],
+                self._result_queue,
+                self.synth_kwargs,
+                self.engine_config,
+            ),
+            daemon=True,
+        )
+        process.start()
+        return process
+
+    def _dispatch(self):
+        """待機中のジョブを空いているワーカーに渡す（self._lock を保持して呼ぶ）"""
+        while self._waiting and self._idle:
+            worker_id = self._idle.pop()
+            job_id, kind, args = self._waiting.popleft()
+            self._running[worker_id] = job_id
+            self._job_queues[worker_id].put(("job", job_id, kind, args))
+
+    def _resolve(self, job_id: int, result: Any = None, error: BaseException | None = None):
+        with self._lock:
+            entry = self._pending.pop(job_id, None)
+        if entry is None:
+            return
+        loop, future = entry
+
+        def set_result():
+            if future.done():
+                return
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+        loop.call_soon_threadsafe(set_result)
+
+    def _check_workers(self):
+        """落ちたワーカーの処理中ジョブを失敗させ、再起動する"""
+        for worker_id, process in enumerate(self._processes):
+            if process.is_alive() or self._closed:
+                continue
+            print(f"TTS worker {worker_id} exited (code {process.exitcode}), restarting")
+            with self._lock:
+                job_id = self._running.pop(worker_id, None)
+                if job_id is not None or worker_id in self._idle:
+                    self.ready_workers -= 1
+                else:
+                    self.startup_failures += 1
+                self._idle.discard(worker_id)
+                # 落ちたプロセスがキューのロックを握ったままの可能性があるので作り直す
+                self._job_queues[worker_id] = self._ctx.Queue()
+            if job_id is not None:
+                self._resolve(job_id, error=RuntimeError("TTS worker crashed"))
+            self._processes[worker_id] = self._spawn(worker_id)
+
+    def _read_results(self):
+        """結果キューを読み、対応するfutureを完了させる（専用スレッド）"""
+        next_check = time.monotonic() + self.CHECK_INTERVAL
+        while not self._closed:
+            if time.monotonic() >= next_check:
+                self._check_workers()
+                next_check = time.monotonic() + self.CHECK_INTERVAL
+            try:
+                message = self._result_queue.get(timeout=self.CHECK_INTERVAL)
+            except queue.Empty:
+                continue
+            except (EOFError, OSError):
+                break
+
+            kind = message[0]
+            if kind == "ready":
+                worker_id = message[1]
+                with self._lock:
+                    self.ready_workers += 1
+                    self._idle.add(worker_id)
+                    self._dispatch()
+                print(f"TTS worker {worker_id} ready")
+            elif kind == "done":
+                _, worker_id, job_id, shm_name, size, error, timings = message
+                with self._lock:
+                    if self._running.get(worker_id) == job_id:
+                        del self._running[worker_id]
+                        self._idle.add(worker_id)
+                        self._dispatch()
+                    if job_id in self._pending:
+                        self._timings[job_id] = timings
+                if error:
+                    self._resolve(job_id, error=RuntimeError(error))
+                elif shm_name:
+                    shm = SharedMemory(name=shm_name)
+                    try:
+                        pcm = bytes(shm.buf[:size])
+                    finally:
+                        shm.close()
+                        shm.unlink()
+                    self._resolve(job_id, pcm)
+                else:
+                    self._resolve(job_id, None)
+
+    def _submit(self, kind: str, args: tuple) -> tuple[int, asyncio.Future]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        job_id = next(self._job_ids)
+        with self._lock:
+            self._pending[job_id] = (loop, future)
+            self._waiting.append((job_id, kind, args))
+            self._dispatch()
+        return job_id, future
+
+    async def run_batch(
+        self,
+        requests: list,
+        on_result: Callable[[int, Any], None],
+    ) -> None:
+        """バッチの各リクエストをワーカーに振り分け、完了した順に結果を返す"""
+        jobs = [self._submit("synth", r.job) for r in requests]
+
+        def deliver(index: int, job_id: int, future: asyncio.Future):
+            with self._lock:
+                timings = self._timings.pop(job_id, {})
+            if future.cancelled():
+                return
+            requests[index].timings.update(timings)
+            on_result(index, future.exception() or future.result())
+
+        for index, (job_id, future) in enumerate(jobs):
+            future.add_done_callback(
+                lambda f, index=index, job_id=job_id: deliver(index, job_id, f)
+            )
+            # リクエストが取り消されたら（VC退出など）未着手のジョブを飛ばす
+            requests[index].future.add_done_callback(
+                lambda f, job_id=job_id, future=future: (
+                    self._cancel(job_id, future) if f.cancelled() else None
+                )
+            )
+        await asyncio.gather(*(future for _, future in jobs), return_exceptions=True)
+
+    def _cancel(self, job_id: int, future: asyncio.Future):
+        """ジョブを取り消す（未着手ならワーカーに渡さず、処理中のものは結果を捨てる）"""
+        with self._lock:
+            self._pending.pop(job_id, None)
+            for waiting in self._waiting:
+                if waiting[0] == job_id:
+                    self._waiting.remove(waiting)
+                    break
+        future.cancel()
+
+    async def prepare_speaker(self, src_path: str, wav_path: str, conds_path: str):
+        """話者登録の前処理をワーカーで実行"""
+        _, future = self._submit("prepare", (src_path, wav_path, conds_path))
+        await future
+
+    async def prefetch_speaker(self, speaker_wav: str, conds_path: str | None):
+        """空いているワーカーにコンディショニングを読み込ませる
+
+        どのワーカーが合成するかは決まらないが、事前計算ファイルはOSのページキャッシュに載る。
+        """
+        _, future = self._submit("prefetch", (speaker_wav, conds_path))
+        await future
+
+    def invalidate_speaker(self, speaker_wav: str):
+        """全ワーカーに話者キャッシュの破棄を通知（処理中のジョブの次に処理される）"""
+        with self._lock:
+            for job_queue in self._job_queues:
+                job_queue.put(("invalidate", speaker_wav))
+
+    def close(self):
+        """ワーカーを停止"""
+        if self._closed:
+            return
+        self._closed = True
+        with self._lock:
+            for job_queue in self._job_queues:
+                job_queue.put(None)
+        for process in self._processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
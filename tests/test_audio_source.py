@@ -0,0 +1,69 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+from audio_source import DISCORD_CHANNELS, FRAME_SAMPLES, SILENCE_FRAME, GuildAudioStream
+
+
+def pcm(value: int, frames: int) -> bytes:
+    return np.full(frames * FRAME_SAMPLES * DISCORD_CHANNELS, value, dtype=np.int16).tobytes()
+
+
+def frame_values(frames: list[bytes]) -> list[int]:
+    """各フレームの先頭サンプルの値"""
+    return [int(np.frombuffer(frame, dtype=np.int16)[0]) for frame in frames]
+
+
+def read_buffered(stream: GuildAudioStream) -> list[bytes]:
+    frames = []
+    while stream.buffered_seconds > 0:
+        frames.append(stream.read())
+    return frames
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+def test_crossfade_overlaps_chunks_of_same_message(loop):
+    stream = GuildAudioStream(loop, gap_ms=100, crossfade_ms=60)
+    stream.append(pcm(1000, 10), message_id=1)
+    stream.append(pcm(-1000, 10), message_id=1)
+
+    values = frame_values(read_buffered(stream))
+    # 3フレーム重なるので 10 + 10 - 3
+    assert len(values) == 17
+    assert values[:7] == [1000] * 7
+    assert values[-7:] == [-1000] * 7
+    # 重なった部分は前のチャンクから次のチャンクへ移っていく
+    assert values[7] == 1000 and -1000 < values[9] < 1000
+
+
+def test_gap_between_messages(loop):
+    stream = GuildAudioStream(loop, gap_ms=100, crossfade_ms=60)
+    stream.append(pcm(1000, 10), message_id=1)
+    stream.append(pcm(-1000, 10), message_id=2)
+
+    frames = read_buffered(stream)
+    # 最初のメッセージの前には無音を入れず、別のメッセージとの間には重ねずに5フレームの無音を入れる
+    assert len(frames) == 25
+    assert frame_values(frames[:10]) == [1000] * 10
+    assert frames[10:15] == [SILENCE_FRAME] * 5
+    assert frame_values(frames[15:]) == [-1000] * 10
+
+
+def test_gap_subtracts_idle_silence(loop):
+    stream = GuildAudioStream(loop, gap_ms=100)
+    stream.append(pcm(1000, 2), message_id=1)
+    read_buffered(stream)
+    # 待機中に3フレームの無音が流れた
+    assert [stream.read() for _ in range(3)] == [SILENCE_FRAME] * 3
+
+    stream.append(pcm(-1000, 2), message_id=2)
+    frames = read_buffered(stream)
+    assert frames[:2] == [SILENCE_FRAME] * 2
+    assert frame_values(frames[2:]) == [-1000] * 2
@@ -0,0 +1,41 @@
+from length_policy import LengthPolicy, estimate_speech_tokens, parse_guild_limits
+
+# 7文字 = 1秒 = 25トークン
+SENTENCE = "あいうえおかき"
+
+
+def test_estimate_speech_tokens():
+    assert estimate_speech_tokens(SENTENCE) == 25
+    assert estimate_speech_tokens(SENTENCE + "く") == 29
+    assert estimate_speech_tokens("") == 0
+
+
+def test_truncate_keeps_whole_sentences_within_budget():
+    policy = LengthPolicy(max_tokens=50)
+    assert policy.truncate([SENTENCE, SENTENCE]) == ([SENTENCE, SENTENCE], False)
+    assert policy.truncate([SENTENCE, SENTENCE, SENTENCE]) == ([SENTENCE, SENTENCE, "以下略"], True)
+
+
+def test_truncate_cuts_first_sentence_by_characters():
+    policy = LengthPolicy(max_tokens=25, truncation_suffix="")
+    assert policy.truncate([SENTENCE * 3]) == ([SENTENCE], True)
+
+
+def test_guild_limits_override_default():
+    policy = LengthPolicy(max_tokens=25, guild_limits={1: 50, 2: 0})
+    chunks = [SENTENCE, SENTENCE]
+    assert policy.truncate(chunks, guild_id=0) == ([SENTENCE, "以下略"], True)
+    assert policy.truncate(chunks, guild_id=1) == (chunks, False)
+    # 0 は上限なし
+    assert policy.truncate(chunks * 10, guild_id=2) == (chunks * 10, False)
+
+
+def test_is_long():
+    policy = LengthPolicy(long_tokens=50)
+    assert not policy.is_long([SENTENCE, SENTENCE])
+    assert policy.is_long([SENTENCE, SENTENCE, "あ"])
+
+
+def test_parse_guild_limits_skips_invalid_entries():
+    assert parse_guild_limits("1:100, 2:abc,3,4:0") == {1: 100, 4: 0}
+    assert parse_guild_limits("") == {}
@@ -0,0 +1,63 @@
+import asyncio
+import time
+
+from audio_source import FRAME_SIZE
+from playback import CHARS_PER_SECOND, AudioItem, PlaybackQueue
+
+
+def make_item(text: str = "", message_id: int = 0, user_id: int = 0, pcm: bytes | None = None) -> AudioItem:
+    return AudioItem(asyncio.Event(), pcm=pcm, text=text, message_id=message_id, user_id=user_id)
+
+
+def test_would_be_stale_uses_estimated_wait():
+    queue = PlaybackQueue(max_age=10.0)
+    assert not queue.would_be_stale()
+
+    # 文字数からの見積もりでちょうど10秒なら、まだ間に合う
+    queue.put_message([make_item("あ" * int(10 * CHARS_PER_SECOND), message_id=1)])
+    assert queue.estimated_wait() == 10.0
+    assert not queue.would_be_stale()
+
+    queue.put_message([make_item("あ", message_id=2)])
+    assert queue.would_be_stale()
+
+
+def test_would_be_stale_prefers_rendered_length():
+    queue = PlaybackQueue(max_age=10.0)
+    # 長いテキストでも、生成済みの音声が短ければその長さで見積もる
+    queue.put_message([make_item("あ" * 200, message_id=1, pcm=b"\0" * FRAME_SIZE * 50 * 5)])
+    assert queue.estimated_wait() == 5.0
+    assert not queue.would_be_stale()
+
+
+def test_would_be_stale_disabled_without_max_age():
+    queue = PlaybackQueue(max_age=0)
+    queue.put_message([make_item("あ" * 1000, message_id=1)])
+    assert not queue.would_be_stale()
+
+
+def test_put_message_drops_oldest_messages_over_max_items():
+    queue = PlaybackQueue(max_items=3)
+    first = [make_item("a", message_id=1), make_item("b", message_id=1)]
+    queue.put_message(first)
+    queue.put_message([make_item("c", message_id=2)])
+    queue.put_message([make_item("d", message_id=3)])
+
+    # メッセージ1のチャンクはまとめて破棄される
+    assert len(queue) == 2
+    assert queue.dropped == 2
+    assert all(item.ready.is_set() and item.pcm is None for item in first)
+
+
+def test_get_skips_items_older_than_max_age():
+    async def main():
+        queue = PlaybackQueue(max_age=10.0)
+        old = make_item("old", message_id=1)
+        old.created_at = time.monotonic() - 11.0
+        queue.put_message([old])
+        queue.put_message([make_item("new", message_id=2)])
+        return await queue.get(), queue.dropped
+
+    item, dropped = asyncio.run(main())
+    assert item.text == "new"
+    assert dropped == 1
@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+
+from scheduler import QueueFullError, SynthesisRequest, SynthesisScheduler
+
+
+class RecordingBackend:
+    """受け取ったバッチのテキストを記録し、テキストをそのまま返すバックエンド"""
+
+    def __init__(self):
+        self.batches: list[list[str]] = []
+
+    async def run_batch(self, requests, on_result):
+        self.batches.append([r.text for r in requests])
+        for index, request in enumerate(requests):
+            on_result(index, request.text.encode())
+
+
+async def run_queued(scheduler: SynthesisScheduler, requests: list[SynthesisRequest]) -> RecordingBackend:
+    """バックエンドが無い間にリクエストを積み、まとめて処理させる"""
+    scheduler.start()
+    futures = [scheduler.submit(request) for request in requests]
+    backend = RecordingBackend()
+    scheduler.set_backend(backend)
+    await asyncio.gather(*futures)
+    await scheduler.stop()
+    return backend
+
+
+def test_queued_requests_are_coalesced_up_to_max_batch_size():
+    async def main():
+        scheduler = SynthesisScheduler(None, batch_window=0.0, max_batch_size=4)
+        return await run_queued(scheduler, [SynthesisRequest(str(i)) for i in range(5)])
+
+    backend = asyncio.run(main())
+    assert backend.batches == [["0", "1", "2", "3"], ["4"]]
+
+
+def test_batch_window_waits_for_followups():
+    async def main():
+        backend = RecordingBackend()
+        scheduler = SynthesisScheduler(backend, batch_window=0.2, max_batch_size=4)
+        scheduler.start()
+        first = scheduler.submit(SynthesisRequest("a"))
+        await asyncio.sleep(0.02)
+        second = scheduler.submit(SynthesisRequest("b"))
+        assert await asyncio.gather(first, second) == [b"a", b"b"]
+        await scheduler.stop()
+        return backend
+
+    assert asyncio.run(main()).batches == [["a", "b"]]
+
+
+def test_guilds_are_served_round_robin():
+    async def main():
+        scheduler = SynthesisScheduler(None, max_batch_size=1)
+        requests = [SynthesisRequest(f"a{i}", guild_id=1) for i in range(3)]
+        requests += [SynthesisRequest(f"b{i}", guild_id=2) for i in range(2)]
+        return await run_queued(scheduler, requests)
+
+    backend = asyncio.run(main())
+    assert [text for batch in backend.batches for text in batch] == ["a0", "b0", "a1", "b1", "a2"]
+
+
+def test_pending_cap_per_guild():
+    async def main():
+        scheduler = SynthesisScheduler(None, max_pending_per_guild=2)
+        first = scheduler.submit(SynthesisRequest("a", guild_id=1, user_id=1))
+        scheduler.submit(SynthesisRequest("b", guild_id=1, user_id=2))
+        with pytest.raises(QueueFullError):
+            scheduler.submit(SynthesisRequest("c", guild_id=1, user_id=3))
+        # 他のギルドは影響を受けない
+        scheduler.submit(SynthesisRequest("d", guild_id=2, user_id=3))
+
+        # キャンセルされたリクエストは上限から外れる
+        first.cancel()
+        await asyncio.sleep(0)
+        assert scheduler.pending_for_guild(1) == 1
+        scheduler.submit(SynthesisRequest("c", guild_id=1, user_id=3))
+        await scheduler.stop()
+
+    asyncio.run(main())
+
+
+def test_pending_cap_per_user_spans_guilds():
+    async def main():
+        scheduler = SynthesisScheduler(None, max_pending_per_user=2)
+        scheduler.submit(SynthesisRequest("a", guild_id=1, user_id=1))
+        scheduler.submit(SynthesisRequest("b", guild_id=2, user_id=1))
+        with pytest.raises(QueueFullError):
+            scheduler.submit(SynthesisRequest("c", guild_id=3, user_id=1))
+        scheduler.submit(SynthesisRequest("d", guild_id=3, user_id=2))
+        await scheduler.stop()
+
+    asyncio.run(main())
+
+
+def test_low_priority_requests_wait_for_normal_ones():
+    async def main():
+        scheduler = SynthesisScheduler(None, max_batch_size=1)
+        return await run_queued(scheduler, [
+            SynthesisRequest("long", guild_id=1, low_priority=True),
+            SynthesisRequest("a", guild_id=1),
+            SynthesisRequest("b", guild_id=2),
+        ])
+
+    backend = asyncio.run(main())
+    assert [text for batch in backend.batches for text in batch] == ["a", "b", "long"]
@@ -0,0 +1,99 @@
+import os
+
+import numpy as np
+import pytest
+
+from speaker_store import SpeakerStore, make_ref
+
+
+class Crash(Exception):
+    """DB の更新直後にプロセスが止まったことの代わり"""
+
+
+def clip(value: int, length: int = 100) -> np.ndarray:
+    return np.full(length, value, dtype=np.int16)
+
+
+def fill(store: SpeakerStore) -> dict[int, tuple[int, int, str, int]]:
+    """話者1〜3を登録し、{話者ID: append の戻り値} を返す"""
+    return {speaker_id: store.append(clip(speaker_id, 100 * speaker_id)) for speaker_id in (1, 2, 3)}
+
+
+def test_append_and_read_ref(tmp_path):
+    store = SpeakerStore(str(tmp_path / "speakers.bin"))
+    offset, length, digest, generation = store.append(clip(7))
+    assert (offset, length, generation) == (0, 100, 0)
+    assert store.append(clip(8))[0] == 100
+
+    samples = store.read_ref(make_ref(generation, offset, length, digest))
+    assert np.array_equal(samples, clip(7))
+    with pytest.raises(ValueError):
+        store.read_ref(make_ref(generation, 100, 100, digest))
+
+
+def test_compact_invalidates_old_refs(tmp_path):
+    store = SpeakerStore(str(tmp_path / "speakers.bin"))
+    appended = fill(store)
+    # 話者2を削除した状態
+    clips = {speaker_id: appended[speaker_id][:2] for speaker_id in (1, 3)}
+    assert store.wasted_bytes(clips) == 200 * 2
+    committed = []
+
+    moved = store.compact(clips, commit=lambda moved, generation: committed.append((moved, generation)))
+
+    assert moved == {1: (0, 100), 3: (100, 300)}
+    assert committed == [(moved, 1)]
+    assert store.generation == 1
+    assert store.wasted_bytes(moved) == 0
+    assert not os.path.exists(store.path + ".tmp")
+
+    assert np.array_equal(store.read_ref(make_ref(1, *moved[3], appended[3][2])), clip(3, 300))
+    # 詰め直し前の参照は、位置と中身が変わっていなくても読めない
+    offset, length, digest, generation = appended[1]
+    assert moved[1] == (offset, length)
+    with pytest.raises(ValueError):
+        store.read_ref(make_ref(generation, offset, length, digest))
+
+
+def test_recover_finishes_compaction_committed_before_crash(tmp_path):
+    path = str(tmp_path / "speakers.bin")
+    store = SpeakerStore(path)
+    appended = fill(store)
+    clips = {speaker_id: appended[speaker_id][:2] for speaker_id in (1, 3)}
+    committed: dict[str, int] = {"generation": 0}
+
+    def commit(moved, generation):
+        committed["generation"] = generation
+        raise Crash()
+
+    with pytest.raises(Crash):
+        store.compact(clips, commit=commit)
+    assert os.path.exists(path + ".tmp")
+    assert store.generation == 0
+
+    # 再起動後、DB に記録された世代に揃える
+    restarted = SpeakerStore(path)
+    restarted.recover(committed["generation"])
+    assert restarted.generation == 1
+    assert not os.path.exists(path + ".tmp")
+    digest = appended[3][2]
+    assert np.array_equal(restarted.read_ref(make_ref(1, 100, 300, digest)), clip(3, 300))
+
+
+def test_recover_discards_uncommitted_compaction(tmp_path):
+    path = str(tmp_path / "speakers.bin")
+    store = SpeakerStore(path)
+    appended = fill(store)
+
+    def commit(moved, generation):
+        raise Crash()
+
+    with pytest.raises(Crash):
+        store.compact({1: appended[1][:2]}, commit=commit)
+
+    restarted = SpeakerStore(path)
+    restarted.recover(0)
+    assert restarted.generation == 0
+    assert not os.path.exists(path + ".tmp")
+    offset, length, digest, generation = appended[2]
+    assert np.array_equal(restarted.read_ref(make_ref(generation, offset, length, digest)), clip(2, 200))
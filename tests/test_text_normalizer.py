@@ -0,0 +1,55 @@
+from text_normalizer import TextNormalizer
+
+
+def test_repeat_collapses_symbols_and_kana():
+    normalizer = TextNormalizer(max_repeat=3)
+    assert normalizer.normalize("えーーーーー！！！！！") == "えーーー!!!"
+
+
+def test_repeat_keeps_digits_and_ascii_letters():
+    normalizer = TextNormalizer(max_repeat=3)
+    assert normalizer.normalize("1000000円") == "1000000円"
+    assert normalizer.normalize("１０００００００円") == "10000000円"
+    assert normalizer.normalize("keroooo") == "keroooo"
+
+
+def test_laugh():
+    normalizer = TextNormalizer()
+    assert normalizer.normalize("それなｗｗｗ") == "それなわら"
+    assert normalizer.normalize("www.example.com") == "URL省略"
+    assert normalizer.normalize("window") == "window"
+
+
+def test_dictionary_keys_are_normalized_like_text():
+    normalizer = TextNormalizer()
+    normalizer.set_dictionary(1, {"ＧＰＵ": "じーぴーゆー", "www": "わらわら", "keroooo": "けろー"})
+    assert normalizer.normalize("GPUが足りない", guild_id=1) == "じーぴーゆーが足りない"
+    assert normalizer.normalize("ｗｗｗ", guild_id=1) == "わらわら"
+    assert normalizer.normalize("keroooo", guild_id=1) == "けろー"
+
+
+def test_dictionary_is_case_insensitive():
+    normalizer = TextNormalizer()
+    normalizer.set_dictionary(1, {"Discord": "ディスコード"})
+    assert normalizer.normalize("discordとDISCORD", guild_id=1) == "ディスコードとディスコード"
+
+
+def test_dictionary_prefers_longer_words():
+    normalizer = TextNormalizer()
+    normalizer.set_dictionary(1, {"東京": "とうきょう", "東京都": "とうきょうと"})
+    assert normalizer.normalize("東京都に行く", guild_id=1) == "とうきょうとに行く"
+
+
+def test_dictionary_update_invalidates_cache():
+    normalizer = TextNormalizer()
+    normalizer.set_dictionary(1, {"kero": "けろ"})
+    assert normalizer.normalize("kero", guild_id=1) == "けろ"
+    normalizer.set_dictionary(1, {})
+    assert normalizer.normalize("kero", guild_id=1) == "kero"
+    assert normalizer.normalize("kero", guild_id=2) == "kero"
+
+
+def test_mentions_and_markdown():
+    normalizer = TextNormalizer()
+    text = "<@123> **太字** `code` ||秘密|| <:kero:456>"
+    assert normalizer.normalize(text, names={123: "けろ"}) == "けろ 太字 code 伏せ字 kero"